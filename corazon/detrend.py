@@ -0,0 +1,318 @@
+# -*- coding: utf-8 -*-
+"""
+Detrenders for removing stellar and instrumental variability before the
+transit search.
+
+Every detrender has the same signature, ``trend = func(time, flux, window)``,
+and returns the trend at each point. `detrend` picks one by name, leaves
+gapped points out of the trend, and returns ``flux/trend - 1``. The
+pipeline chooses one with the "detrender" config key.
+
+window is the half width of the sliding window in cadences (the
+"det_window" config value). Each point's window covers ``2*window``
+cadences and is shifted to stay inside the data near the ends.
+
+`detrend_segments` and `stream_detrend` split a light curve at gaps in
+time and detrend each contiguous segment on its own, so windows do not
+straddle orbit or sector gaps, and long multi-sector light curves can be
+processed a segment at a time.
+
+Speed and accuracy, from ``benchmark(n_lc=20, seed=1)`` (27 d at 30 min
+cadence, window 65, a 4 h, 1000 ppm transit on a 10 d, 0.5% sinusoid
+plus 1000 ppm noise):
+
+========  ========  =========  ==========  ================================
+name      time      rms (ppm)  depth kept  notes
+========  ========  =========  ==========  ================================
+median    3 ms      1155       0.88        Default. Robust to outliers,
+                                           but a transit drags the median
+                                           of a short window.
+box       0.06 ms   1186       0.94        Running mean, O(n) whatever the
+                                           window. Fastest. Outliers and
+                                           flares leak into the trend, so
+                                           scatter is slightly higher.
+biweight  20 ms     1164       0.92        Tukey biweight. Close to the
+                                           median's scatter with less
+                                           loss of depth, but slowest.
+========  ========  =========  ==========  ================================
+
+"rms" is the scatter of the detrended flux out of transit, and "depth
+kept" is the fraction of the injected depth that remains. Run
+``python -m corazon.detrend`` to reproduce the table on this machine.
+"""
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter
+
+import numpy as np
+
+from corazon import rolling
+
+#Name -> function(time, flux, window) returning the trend
+DETRENDERS = dict()
+
+#Jumps in time longer than this (days) split a light curve into segments
+#that are detrended separately, see `detrend_segments`
+SEGMENT_GAP_DAYS = 0.5
+
+
+def register(name):
+    """Decorator adding a trend function to `DETRENDERS` under name"""
+    def wrapper(func):
+        DETRENDERS[name] = func
+        return func
+    return wrapper
+
+
+def get_detrender(name):
+    """Return the trend function registered under name"""
+    try:
+        return DETRENDERS[name]
+    except KeyError:
+        raise ValueError("Unknown detrender %s. Choose from %s" %
+                         (name, ", ".join(sorted(DETRENDERS))))
+
+
+def detrend(time, flux, window, gap=None, method="median", dtype=np.float64):
+    """Divide out the trend of a light curve.
+
+    Inputs
+    ---------
+    time, flux
+        (1d numpy arrays)
+    window
+        (int) Half width of the sliding window, in cadences
+    gap
+        (1d boolean numpy array) Optional. Points where gap is True are
+        not used to compute the trend. Their trend is interpolated in
+        time from the neighbouring good points.
+    method
+        (str) Name of a detrender in `DETRENDERS`
+    dtype
+        Type of the returned array
+
+    Returns
+    -----------
+    1d numpy array of ``flux/trend - 1``, the same length as flux.
+    """
+    func = get_detrender(method)
+    flux = np.asarray(flux)
+
+    if gap is None or not np.any(gap):
+        trend = func(time, flux, window)
+    else:
+        good = ~gap
+        trend = np.interp(time, time[good],
+                          func(time[good], flux[good], window))
+
+    filtered = np.zeros(len(flux), dtype=dtype)
+    filtered[:] = flux/trend - 1
+    return filtered
+
+
+@register("median")
+def median_trend(time, flux, window):
+    """Running median. The trend used by `planetSearch.median_detrend`."""
+    return rolling.clamped_median(flux, window)
+
+
+@register("box")
+def box_trend(time, flux, window):
+    """Running mean (box filter), computed with a cumulative sum."""
+    return rolling.clamped_running(rolling.running_mean, flux, window)
+
+
+@register("biweight")
+def biweight_trend(time, flux, window):
+    """Running Tukey biweight location, see `rolling.running_biweight`."""
+    return rolling.clamped_running(rolling.running_biweight, flux, window)
+
+
+def segment_bounds(time, min_gap=SEGMENT_GAP_DAYS):
+    """Indices where the contiguous segments of a light curve start and end.
+
+    A segment ends wherever the time to the next cadence is more than
+    min_gap days, e.g. at orbit gaps and between sectors.
+
+    Returns
+    -----------
+    1d int numpy array of bounds, so segment i is ``bounds[i]:bounds[i+1]``.
+    """
+    time = np.asarray(time)
+    cuts = np.flatnonzero(np.diff(time) > min_gap) + 1
+    return np.concatenate([[0], cuts, [len(time)]]).astype(int)
+
+
+def detrend_segments(time, flux, window, gap=None, method="median",
+                     min_gap=SEGMENT_GAP_DAYS, workers=1, dtype=np.float64):
+    """`detrend` each contiguous segment of a light curve on its own.
+
+    Windows never reach across a gap in time longer than min_gap days, so
+    the ramps and offsets either side of orbit and sector gaps are not
+    mixed. Segments are views of the inputs, and with workers > 1 they
+    are detrended on a thread pool.
+
+    time must be sorted. Returns ``flux/trend - 1`` in the input order.
+    """
+    time = np.asarray(time)
+    flux = np.asarray(flux)
+    if np.any(np.diff(time) < 0):
+        raise ValueError("Segmented detrending needs time sorted")
+
+    bounds = segment_bounds(time, min_gap)
+
+    def run(i):
+        lwr, upr = bounds[i], bounds[i+1]
+        sgap = None if gap is None else gap[lwr:upr]
+        return detrend(time[lwr:upr], flux[lwr:upr], window, gap=sgap,
+                       method=method, dtype=dtype)
+
+    out = np.zeros(len(flux), dtype=dtype)
+    for i, det in enumerate(_ordered_map(run, range(len(bounds) - 1),
+                                         workers)):
+        out[bounds[i]:bounds[i+1]] = det
+    return out
+
+
+def stream_segments(chunks, min_gap=SEGMENT_GAP_DAYS):
+    """Regroup a stream of light curve pieces into contiguous segments.
+
+    Inputs
+    ---------
+    chunks
+        Iterable of (time, flux) pairs of arrays, in time order, e.g. one
+        per sector or per block read from a file. They can be cut anywhere.
+    min_gap
+        (float) Jump in time, in days, that ends a segment
+
+    Yields
+    -----------
+    (time, flux) for each segment. Only the current segment is buffered.
+    """
+    pending = []
+    last = None
+
+    def flush():
+        time = np.concatenate([p[0] for p in pending])
+        flux = np.concatenate([p[1] for p in pending])
+        del pending[:]
+        return time, flux
+
+    for time, flux in chunks:
+        time = np.asarray(time)
+        flux = np.asarray(flux)
+        if len(time) == 0:
+            continue
+
+        if last is not None and time[0] - last > min_gap:
+            yield flush()
+        bounds = segment_bounds(time, min_gap)
+        for lwr, upr in zip(bounds[:-1], bounds[1:]):
+            if lwr > 0:
+                yield flush()
+            pending.append((time[lwr:upr], flux[lwr:upr]))
+        last = time[-1]
+
+    if pending:
+        yield flush()
+
+
+def stream_detrend(chunks, window, method="median", min_gap=SEGMENT_GAP_DAYS,
+                   workers=1):
+    """Detrend a stream of light curve pieces one segment at a time.
+
+    The pieces are regrouped with `stream_segments` and each segment is
+    detrended on its own. At most workers segments are in flight, so
+    memory is bounded by a few segments, not the whole light curve.
+
+    Yields
+    -----------
+    (time, detrended flux) for each segment, in time order.
+    """
+    def run(segment):
+        time, flux = segment
+        return time, detrend(time, flux, window, method=method)
+
+    for result in _ordered_map(run, stream_segments(chunks, min_gap), workers):
+        yield result
+
+
+def _ordered_map(func, items, workers):
+    """map(func, items), on up to workers threads, in the order of items.
+
+    Only workers items are submitted ahead of the one being returned, so
+    a long generator is never read all at once.
+    """
+    if workers <= 1:
+        for item in items:
+            yield func(item)
+        return
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        queue = deque()
+        for item in items:
+            queue.append(pool.submit(func, item))
+            if len(queue) >= workers:
+                yield queue.popleft().result()
+        while queue:
+            yield queue.popleft().result()
+
+
+def benchmark(methods=None, window=65, n_lc=5, seed=0):
+    """Compare the speed and accuracy of the detrenders.
+
+    Each light curve is 27 days at the 30 minute FFI cadence. It has a 10
+    day, 0.5% sinusoid, 1000 ppm white noise and a 4 hour, 1000 ppm box
+    transit every 3.1 days. Every method sees the same light curves.
+
+    Returns
+    -----------
+    dict of name -> dict with "seconds" (mean time per light curve),
+    "rms_ppm" (out of transit scatter) and "depth_kept" (recovered over
+    injected depth).
+    """
+    if methods is None:
+        methods = sorted(DETRENDERS)
+
+    rng = np.random.default_rng(seed)
+    time = np.arange(1325, 1352, 1/48.)
+    depth = 1e-3
+    intransit = np.abs((time - 1326 + 1.55) % 3.1 - 1.55) < 2/24.
+
+    lcs = []
+    for i in range(n_lc):
+        phase = rng.uniform(0, 2*np.pi)
+        flux = 1 + 5e-3 * np.sin(2*np.pi * time / 10. + phase)
+        flux += 1e-3 * rng.standard_normal(len(time))
+        lcs.append(flux)
+
+    results = dict()
+    for name in methods:
+        seconds = 0
+        rms = []
+        kept = []
+        for flux in lcs:
+            transit = flux.copy()
+            transit[intransit] -= depth
+            start = perf_counter()
+            det = detrend(time, transit, window, method=name)
+            seconds += perf_counter() - start
+            rms.append(np.std(det[~intransit]))
+            #Compare with the same data without the transit, so the noise
+            #cancels out of the depth
+            clean = detrend(time, flux, window, method=name)
+            kept.append(np.mean(clean[intransit] - det[intransit]) / depth)
+        results[name] = dict(seconds=seconds / n_lc,
+                             rms_ppm=1e6 * np.mean(rms),
+                             depth_kept=np.mean(kept))
+    return results
+
+
+if __name__ == "__main__":
+    print("%-10s %10s %10s %10s" % ("name", "seconds", "rms_ppm",
+                                     "depth_kept"))
+    for name, row in benchmark(n_lc=20, seed=1).items():
+        print("%-10s %10.4f %10.1f %10.3f" % (name, row["seconds"],
+                                              row["rms_ppm"],
+                                              row["depth_kept"]))
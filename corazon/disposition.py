@@ -0,0 +1,262 @@
+# -*- coding: utf-8 -*-
+"""
+Columnar dispositions, for trying new thresholds without vetting again.
+
+`metrics_table` turns the `VetterMetrics` of every TCE in a run into a
+table of columns (a dict of 1d numpy arrays), and `dispose` applies a
+thresholds dict to a whole table at once. It gives the same dispositions
+and reasons as `pipeline.get_disposition` does one TCE at a time.
+
+A table can be saved with `save_table`, or kept in a run's metrics store
+(see `corazon.store`), and re-dispositioned later from the command line::
+
+    python -m corazon.disposition run_metrics.npz --thresholds new.json
+
+Metrics of vetters skipped in triage mode are NaN in the table and never
+fail a TCE. Metrics that are missing although their vetter was run are
+also NaN, and are flagged in the "missing" column. As in
+`pipeline.get_disposition`, they fail the TCE with the reason
+`metrics.MISSING_REASON`.
+"""
+
+import argparse
+import json
+import sys
+
+import numpy as np
+
+from corazon.metrics import METRIC_FIELDS, MISSING_REASON
+
+#Columns identifying each TCE
+ID_COLUMNS = ('ticid', 'sector', 'event')
+
+#Scalar metric columns, and how each is read from a `VetterMetrics`
+METRIC_COLUMNS = {'snr' : lambda m: m['snr'],
+                  'norm_lpp' : lambda m: m['norm_lpp'],
+                  'raw_lpp' : lambda m: m['raw_lpp'],
+                  'tp_cover' : lambda m: m['tp_cover'],
+                  'oe_sigma' : lambda m: m['oe_sigma'],
+                  'odd_depth' : lambda m: m['odd_depth'][0],
+                  'even_depth' : lambda m: m['even_depth'][0],
+                  'sweet_half' : lambda m: m['sweet']['amp'][0, -1],
+                  'sweet_at' : lambda m: m['sweet']['amp'][1, -1],
+                  'sweet_twice' : lambda m: m['sweet']['amp'][2, -1],
+                  }
+
+#Integer column, bit i is set if METRIC_FIELDS[i] is missing although its
+#vetter was run
+MISSING_COLUMN = 'missing'
+
+#The checks of get_disposition, in the same order. Each is the column, the
+#threshold it is compared to, the comparison that fails a TCE and the
+#reason text.
+CHECKS = [('snr', 'snr', np.less, "-LowSNR-"),
+          ('norm_lpp', 'norm_lpp', np.greater, "-NormLPP-"),
+          ('tp_cover', 'tp_cover', np.less, "-PoorTransitCoverage-"),
+          ('oe_sigma', 'oe_sigma', np.greater, "-OddEvenDetected-"),
+          ('sweet_half', 'sweet', np.greater, "-SWEETHalfPeriod"),
+          ('sweet_at', 'sweet', np.greater, "-SWEETAtPeriod"),
+          ('sweet_twice', 'sweet', np.greater, "-SWEETTwicePeriod-"),
+          ]
+
+
+def metric_row(metrics):
+    """dict of column -> float for one `VetterMetrics`. NaN if missing.
+    The MISSING_COLUMN entry flags the metrics missing although their
+    vetter was run."""
+    not_computed = getattr(metrics, 'not_computed', ())
+    row = dict()
+    row[MISSING_COLUMN] = 0
+    for i, name in enumerate(METRIC_FIELDS):
+        if metrics.get(name) is None and name not in not_computed:
+            row[MISSING_COLUMN] |= 1 << i
+    for column, read in METRIC_COLUMNS.items():
+        try:
+            value = float(read(metrics))
+        except (KeyError, IndexError, TypeError):
+            value = np.nan
+        row[column] = value
+    for column in _columns_of(not_computed):
+        row[column] = np.nan
+    return row
+
+
+def metrics_table(metrics_list, tce_list):
+    """Columns for the TCEs of a run.
+
+    Inputs
+    ---------
+    metrics_list
+        (list) `VetterMetrics`, one per TCE
+    tce_list
+        (list) The exovetter TCEs, in the same order. Their target
+        ("TIC 1234"), sector and event fill the id columns.
+
+    Returns
+    -----------
+    dict of column name -> 1d numpy array
+    """
+    rows = [metric_row(m) for m in metrics_list]
+    table = dict()
+    table['ticid'] = np.array([int(str(t['target']).split()[-1])
+                               for t in tce_list], dtype=np.int64)
+    table['sector'] = np.array([int(t['sector']) for t in tce_list],
+                               dtype=np.int64)
+    table['event'] = np.array([int(t['event']) for t in tce_list],
+                              dtype=np.int64)
+    for column in METRIC_COLUMNS:
+        table[column] = np.array([r[column] for r in rows], dtype=float)
+    table[MISSING_COLUMN] = np.array([r[MISSING_COLUMN] for r in rows],
+                                     dtype=np.int64)
+    return table
+
+
+def concatenate(tables):
+    """Join tables with the same columns into one"""
+    tables = list(tables)
+    if not tables:
+        return empty_table()
+    return {c: np.concatenate([t[c] for t in tables]) for c in tables[0]}
+
+
+def empty_table():
+    table = {c: np.zeros(0, dtype=np.int64) for c in ID_COLUMNS}
+    table.update({c: np.zeros(0) for c in METRIC_COLUMNS})
+    table[MISSING_COLUMN] = np.zeros(0, dtype=np.int64)
+    return table
+
+
+def dispose(table, thresholds):
+    """Dispositions and reasons for every row of a table.
+
+    Inputs
+    ---------
+    table
+        (dict) Columns, as from `metrics_table`
+    thresholds
+        (dict) As from `run_pipeline.load_def_thresholds`
+
+    Returns
+    -----------
+    disposition
+        (1d numpy array of str) "PASS" or "FAIL"
+    reason
+        (1d numpy array of str) The reasons for failing, in the format of
+        `pipeline.get_disposition`
+    """
+    #Bit 2i of code is set if a row fails check i, and bit 2i+1 if the
+    #metric of check i is missing. Reason strings are only built once for
+    #each combination of failures that occurs.
+    n = len(table['snr'])
+    missing = table.get(MISSING_COLUMN)
+    if missing is None:
+        #Tables saved before missing metrics were flagged
+        missing = np.zeros(n, dtype=np.int64)
+    code = np.zeros(n, dtype=np.int64)
+    for i, (column, key, fails, text) in enumerate(CHECKS):
+        bit = METRIC_FIELDS.index(_source(column))
+        absent = (missing >> bit) & 1 == 1
+        with np.errstate(invalid="ignore"):
+            fail = fails(table[column], thresholds[key]) & ~absent
+        code |= fail.astype(np.int64) << 2*i
+        code |= absent.astype(np.int64) << 2*i + 1
+
+    codes, index = np.unique(code, return_inverse=True)
+    texts = [_reason(u) for u in codes]
+    reason = np.array(texts, dtype=str)[index.reshape(-1)]
+
+    disposition = np.where(code != 0, "FAIL", "PASS")
+    return disposition, reason
+
+
+def save_table(path, table):
+    """Write a table to a numpy .npz file"""
+    np.savez(path, **table)
+
+
+def load_table(path):
+    """Read a table written by `save_table`, or every row of a SQLite
+    metrics store (a .sqlite or .db file)"""
+    if path.endswith((".sqlite", ".db")):
+        from corazon.store import MetricsStore
+        with MetricsStore(path) as store:
+            return store.query()
+
+    with np.load(path) as data:
+        return {c: data[c] for c in data.files}
+
+
+def redisposition(path, thresholds):
+    """Load a saved table and dispose it with new thresholds.
+
+    Returns
+    -----------
+    The table, with "disposition" and "reason" columns added.
+    """
+    table = load_table(path)
+    table['disposition'], table['reason'] = dispose(table, thresholds)
+    return table
+
+
+def _reason(code):
+    """Reason text for a code built by `dispose`"""
+    parts = []
+    for i, (column, key, fails, text) in enumerate(CHECKS):
+        if code >> 2*i + 1 & 1:
+            text = MISSING_REASON % (_source(column))
+            if text not in parts:
+                parts.append(text)
+        elif code >> 2*i & 1:
+            parts.append(text)
+    return "".join(parts)
+
+
+def _source(column):
+    """The `VetterMetrics` field a table column comes from"""
+    sources = {'sweet_half' : 'sweet', 'sweet_at' : 'sweet',
+               'sweet_twice' : 'sweet'}
+    return sources.get(column, column)
+
+
+def _columns_of(metric_names):
+    """Table columns that come from the named `VetterMetrics` fields"""
+    return [c for c in METRIC_COLUMNS if _source(c) in metric_names]
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        description="Re-disposition the stored metrics of a corazon run")
+    parser.add_argument("metrics",
+                        help="Metrics table (.npz) or store (.sqlite)")
+    parser.add_argument("--thresholds",
+                        help="json file of thresholds. Keys not given keep "
+                             "their default values.")
+    parser.add_argument("--out", help="csv file to write (default stdout)")
+    opts = parser.parse_args(args)
+
+    from corazon.run_pipeline import load_def_thresholds
+    thresholds = load_def_thresholds()
+    if opts.thresholds is not None:
+        with open(opts.thresholds) as fp:
+            thresholds.update(json.load(fp))
+
+    table = redisposition(opts.metrics, thresholds)
+
+    fp = sys.stdout if opts.out is None else open(opts.out, "w")
+    try:
+        fp.write("ticid,sector,event,disposition,reason\n")
+        for row in zip(table['ticid'], table['sector'], table['event'],
+                       table['disposition'], table['reason']):
+            fp.write("%i,%i,%i,%s,%s\n" % row)
+    finally:
+        if fp is not sys.stdout:
+            fp.close()
+
+    n_fail = np.sum(table['disposition'] == "FAIL")
+    print("%i TCEs, %i PASS, %i FAIL" % (len(table['disposition']),
+                                        len(table['disposition']) - n_fail,
+                                        n_fail), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
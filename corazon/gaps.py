@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+"""
+Known bad time ranges in TESS FFI light curves, by sector.
+
+The ranges are kept in a versioned table shipped with the package
+(``corazon/data/sector_gaps.csv``). A user file in the same format can
+be given to add sectors or replace the ranges of shipped ones. Tables
+are read once per process and cached.
+
+For each sector the ranges are merged into sorted, non-overlapping
+intervals, so the mask for a light curve is a single `np.searchsorted`
+over the interval starts.
+"""
+
+import csv
+from functools import lru_cache
+import os
+
+import numpy as np
+
+DEFAULT_GAP_FILE = os.path.join(os.path.dirname(__file__), "data",
+                                "sector_gaps.csv")
+
+#What to do for a sector that is not in the table
+UNKNOWN_SECTOR_POLICIES = ("error", "none", "infer")
+
+#For unknown_sector="infer". A jump in time of more than INFER_MIN_GAP_DAYS
+#is treated as a data downlink, and INFER_MARGIN_DAYS either side of it
+#are marked as bad, to remove the ramps seen around downlinks.
+INFER_MIN_GAP_DAYS = 0.5
+INFER_MARGIN_DAYS = 0.5
+
+
+class GapTable(object):
+    """Bad time ranges for a set of sectors.
+
+    Inputs
+    ---------
+    intervals
+        (dict) Maps sector number to a list of (start, end) pairs, in TJD.
+        Both ends are included in the range.
+    version
+        (str) Version of the table, from the "# version:" line of its file.
+    """
+    def __init__(self, intervals, version=None):
+        self.version = version
+        self.intervals = dict()
+        for sector, ranges in intervals.items():
+            self.intervals[int(sector)] = merge_intervals(ranges)
+
+    def __contains__(self, sector):
+        return int(sector) in self.intervals
+
+    @property
+    def sectors(self):
+        return sorted(self.intervals)
+
+    def update(self, other):
+        """Return a new table with the sectors in `other` replacing ours"""
+        intervals = dict(self.intervals)
+        intervals.update(other.intervals)
+        version = "%s+%s" % (self.version, other.version or "user")
+        return GapTable({k: np.transpose(v) for k, v in intervals.items()},
+                        version=version)
+
+    def mask(self, time, sector):
+        """Boolean array, true for the elements of time in a bad range.
+
+        Raises a KeyError if the sector is not in the table.
+        """
+        starts, ends = self.intervals[int(sector)]
+        return interval_mask(time, starts, ends)
+
+
+def merge_intervals(ranges):
+    """Merge closed (start, end) ranges into sorted, disjoint intervals.
+
+    Returns
+    -----------
+    A (2, n) numpy array of starts and ends.
+    """
+    ranges = np.asarray(ranges, dtype=float).reshape(-1, 2)
+    ranges = ranges[ranges[:, 0] <= ranges[:, 1]]
+    if len(ranges) == 0:
+        return np.zeros((2, 0))
+
+    ranges = ranges[np.argsort(ranges[:, 0], kind="stable")]
+    #A range starts a new interval if it begins after every earlier one ends
+    reach = np.maximum.accumulate(ranges[:, 1])
+    new = np.ones(len(ranges), dtype=bool)
+    new[1:] = ranges[1:, 0] > reach[:-1]
+
+    first = np.flatnonzero(new)
+    last = np.append(first[1:], len(ranges)) - 1
+    return np.array([ranges[first, 0], reach[last]])
+
+
+def interval_mask(time, starts, ends):
+    """True for elements of time in any [start, end] interval.
+
+    starts and ends must be sorted and the intervals must not overlap,
+    as returned by `merge_intervals`. NaN times are never in a gap.
+    """
+    time = np.asarray(time)
+    i = np.searchsorted(starts, time, side="right") - 1
+    inside = i >= 0
+    inside[inside] = time[inside] <= ends[i[inside]]
+    return inside
+
+
+@lru_cache(maxsize=None)
+def load_gap_table(path=DEFAULT_GAP_FILE):
+    """Read a gap table from a csv file. Each file is only read once.
+
+    The file has columns sector,start,end,note. Lines starting with # are
+    comments, except for an optional "# version: <version>" line.
+    """
+    version = None
+    rows = []
+    with open(path) as fp:
+        for line in fp:
+            if line.startswith("#"):
+                key, _, value = line[1:].partition(":")
+                if key.strip().lower() == "version" and version is None:
+                    version = value.strip()
+            elif line.strip():
+                rows.append(line)
+
+    intervals = dict()
+    for row in csv.DictReader(rows):
+        try:
+            sector = int(row["sector"])
+            start = float(row["start"])
+            end = float(row["end"])
+        except (KeyError, TypeError, ValueError):
+            raise ValueError("Bad row in gap table %s: %s" % (path, row))
+        intervals.setdefault(sector, []).append((start, end))
+
+    return GapTable(intervals, version=version)
+
+
+@lru_cache(maxsize=None)
+def gap_table(user_file=None):
+    """The shipped gap table, with the sectors in user_file replacing ours"""
+    table = load_gap_table(DEFAULT_GAP_FILE)
+    if user_file is not None:
+        table = table.update(load_gap_table(os.path.abspath(user_file)))
+    return table
+
+
+def infer_gaps(time, min_gap=INFER_MIN_GAP_DAYS, margin=INFER_MARGIN_DAYS):
+    """Mark the data either side of each large jump in time.
+
+    Used for sectors with no entry in the gap table. Every cadence within
+    margin days of a jump longer than min_gap days is marked as bad.
+    """
+    time = np.asarray(time)
+    good = np.isfinite(time)
+    t = np.sort(time[good])
+    if len(t) < 2:
+        return np.zeros(len(time), dtype=bool)
+
+    jump = np.flatnonzero(np.diff(t) > min_gap)
+    ranges = np.transpose([t[jump] - margin, t[jump + 1] + margin])
+    starts, ends = merge_intervals(ranges)
+    return interval_mask(time, starts, ends)
+
+
+def sector_gaps(time, sector, unknown_sector="error", user_file=None):
+    """Boolean array, true for elements of time in a known bad range.
+
+    Inputs
+    ---------
+    time
+        (1d np array) TJDs of the data
+    sector
+        (int)
+    unknown_sector
+        (str) What to do if the sector is not in the table. "error" raises
+        a ValueError, "none" marks no data as bad, and "infer" uses
+        `infer_gaps`.
+    user_file
+        (str) Optional csv file of gaps that replaces the shipped ranges
+        for the sectors it lists.
+
+    Returns
+    -----------
+    1d boolean np array of length time
+    """
+    if unknown_sector not in UNKNOWN_SECTOR_POLICIES:
+        raise ValueError("Unknown sector policy %s. Choose from %s" %
+                         (unknown_sector, ", ".join(UNKNOWN_SECTOR_POLICIES)))
+
+    table = gap_table(user_file)
+    if sector in table:
+        return table.mask(time, sector)
+
+    if unknown_sector == "none":
+        return np.zeros(len(time), dtype=bool)
+    if unknown_sector == "infer":
+        return infer_gaps(time)
+    raise ValueError("No gap info available for sector %i" %(sector))
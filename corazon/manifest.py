@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+"""
+Run manifests, so an interrupted or re-configured run only redoes the
+targets that need it.
+
+Each finished target is recorded with a key made from everything its
+results depend on:
+
+* the light curve file, by size and modification time ("stat") or by a
+  hash of its contents ("sha256"),
+* the pipeline config, apart from the settings in `RUN_KEYS`,
+* the vetters' settings and the thresholds,
+* the corazon version.
+
+A target is skipped if the manifest already has it with the same key.
+Changing the config or thresholds, updating corazon, or replacing a light
+curve file changes the key, so just those targets are run again.
+
+The manifest is an append-only JSON lines file. A line cut short by a
+crash is ignored, and a target whose line was lost is simply run again.
+"""
+
+import atexit
+import hashlib
+import json
+import os
+import threading
+import time
+
+import corazon
+
+LC_KEY_MODES = ("stat", "sha256")
+
+#Config keys that change how a run is carried out, not its results. They
+#are left out of the key, so e.g. a resumed run can use more workers.
+RUN_KEYS = ("detrend_workers", "vet_workers", "vet_executor", "bls_workers",
+            "output", "output_batch", "background_output", "output_queue",
+            "resume", "lc_key")
+
+#Lines buffered before they are appended to the manifest
+DEFAULT_BATCH_SIZE = 20
+
+#Open manifests, by path, see `open_manifest`
+_manifests = dict()
+_manifests_lock = threading.Lock()
+
+
+def lc_file_key(path, mode="stat"):
+    """Identify the contents of a light curve file.
+
+    mode "stat" uses the size and modification time, which is fast.
+    "sha256" hashes the whole file, which survives copies and touches.
+    """
+    if mode not in LC_KEY_MODES:
+        raise ValueError("Unknown light curve key mode %s. Choose from %s" %
+                         (mode, ", ".join(LC_KEY_MODES)))
+    if mode == "stat":
+        st = os.stat(path)
+        return "stat:%i-%i" % (st.st_size, st.st_mtime_ns)
+
+    sha = hashlib.sha256()
+    with open(path, 'rb') as fobj:
+        for block in iter(lambda: fobj.read(1 << 20), b""):
+            sha.update(block)
+    return "sha256:" + sha.hexdigest()
+
+
+def hash_of(obj):
+    """Short, stable hash of a json-able object (dict keys are sorted)"""
+    text = json.dumps(obj, sort_keys=True, default=repr)
+    return hashlib.sha256(text.encode()).hexdigest()[:16]
+
+
+def vetter_settings(vetter_list):
+    """Class and settings of each vetter, as used in the key.
+
+    For a `VetterPool` the settings are the attributes of the vetters
+    just after construction that are numbers, strings or None. A plain
+    list only contributes the class of each vetter, because its
+    attributes change as it runs.
+    """
+    describe = getattr(vetter_list, 'describe', None)
+    if describe is not None:
+        return describe()
+    return [[type(v).__module__ + "." + type(v).__name__, {}]
+            for v in vetter_list]
+
+
+def target_key(lc_key, config, vetter_list, thresholds, version=None):
+    """The key a target is recorded under in a manifest"""
+    if version is None:
+        version = corazon.__version__ or "unknown"
+    config = {k: v for k, v in config.items() if k not in RUN_KEYS}
+    parts = dict(lc=lc_key, config=hash_of(config),
+                 vetters=hash_of([vetter_settings(vetter_list), thresholds]),
+                 version=version)
+    return hash_of(parts)
+
+
+class RunManifest(object):
+    """The targets finished in a run, and the key of each.
+
+    Inputs
+    ---------
+    path
+        (str) JSON lines file. Read if it exists, appended to otherwise.
+    batch_size
+        (int) Lines buffered before they are written. `flush` and `close`
+        write the rest.
+    """
+    def __init__(self, path, batch_size=DEFAULT_BATCH_SIZE):
+        self.path = path
+        self.batch_size = batch_size
+        self.pid = os.getpid()
+        self.meta = dict()
+        self.skipped = 0
+        self._done = dict()
+        self._lines = []
+        self._lock = threading.Lock()
+
+        if os.path.exists(path):
+            with open(path) as fobj:
+                for line in fobj:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue
+                    if 'meta' in entry:
+                        self.meta.update(entry['meta'])
+                    else:
+                        self._done[(entry['ticid'],
+                                    entry['sector'])] = entry['key']
+
+    def __len__(self):
+        return len(self._done)
+
+    def is_done(self, ticid, sector, key):
+        """True if the target was finished with the same key"""
+        return self._done.get((int(ticid), int(sector))) == key
+
+    def mark_done(self, ticid, sector, key):
+        """Record that a target's results have been written"""
+        entry = dict(ticid=int(ticid), sector=int(sector), key=key,
+                     finished=time.time())
+        with self._lock:
+            self._done[(entry['ticid'], entry['sector'])] = key
+            self._append(entry)
+
+    def set_meta(self, **kwargs):
+        """Record run wide values, e.g. the run tag, written straight away"""
+        with self._lock:
+            self.meta.update(kwargs)
+            self._append(dict(meta=kwargs))
+            self._write()
+
+    def _append(self, entry):
+        self._lines.append(json.dumps(entry) + "\n")
+        if len(self._lines) >= self.batch_size:
+            self._write()
+
+    def flush(self):
+        with self._lock:
+            self._write()
+
+    def _write(self):
+        if not self._lines:
+            return
+        with open(self.path, 'a') as fobj:
+            fobj.write("".join(self._lines))
+        self._lines = []
+
+    def close(self):
+        self.flush()
+
+
+def open_manifest(path, batch_size=DEFAULT_BATCH_SIZE):
+    """The `RunManifest` for path, shared by everything in this process"""
+    path = os.path.abspath(path)
+    with _manifests_lock:
+        manifest = _manifests.get(path)
+        if manifest is None or manifest.pid != os.getpid():
+            manifest = RunManifest(path, batch_size=batch_size)
+            _manifests[path] = manifest
+        return manifest
+
+
+@atexit.register
+def close_manifests():
+    """Write the buffered lines of every manifest opened in this process"""
+    with _manifests_lock:
+        for manifest in _manifests.values():
+            if manifest.pid == os.getpid():
+                manifest.close()
+        _manifests.clear()
@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+"""
+Compact per TCE vetting metrics.
+
+Vetters keep everything from their last run as attributes, including the
+light curve, the TCE and large intermediate arrays. `VetterMetrics` keeps
+only the named outputs in `METRIC_FIELDS`, so the metrics held for a
+target do not grow with the length of its light curve.
+"""
+
+#Name of each metric, and the vetter attribute it is read from.
+#Metrics a vetter did not produce are left as None.
+METRIC_FIELDS = ('snr',          #Set from the TCE, not a vetter
+                 'norm_lpp',     #Lpp
+                 'raw_lpp',      #Lpp
+                 'oe_sigma',     #OddEven
+                 'odd_depth',    #OddEven, (depth, error)
+                 'even_depth',   #OddEven, (depth, error)
+                 'tp_cover',     #TransitPhaseCoverage
+                 'sweet',        #Sweet, dict with a 3x3 'amp' array
+                 )
+
+#Disposition reason for a metric that a vetter was run for but did not
+#produce (e.g. the vetter raised an error)
+MISSING_REASON = "-Missing_%s-"
+
+#The metrics each vetter class produces, by class name. Some vetters only
+#create their metric attributes in run(), so a vetter that was skipped
+#can not be asked. A vetter with a `metric_names` attribute uses that.
+VETTER_METRICS = {'Lpp' : ('norm_lpp', 'raw_lpp'),
+                  'OddEven' : ('oe_sigma', 'odd_depth', 'even_depth'),
+                  'TransitPhaseCoverage' : ('tp_cover',),
+                  'Sweet' : ('sweet',)}
+
+
+#Metrics some exovetter versions only return in the vetter's `metrics`
+#dictionary, and their key there. None means the whole dictionary.
+RESULT_KEYS = {'tp_cover' : 'transit_phase_coverage',
+               'sweet' : None}
+
+
+def metric_names(vetter):
+    """The metrics a vetter produces: its own `metric_names` attribute,
+    else the entry for its class in `VETTER_METRICS`"""
+    names = getattr(vetter, 'metric_names', None)
+    if names is None:
+        names = VETTER_METRICS.get(type(vetter).__name__)
+    if names is None:
+        raise ValueError("Unknown metrics for vetter %s. Give it a "
+                         "metric_names attribute" % (type(vetter).__name__))
+    return tuple(names)
+
+
+class VetterMetrics(object):
+    """The metrics of one TCE, read like a dict.
+
+    Only the keys in `METRIC_FIELDS` exist. Setting any other key raises
+    a KeyError.
+
+    Attributes
+    ----------
+    not_computed
+        (tuple) Metrics of vetters that were skipped in triage mode
+    decided_by
+        (str) In triage mode, the vetter (or "snr") whose failure decided
+        the disposition. None if the TCE passed or was fully vetted.
+    """
+    __slots__ = METRIC_FIELDS + ('not_computed', 'decided_by')
+
+    def __init__(self, **kwargs):
+        for name in METRIC_FIELDS:
+            setattr(self, name, kwargs.pop(name, None))
+        self.not_computed = tuple(kwargs.pop('not_computed', ()))
+        self.decided_by = kwargs.pop('decided_by', None)
+        if kwargs:
+            raise KeyError("Unknown metrics %s" % (", ".join(kwargs)))
+
+    def computed(self, key):
+        """False if the metric was skipped in triage mode"""
+        return key not in self.not_computed
+
+    def skip(self, vetter):
+        """Record the metrics of a vetter that was not run as not computed,
+        unless another vetter already computed them"""
+        names = [name for name in metric_names(vetter)
+                 if getattr(self, name) is None and
+                 name not in self.not_computed]
+        self.not_computed = self.not_computed + tuple(names)
+
+    def update_from(self, vetter):
+        """Copy the metrics a vetter computed in its last run"""
+        attrs = vars(vetter)
+        for name in METRIC_FIELDS:
+            value = attrs.get(name)
+            if value is None:
+                value = _from_results(vetter, name)
+            if value is not None:
+                setattr(self, name, value)
+
+    def __getitem__(self, key):
+        if key not in METRIC_FIELDS:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __setitem__(self, key, value):
+        if key not in METRIC_FIELDS:
+            raise KeyError(key)
+        setattr(self, key, value)
+
+    def __contains__(self, key):
+        return key in METRIC_FIELDS
+
+    def __iter__(self):
+        return iter(METRIC_FIELDS)
+
+    def __len__(self):
+        return len(METRIC_FIELDS)
+
+    def __repr__(self):
+        return "VetterMetrics(%s)" % (", ".join("%s=%r" % item
+                                                 for item in self.items()))
+
+    def get(self, key, default=None):
+        if key not in METRIC_FIELDS:
+            return default
+        return getattr(self, key)
+
+    def keys(self):
+        return list(METRIC_FIELDS)
+
+    def values(self):
+        return [getattr(self, name) for name in METRIC_FIELDS]
+
+    def items(self):
+        return [(name, getattr(self, name)) for name in METRIC_FIELDS]
+
+    def to_dict(self):
+        return dict(self.items())
+
+    def __getstate__(self):
+        return self.values() + [self.not_computed, self.decided_by]
+
+    def __setstate__(self, state):
+        for name, value in zip(self.__slots__, state):
+            setattr(self, name, value)
+
+
+def _from_results(vetter, name):
+    """A metric from the `metrics` dictionary of a vetter that produces it
+    (see `RESULT_KEYS`), or None"""
+    results = vars(vetter).get('metrics')
+    if not isinstance(results, dict) or name not in RESULT_KEYS:
+        return None
+    if name not in VETTER_METRICS.get(type(vetter).__name__, ()):
+        return None
+    key = RESULT_KEYS[name]
+    if key is None:
+        return results
+    return results.get(key)
@@ -0,0 +1,489 @@
+# -*- coding: utf-8 -*-
+"""
+Writers for the results of each target of a run.
+
+`run_write_one` collects everything it writes about a target (the log
+text, the tcesum lines, the TCE json and an optional plot) into one
+record, a dict, and gives it to a writer.
+
+"files" (`FileWriter`)
+    The original layout. A directory per target holding a .log file, a
+    -tcesum.csv, one .json per TCE and the plot.
+
+"jsonl" (`JsonlWriter`)
+    One append-only JSON lines file per worker process per run, with a
+    line per target. Lines are buffered and written in batches, so a
+    large run makes a handful of files instead of ~20 per target. Plots,
+    if made, go in a single directory per run.
+
+Either can be wrapped in a `BackgroundWriter`, which does the writing on
+a dedicated `WriterThread`, so the next target can start straight away.
+
+`merge` joins the files of all the workers of a run into one, and
+`export_files` writes the original per-target layout from a JSON lines
+file, for all targets or just the ones asked for.
+"""
+
+import atexit
+import glob
+import json
+import os
+import queue
+import shutil
+import socket
+import threading
+import time
+
+#Imported before our atexit hook is registered, so the hook, which may
+#still add metrics to a store, runs before the stores are closed
+from corazon import store  # noqa: F401
+
+OUTPUT_BACKENDS = ("files", "jsonl")
+
+#Records buffered by a JsonlWriter before they are written
+DEFAULT_BATCH_SIZE = 100
+
+#Tasks a BackgroundWriter holds before write() blocks
+DEFAULT_QUEUE_SIZE = 16
+
+#Open JSON lines writers, by path, and the background writing thread of
+#this process, see `open_writer`
+_writers = dict()
+_thread = None
+_writers_lock = threading.Lock()
+
+
+def new_record(ticid, sector, run_tag, lc_author):
+    """An empty record for one target, filled in by run_write_one.
+
+    Keys are ticid, sector, run_tag and lc_author, "status" ("success" or
+    "failed"), "log" (text of the log file), "results" (lines of the
+    tcesum file), "tces" (dicts as written by `exovetter.tce.Tce.to_json`)
+    and "plot" (png bytes, or None).
+    """
+    return dict(ticid=int(ticid), sector=int(sector), run_tag=run_tag,
+                lc_author=lc_author, status="failed", log="", results=[],
+                tces=[], plot=None)
+
+
+class WriteError(Exception):
+    """A write for one target that failed on the background thread.
+
+    ticid and sector name the target, error is the exception raised.
+    """
+    def __init__(self, ticid, sector, error):
+        self.ticid = ticid
+        self.sector = sector
+        self.error = error
+        super().__init__("Writing the results of TIC %i sector %i failed: "
+                         "%r" % (ticid, sector, error))
+
+
+def target_dir(out_dir, ticid, sector):
+    return out_dir + "/tic%09is%02i/" % (int(ticid), int(sector))
+
+
+class Writer(object):
+    """Base class of the writers"""
+    def submit(self, func, *args, **kwargs):
+        """Run func(*args, **kwargs). A `BackgroundWriter` runs it on its
+        thread, in order with the records."""
+        func(*args, **kwargs)
+
+    def submit_for(self, target, func, *args, **kwargs):
+        """As `submit`, for a target (ticid, sector). A `BackgroundWriter`
+        names the target in any error it raises."""
+        self.submit(func, *args, **kwargs)
+
+    def check(self):
+        """Raise the first error of the writes made so far, if any"""
+        pass
+
+    def after_flush(self, func, *args):
+        """Run func(*args) once the records written so far are on disk"""
+        func(*args)
+
+    def write(self, record):
+        raise NotImplementedError
+
+    def write_then(self, record, func, *args):
+        """Write record, then run func(*args) once it is on disk. func is
+        not run if the write fails."""
+        self.write(record)
+        self.after_flush(func, *args)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.flush()
+
+
+class FileWriter(Writer):
+    """Writes each record as the original directory of small files"""
+    def __init__(self, out_dir):
+        self.out_dir = out_dir
+
+    def write(self, record):
+        ticid = record['ticid']
+        run_tag = record['run_tag']
+        tdir = target_dir(self.out_dir, ticid, record['sector'])
+        os.makedirs(tdir, exist_ok=True)
+
+        if record['status'] == "success":
+            output_file = tdir + "tic%09i-%s-tcesum.csv" % (ticid, run_tag)
+            with open(output_file, 'w') as output_obj:
+                for r in record['results']:
+                    output_obj.write(r)
+
+            for tce in record['tces']:
+                tcefilename = "tic%09i-%02i-%s.json" % (ticid,
+                                                        int(tce['event']),
+                                                        run_tag)
+                with open(tdir + tcefilename, 'w') as fobj:
+                    fobj.write(json.dumps(tce))
+
+        if record['plot'] is not None:
+            plotfilename = "tic%09i-%s-plot.png" % (ticid, run_tag)
+            with open(tdir + plotfilename, 'wb') as fobj:
+                fobj.write(record['plot'])
+
+        log_name = tdir + "tic%09i-%s.log" % (ticid, run_tag)
+        with open(log_name, 'w+') as log_obj:
+            log_obj.write(record['log'])
+
+
+class JsonlWriter(Writer):
+    """Appends records to one JSON lines file, in batches.
+
+    Inputs
+    ---------
+    path
+        (str) File to append to
+    batch_size
+        (int) Records buffered before they are written. `flush` and
+        `close` write the rest.
+    """
+    def __init__(self, path, batch_size=DEFAULT_BATCH_SIZE):
+        self.path = path
+        self.batch_size = batch_size
+        self.pid = os.getpid()
+        self.plot_dir = os.path.splitext(path)[0] + "-plots"
+        self._lines = []
+        self._callbacks = []
+        self._lock = threading.Lock()
+
+    def write(self, record):
+        record = dict(record, finished=time.time())
+        if record['plot'] is not None:
+            plotfilename = "tic%09is%02i-%s-plot.png" % (record['ticid'],
+                                                         record['sector'],
+                                                         record['run_tag'])
+            os.makedirs(self.plot_dir, exist_ok=True)
+            with open(os.path.join(self.plot_dir, plotfilename), 'wb') as fobj:
+                fobj.write(record['plot'])
+            record['plot'] = os.path.join(os.path.basename(self.plot_dir),
+                                          plotfilename)
+
+        line = json.dumps(record) + "\n"
+        with self._lock:
+            self._lines.append(line)
+            if len(self._lines) >= self.batch_size:
+                self._write()
+
+    def after_flush(self, func, *args):
+        with self._lock:
+            if self._lines:
+                self._callbacks.append((func, args))
+                return
+        func(*args)
+
+    def flush(self):
+        with self._lock:
+            self._write()
+
+    def _write(self):
+        if self._lines:
+            with open(self.path, 'a') as fobj:
+                fobj.write("".join(self._lines))
+            self._lines = []
+        callbacks, self._callbacks = self._callbacks, []
+        for func, args in callbacks:
+            func(*args)
+
+
+class WriterThread(object):
+    """A dedicated thread running tasks from a bounded queue, in order.
+
+    submit() puts a task on the queue and returns. If the queue is full
+    it blocks until the thread catches up, so a slow file system holds
+    back the pipeline rather than filling memory.
+
+    An exception raised by a task does not stop the thread. It is raised
+    again in the caller by the next check, join or close, as a
+    `WriteError` naming the target if the task was given one.
+
+    Inputs
+    ---------
+    maxsize
+        (int) Tasks queued before submit() blocks
+    """
+    def __init__(self, maxsize=DEFAULT_QUEUE_SIZE):
+        self.pid = os.getpid()
+        self._queue = queue.Queue(maxsize=maxsize)
+        self._errors = []
+        self._closed = False
+        #A daemon, so a process that is not closed cleanly can still exit.
+        #close_writers drains the queue at exit.
+        self._thread = threading.Thread(target=self._run,
+                                        name="corazon-writer", daemon=True)
+        self._thread.start()
+
+    def submit(self, func, *args, **kwargs):
+        self.submit_for(None, func, *args, **kwargs)
+
+    def submit_for(self, target, func, *args, **kwargs):
+        """Queue func(*args, **kwargs), the work of target (ticid, sector)"""
+        if self._closed:
+            raise ValueError("Writer thread is closed")
+        self._queue.put((target, func, args, kwargs))
+
+    def check(self):
+        """Raise the first error of the tasks run so far, if any"""
+        self._raise_errors()
+
+    def join(self):
+        """Wait until every task submitted so far has run"""
+        self._queue.join()
+        self._raise_errors()
+
+    def close(self):
+        """Run everything queued and stop the thread"""
+        if not self._closed:
+            self._closed = True
+            self._queue.put(None)
+            self._thread.join()
+        self._raise_errors()
+
+    def _run(self):
+        while True:
+            task = self._queue.get()
+            try:
+                if task is None:
+                    return
+                target, func, args, kwargs = task
+                func(*args, **kwargs)
+            except Exception as e:
+                if target is not None:
+                    e = WriteError(target[0], target[1], e)
+                self._errors.append(e)
+            finally:
+                self._queue.task_done()
+
+    def _raise_errors(self):
+        if self._errors:
+            error = self._errors[0]
+            self._errors = []
+            if isinstance(error, WriteError):
+                raise error from error.error
+            raise error
+
+
+class BackgroundWriter(Writer):
+    """Hands the records for another writer to a `WriterThread`.
+
+    Inputs
+    ---------
+    writer
+        The `FileWriter` or `JsonlWriter` that does the writing
+    thread
+        (WriterThread) Usually the one thread shared by the process
+    """
+    def __init__(self, writer, thread):
+        self.writer = writer
+        self.thread = thread
+        self.pid = thread.pid
+
+    def submit(self, func, *args, **kwargs):
+        self.thread.submit(func, *args, **kwargs)
+
+    def submit_for(self, target, func, *args, **kwargs):
+        self.thread.submit_for(target, func, *args, **kwargs)
+
+    def check(self):
+        self.thread.check()
+
+    def write(self, record):
+        self.thread.submit_for((record['ticid'], record['sector']),
+                               self.writer.write, record)
+
+    def write_then(self, record, func, *args):
+        #One task, so func is not run if the write fails
+        self.thread.submit_for((record['ticid'], record['sector']),
+                               self.writer.write_then, record, func, *args)
+
+    def after_flush(self, func, *args):
+        self.thread.submit(self.writer.after_flush, func, *args)
+
+    def flush(self):
+        """Wait for the queued records, then flush the writer"""
+        self.thread.join()
+        self.writer.flush()
+
+    def close(self):
+        self.flush()
+        self.writer.close()
+
+
+def worker_path(out_dir, run_tag):
+    """The JSON lines file of this process for a run"""
+    return os.path.join(out_dir, "%s-%s-%i.jsonl" % (run_tag,
+                                                     socket.gethostname(),
+                                                     os.getpid()))
+
+
+def open_writer(out_dir, run_tag, backend="files",
+                batch_size=DEFAULT_BATCH_SIZE, background=False,
+                queue_size=DEFAULT_QUEUE_SIZE):
+    """The writer for a run in this process.
+
+    JSON lines writers are shared by every target of the run in the
+    process. With background=True, the writing is done by a thread
+    shared by every writer in the process. Everything held is written
+    when the process exits or `close_writers` is called.
+    """
+    global _thread
+    if backend not in OUTPUT_BACKENDS:
+        raise ValueError("Unknown output backend %s. Choose from %s" %
+                         (backend, ", ".join(OUTPUT_BACKENDS)))
+    os.makedirs(out_dir, exist_ok=True)
+
+    with _writers_lock:
+        if backend == "files":
+            writer = FileWriter(out_dir)
+        else:
+            path = os.path.abspath(worker_path(out_dir, run_tag))
+            writer = _writers.get(path)
+            if writer is None:
+                writer = JsonlWriter(path, batch_size=batch_size)
+                _writers[path] = writer
+
+        if background:
+            #A thread made before a fork belongs to the parent
+            if _thread is None or _thread.pid != os.getpid():
+                _thread = WriterThread(maxsize=queue_size)
+            writer = BackgroundWriter(writer, _thread)
+        return writer
+
+
+@atexit.register
+def close_writers():
+    """Write everything held by the writers opened by this process.
+
+    The queue of the background thread is drained first, then the JSON
+    lines writers are flushed. Everything is closed even if one step
+    fails, then the first error is raised.
+    """
+    global _thread
+    errors = []
+    with _writers_lock:
+        writers = list(_writers.values())
+        if _thread is not None:
+            writers.insert(0, _thread)
+        for writer in writers:
+            #Forked workers inherit their parent's writers, leave those
+            if writer.pid != os.getpid():
+                continue
+            try:
+                writer.close()
+            except Exception as e:
+                errors.append(e)
+        _writers.clear()
+        _thread = None
+    if errors:
+        raise errors[0]
+
+
+def read_records(path):
+    """Yield the records in a JSON lines file.
+
+    A last line cut short by a crash is skipped.
+    """
+    with open(path) as fobj:
+        for line in fobj:
+            try:
+                yield json.loads(line)
+            except ValueError:
+                continue
+
+
+def merge(out_dir, run_tag, path=None):
+    """Join the JSON lines files of every worker of a run.
+
+    If a target was written more than once, the last record is kept.
+    Records are sorted by TIC and sector. Lines that are not target
+    records (they have no "status") are skipped.
+
+    Returns
+    -----------
+    The merged file, by default "<run_tag>.jsonl" in out_dir.
+    """
+    if path is None:
+        path = os.path.join(out_dir, "%s.jsonl" % (run_tag))
+
+    latest = dict()
+    for part in sorted(glob.glob(os.path.join(out_dir,
+                                              "%s-*.jsonl" % (run_tag)))):
+        for record in read_records(part):
+            if 'status' not in record:
+                continue
+            key = (record['ticid'], record['sector'])
+            if key not in latest or \
+               record['finished'] >= latest[key]['finished']:
+                latest[key] = record
+
+    tmp = path + ".tmp"
+    with open(tmp, 'w') as fobj:
+        for key in sorted(latest):
+            fobj.write(json.dumps(latest[key]) + "\n")
+    os.replace(tmp, path)
+    return path
+
+
+def export_files(path, out_dir, targets=None):
+    """Write the original per-target files from a JSON lines file.
+
+    Inputs
+    ---------
+    path
+        (str) JSON lines file, from a worker or `merge`
+    out_dir
+        (str) Where to make the target directories
+    targets
+        Optional collection of (ticid, sector) to export. Default all.
+
+    Returns
+    -----------
+    Number of targets written.
+    """
+    writer = FileWriter(out_dir)
+    base = os.path.dirname(os.path.abspath(path))
+    if targets is not None:
+        targets = {(int(t), int(s)) for t, s in targets}
+
+    n = 0
+    for record in read_records(path):
+        if targets is not None and \
+           (record['ticid'], record['sector']) not in targets:
+            continue
+        plot = record['plot']
+        record['plot'] = None
+        writer.write(record)
+        if plot is not None:
+            shutil.copyfile(os.path.join(base, plot),
+                            target_dir(out_dir, record['ticid'],
+                                       record['sector']) +
+                            "tic%09i-%s-plot.png" % (record['ticid'],
+                                                     record['run_tag']))
+        n += 1
+    return n
@@ -1,7 +1,14 @@
 __all__ = ['search_and_vet_one', 'vet_tce','vet_all_tces','get_disposition',
            'load_def_config','load_def_vetter']
 
+import atexit
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import os
+from time import perf_counter
+
 import corazon.planetSearch as ps
+from corazon.metrics import MISSING_REASON, VetterMetrics, metric_names
+from corazon.vetter_pool import VetterPool
 import corazon.gen_lightcurve as genlc
 import matplotlib.pyplot as plt
 import exovetter.tce as TCE
@@ -26,12 +33,25 @@ def load_def_config():
         "det_window" : 65,
         "noise_window" : 27,
         "n_sigma" : 4.5,  #noise reject sigma
+        "detrender" : "median",  #"median", "box" or "biweight", see corazon.detrend
+        "segment_gap_days" : None,  #Detrend each stretch between longer gaps on its own
+        "detrend_workers" : 1,  #Threads for segmented detrending
+        "float32" : False,  #Keep flux and BLS bins in single precision
+        "vet_workers" : 1,  #TCEs of one target vetted at the same time
+        "vet_executor" : "thread",  #"thread" or "process" pool for vetting
+        "vet_triage" : False,  #Stop vetting a TCE at its first failed threshold
         "max_period_days" : 10,
         "min_period_days" : 0.8,
         "bls_durs_hrs" : [1,2,4,8,12],
         "minSnr" : [1],
         "maxTces" : 20,
-        "fracRemain" : 0.7
+        "fracRemain" : 0.7,
+        "bls_backend" : "astropy",  #"astropy" or "corazon", see planetSearch.calcBls
+        "bls_grid" : "uniform",  #BLS trial periods, see planetSearch.blsPeriodGrids
+        "bls_workers" : 1,  #Processes for one BLS search (corazon backend only)
+        "tce_extraction" : "iterative",  #or "topk", see planetSearch.identifyTces
+        "unknown_sector" : "none",  #Gaps for sectors with no gap info: "none", "infer" or "error"
+        "gap_file" : None  #Optional csv of sector gaps, see corazon.gaps
         }
     
     return config
@@ -75,7 +95,7 @@ def search_and_vet_one(ticid, sector, lcdata, config, vetter_list,
        string version of tce and decision
       
     metrics_list : list
-        all metrics, one per tce
+        `VetterMetrics`, one per tce
 
     
     """
@@ -88,16 +108,29 @@ def search_and_vet_one(ticid, sector, lcdata, config, vetter_list,
                                           config["det_window"], 
                                           config["noise_window"], 
                                           config["n_sigma"], 
-                                          sector)
+                                          sector,
+                                          unknown_sector=config.get("unknown_sector",
+                                                                    "error"),
+                                          gap_file=config.get("gap_file"),
+                                          detrender=config.get("detrender",
+                                                               "median"),
+                                          segment_gap=config.get("segment_gap_days"),
+                                          workers=config.get("detrend_workers", 1),
+                                          float32=config.get("float32", False))
         
-    
     tce_list, stats = ps.identifyTces(good_time, meddet_flux, 
                                       bls_durs_hrs=config["bls_durs_hrs"],
                                       minSnr=config["minSnr"], 
                                       fracRemain=config["fracRemain"], 
                                       maxTces=config["maxTces"], 
                                       minP=config["min_period_days"], 
-                                      maxP=config["max_period_days"])
+                                      maxP=config["max_period_days"],
+                                      bls_backend=config.get("bls_backend",
+                                                             "astropy"),
+                                      bls_grid=config.get("bls_grid", "uniform"),
+                                      bls_workers=config.get("bls_workers", 1),
+                                      extraction=config.get("tce_extraction",
+                                                            "iterative"))
     
     if plot:
         plot_lc_tce(ticid, tce_list, time, flux, flags, good_time, 
@@ -110,54 +143,136 @@ def search_and_vet_one(ticid, sector, lcdata, config, vetter_list,
     result_strings, disp, reason, metrics_list, tce_tces = vet_all_tces(tce_lc, 
                                                     tce_list, ticid, 
                                                     vetter_list, thresholds,
-                                                    plot=False)
+                                                    plot=False,
+                                                    workers=config.get("vet_workers", 1),
+                                                    executor=config.get("vet_executor",
+                                                                        "thread"),
+                                                    triage=config.get("vet_triage",
+                                                                      False))
     
     return tce_tces, result_strings, metrics_list
 
 
-def vet_tce(tce, tce_lc, vetter_list, plot=False):
+#Rough run time in seconds of each vetter on a sector of FFI data. Triage
+#mode runs the cheapest first, using these until a vetter has been timed.
+#A vetter with a `cost` attribute always uses that instead.
+VETTER_COSTS = {'TransitPhaseCoverage' : 2e-4,
+                'OddEven' : 2e-4,
+                'Sweet' : 2e-3,
+                'Lpp' : 1e-2}
+DEFAULT_VETTER_COST = 1e-2
+
+#Mean measured run time of each vetter class in this process, in seconds
+_measured_costs = dict()
+
+#The checks applied by get_disposition, in order. Each is the metric it
+#reads, a function that is True if the TCE fails, and the reason text.
+DISPOSITION_CHECKS = [
+    ('snr', lambda m, t: m['snr'] < t['snr'], "-LowSNR-"),
+    ('norm_lpp', lambda m, t: m['norm_lpp'] > t['norm_lpp'], "-NormLPP-"),
+    ('tp_cover', lambda m, t: m['tp_cover'] < t['tp_cover'],
+     "-PoorTransitCoverage-"),
+    ('oe_sigma', lambda m, t: m['oe_sigma'] > t['oe_sigma'],
+     "-OddEvenDetected-"),
+    ('sweet', lambda m, t: m['sweet']['amp'][0, -1] > t['sweet'],
+     "-SWEETHalfPeriod"),
+    ('sweet', lambda m, t: m['sweet']['amp'][1, -1] > t['sweet'],
+     "-SWEETAtPeriod"),
+    ('sweet', lambda m, t: m['sweet']['amp'][2, -1] > t['sweet'],
+     "-SWEETTwicePeriod-"),
+    ]
+
+
+def vet_tce(tce, tce_lc, vetter_list, plot=False, thresholds=None,
+            triage=False):
+    """Run the vetters on a TCE and return its `VetterMetrics`.
+
+    With triage=True, thresholds must be given. The snr is checked first,
+    then the vetters are run cheapest first (see `vetter_cost`) and
+    vetting stops at the first threshold failure. The metrics of the
+    vetters that were not run are marked as not computed, and
+    ``metrics.decided_by`` names the vetter that failed the TCE.
+    """
+    metrics = VetterMetrics()
+    if triage:
+        if thresholds is None:
+            raise ValueError("Triage vetting needs thresholds")
+        metrics['snr'] = tce['snr']
+        if failed_checks(metrics, thresholds, ['snr']):
+            metrics.decided_by = 'snr'
+        vetter_list = sorted(vetter_list, key=vetter_cost)
 
-    metrics = dict()
     for v in vetter_list:
         vetter = v
+        if metrics.decided_by is not None:
+            metrics.skip(vetter)
+            continue
         
+        start = perf_counter()
         try:
             _ = vetter.run(tce, tce_lc)
         except ValueError:
             pass
         if plot:
             vetter.plot()
-        metrics.update(vetter.__dict__)
+        metrics.update_from(vetter)
+
+        if triage:
+            _record_cost(vetter, perf_counter() - start)
+            if failed_checks(metrics, thresholds, metric_names(vetter)):
+                metrics.decided_by = type(vetter).__name__
         
     return metrics
 
+
+def vetter_cost(vetter):
+    """Expected run time of a vetter: its own `cost` attribute, else the
+    measured mean time, else the value in `VETTER_COSTS`"""
+    cost = getattr(vetter, 'cost', None)
+    if cost is not None:
+        return cost
+    name = type(vetter).__name__
+    if name in _measured_costs:
+        return _measured_costs[name]
+    return VETTER_COSTS.get(name, DEFAULT_VETTER_COST)
+
+
+def _record_cost(vetter, seconds):
+    name = type(vetter).__name__
+    if name in _measured_costs:
+        seconds = 0.8 * _measured_costs[name] + 0.2 * seconds
+    _measured_costs[name] = seconds
+
+
+def failed_checks(metrics, thresholds, names=None):
+    """Reasons for the disposition checks the metrics fail.
+
+    Only checks of the metrics in names (default, all of them) are
+    applied. Checks of metrics skipped in triage mode (not_computed) are
+    not applied. A metric that is None otherwise (e.g. its vetter raised
+    an error) fails, with the reason `MISSING_REASON`.
+    """
+    not_computed = getattr(metrics, 'not_computed', ())
+    reasons = []
+    for name, fails, reason in DISPOSITION_CHECKS:
+        if names is not None and name not in names:
+            continue
+        if name in not_computed:
+            continue
+        if metrics[name] is None:
+            missing = MISSING_REASON % (name)
+            if missing not in reasons:
+                reasons.append(missing)
+        elif fails(metrics, thresholds):
+            reasons.append(reason)
+    return reasons
+
+
 def get_disposition(metrics, thresholds):
     """Apply thresholds to get a passfail"""
     
-    disp = 'PASS' 
-    reason = ''
-    if metrics['snr'] < thresholds['snr']:
-        disp = 'FAIL'
-        reason = reason + "-LowSNR-"
-    if metrics['norm_lpp'] > thresholds['norm_lpp']:
-        disp = 'FAIL'
-        reason = reason + "-NormLPP-"
-    if metrics['tp_cover'] < thresholds['tp_cover']:
-        disp = 'FAIL'
-        reason = reason + "-PoorTransitCoverage-"
-    if metrics['oe_sigma'] > thresholds['oe_sigma']:
-        disp = 'FAIL'
-        reason = reason + "-OddEvenDetected-"
-    if metrics['sweet']['amp'][0, -1] > thresholds['sweet']:
-        disp = 'FAIL'
-        reason = reason + "-SWEETHalfPeriod"
-    if metrics['sweet']['amp'][1, -1] > thresholds['sweet']:
-        disp = 'FAIL'
-        reason = reason + "-SWEETAtPeriod"
-    if metrics['sweet']['amp'][2,-1] > thresholds['sweet']:
-        disp = 'FAIL'
-        reason = reason + "-SWEETTwicePeriod-"
-    
+    reason = "".join(failed_checks(metrics, thresholds))
+    disp = 'FAIL' if reason else 'PASS'
     
     return disp,reason
     
@@ -190,7 +305,30 @@ def make_result_string(tce, disposition, reason):
     return st
 
 
-def vet_all_tces(lc, tce_dict_list, ticid, vetter_list, thresholds, plot=False):
+def vet_all_tces(lc, tce_dict_list, ticid, vetter_list, thresholds, plot=False,
+                 workers=1, executor="thread", triage=False):
+    """
+    Vet every TCE found for one target.
+
+    vetter_list is a list of vetters, or a `VetterPool` that lends a clean
+    vetter set to each TCE (e.g. `run_pipeline.default_vetter_pool`, which
+    is built once per process and reused for every target).
+
+    With workers > 1 the TCEs are vetted at the same time on a pool of
+    threads (executor="thread") or processes (executor="process"). Vetters
+    keep the state of their last run, so each TCE in flight gets its own
+    copy of vetter_list. Results are returned in event order and are the
+    same as a serial run. Plotting always runs serially. The thread copies
+    (a `VetterPool` around a plain list) and the process pool are kept for
+    the next call with the same vetter_list, so they are made once per
+    run, not once per target.
+
+    With triage=True each TCE is vetted cheapest vetter first and stops at
+    the first threshold failure, see `vet_tce`.
+    """
+    if executor not in ("thread", "process"):
+        raise ValueError("Unknown vetting executor %s" % (executor))
+
     lcformat = lc['time'].format
     disp_list = []
     reason_list = []
@@ -207,23 +345,118 @@ def vet_all_tces(lc, tce_dict_list, ticid, vetter_list, thresholds, plot=False):
                       target = f"TIC {ticid}",
                       sector = lc.sector,
                       event = f"{pn}")
-        
-        metrics = vet_tce(tce, lc, vetter_list, plot=plot)
+        tce_list.append(tce)
+        pn=pn+1
+
+    n = len(tce_list)
+    opts = dict(thresholds=thresholds, triage=triage)
+    workers = min(workers, n)
+    if plot or workers <= 1:
+        all_metrics = [_vet_with(tce, lc, vetter_list, plot=plot, **opts)
+                       for tce in tce_list]
+    elif executor == "thread":
+        if not isinstance(vetter_list, VetterPool):
+            vetter_list = _thread_vetter_pool(vetter_list)
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            all_metrics = list(pool.map(_vet_with, tce_list, [lc] * n,
+                                        [vetter_list] * n, [False] * n,
+                                        [thresholds] * n, [triage] * n))
+    else:
+        pool = _vet_process_pool(workers, vetter_list)
+        #One chunk per worker, so the light curve is pickled once per chunk
+        all_metrics = list(pool.map(_vet_in_worker, tce_list, [lc] * n,
+                                    [thresholds] * n, [triage] * n,
+                                    chunksize=-(-n // workers)))
+
+    for tce, metrics in zip(tce_list, all_metrics):
         metrics['snr'] = tce['snr']
         disposition, reason = get_disposition(metrics, thresholds)
         result_string = make_result_string(tce, disposition, reason)
         tce['disposition'] = disposition
         tce['reason'] = reason
-        tce_list.append(tce)
         disp_list.append(disposition)
         reason_list.append(reason)
         result_list.append(result_string)
         metrics_list.append(metrics)
-        pn=pn+1
-        
-        
+
     return result_list, disp_list, reason_list, metrics_list, tce_list
 
+
+#The vetters of a vetting worker process, see vet_all_tces
+_worker_vetters = None
+
+#Process pool kept between calls of vet_all_tces, and what it was made for
+_vet_pool = None
+_vet_pool_key = None
+
+#VetterPool wrapping the last plain vetter list vetted on threads, and
+#that list
+_thread_vetters = None
+_thread_vetters_list = None
+
+
+def _thread_vetter_pool(vetter_list):
+    """A `VetterPool` around a plain vetter list, kept between targets so
+    the extra set for each thread is made once. The first set is
+    vetter_list itself, the others are shallow copies that share its
+    attributes (e.g. the LPP map). Sets are reset to the state vetter_list
+    was in when the pool was made. A new pool is made if vetter_list (by
+    identity) changes."""
+    global _thread_vetters, _thread_vetters_list
+    if _thread_vetters is None or _thread_vetters_list is not vetter_list:
+        _thread_vetters = VetterPool(lambda: vetter_list)
+        _thread_vetters_list = vetter_list
+    return _thread_vetters
+
+
+def _vet_process_pool(workers, vetter_list):
+    """A process pool kept between targets, so workers start and receive
+    their vetters once. A new pool is made if workers or vetter_list (by
+    identity) change. Each worker holds a copy of vetter_list as it was
+    when the pool started."""
+    global _vet_pool, _vet_pool_key
+    key = (workers, id(vetter_list), os.getpid())
+    if _vet_pool is None or _vet_pool_key[:3] != key:
+        shutdown_vet_pool()
+        _vet_pool = ProcessPoolExecutor(max_workers=workers,
+                                        initializer=_init_vet_worker,
+                                        initargs=(vetter_list,))
+        #Holding vetter_list keeps its id from being reused
+        _vet_pool_key = key + (vetter_list,)
+    return _vet_pool
+
+
+def shutdown_vet_pool():
+    """Stop the process pool used by `vet_all_tces`"""
+    global _vet_pool, _vet_pool_key
+    if _vet_pool is not None and _vet_pool_key[2] == os.getpid():
+        _vet_pool.shutdown()
+    _vet_pool = None
+    _vet_pool_key = None
+
+
+atexit.register(shutdown_vet_pool)
+
+
+def _init_vet_worker(vetter_list):
+    global _worker_vetters
+    _worker_vetters = vetter_list
+
+
+def _vet_in_worker(tce, lc, thresholds=None, triage=False):
+    return _vet_with(tce, lc, _worker_vetters, thresholds=thresholds,
+                     triage=triage)
+
+
+def _vet_with(tce, lc, vetter_list, plot=False, thresholds=None, triage=False):
+    """vet_tce, borrowing the vetters if vetter_list is a `VetterPool`"""
+    if isinstance(vetter_list, VetterPool):
+        with vetter_list.borrow() as vetters_:
+            return vet_tce(tce, lc, vetters_, plot=plot, thresholds=thresholds,
+                           triage=triage)
+    return vet_tce(tce, lc, vetter_list, plot=plot, thresholds=thresholds,
+                   triage=triage)
+
     
 def plot_lc_tce(ticid, tce_list, time, flux, flags, good_time, 
                 good_flux, stats, sector):
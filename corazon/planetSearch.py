@@ -9,51 +9,111 @@ Created on Sat Feb  9 16:47:22 2019
 from astropy.timeseries import BoxLeastSquares
 import numpy as np
 from astropy.convolution import convolve, Box1DKernel
+from corazon import detrend as cordetrend
+from corazon import gaps
 from corazon import plateau
+from corazon import rolling
+from corazon import bls as corbls
 
 #import matplotlib.pyplot as plt
 
+#Settings for the BLS period grid and phase binning
+BLS_FREQUENCY_FACTOR = 0.8
+BLS_GRID_OVERSAMPLE = 3  #Trial frequencies per duty cycle step
+BLS_OVERSAMPLE = 20
 
-def clean_timeseries(time, flux, qflags, det_window, noise_window, n_sigma, sector):
+#Two periods whose ratio is within HARMONIC_TOL of an integer up to
+#HARMONIC_MAX_ORDER are treated as the same signal by blsTopPeaks. The
+#tolerance is widened to HARMONIC_WIDTH*duration/baseline, the width of
+#a BLS peak, so the side lobes of a strong signal are dropped too.
+HARMONIC_TOL = 0.01
+HARMONIC_MAX_ORDER = 10
+HARMONIC_WIDTH = 3
+
+
+def clean_timeseries(time, flux, qflags, det_window, noise_window, n_sigma, sector,
+                     unknown_sector="error", gap_file=None, detrender="median",
+                     segment_gap=None, workers=1, float32=False):
+    """
+    Remove bad data and detrend a light curve.
+
+    If float32 is True, flux and every array derived from it are kept in
+    single precision, halving their memory. time stays in double
+    precision.
+
+    detrender names the method used for the final detrend, see
+    `corazon.detrend`. Noisy data are always found with a median detrend.
+
+    If segment_gap (days) is set, both detrends are done separately on
+    each stretch of data between jumps in time longer than segment_gap,
+    on up to workers threads (see `corazon.detrend.detrend_segments`).
+    time must then be sorted.
+
+    The stages (quality flags, gaps, noisy data, noisy sections and single
+    point outliers) each shrink one array of surviving indices, and only
+    the final survivors are copied out of time. The median detrend of the
+    raw flux done by `idNoisyData` is reused for the final median detrend
+    when nothing was flagged and the windows are the same.
+
+    Returns good_time, good_flux
+    """
     
-    qbad = qflags != 0
-    tgaps = loadGapInfoBySector(time,sector)
-    bad = idNoisyData(flux, noise_window, Nsigma=n_sigma)
- 
-    flagged = bad | qbad | tgaps  #Indicate bad data
-    med_det = median_detrend(flux[~flagged], det_window)
-    det_time = time[~flagged]
+    dtype = np.float64
+    if float32:
+        dtype = np.float32
+        flux = np.asarray(flux, dtype=dtype)
+
+    def run_detrend(t, f, window, method):
+        if segment_gap is None:
+            return cordetrend.detrend(t, f, window, method=method, dtype=dtype)
+        return cordetrend.detrend_segments(t, f, window, method=method,
+                                           min_gap=segment_gap, workers=workers,
+                                           dtype=dtype)
+
+    win = noiseWindow(noise_window)
+    if segment_gap is None:
+        mdFlux = median_detrend(flux, win, dtype=dtype)
+    else:
+        mdFlux = run_detrend(time, flux, win, "median")
+    flagged = idNoisyData(flux, noise_window, Nsigma=n_sigma, mdFlux=mdFlux)
+    flagged |= qflags != 0
+    flagged |= loadGapInfoBySector(time, sector, unknown_sector=unknown_sector,
+                                   gap_file=gap_file)  #Indicate bad data
+
+    keep = np.flatnonzero(~flagged)
+    if detrender == "median" and win == det_window and len(keep) == len(flux):
+        med_det = mdFlux
+    else:
+        med_det = run_detrend(time[keep], flux[keep], det_window, detrender)
+    del mdFlux, flagged
 
     #Look for extra noisy section on length of around 1.5 days (window = 90)
-    std_bad, med_std = running_std_gap(med_det, 70, N=2, nSigTimes=5)
+    std_bad, med_std = running_std_gap(med_det, 70, N=2, nSigTimes=5,
+                                       dtype=dtype)
     #print(len(std_bad[std_bad]))
     
-    
-    good_time = det_time[~std_bad]
-    good_flux = med_det[~std_bad]
+    if np.any(std_bad):
+        keep = keep[~std_bad]
+        med_det = med_det[~std_bad]
+    good_time = time[keep]
     
     #Final Pass for single point outliers that are not periodic
-    spo_idx = findOutliers(good_time, good_flux, gap=None,
+    spo_idx = findOutliers(good_time, med_det, gap=None,
                  threshold_sigma=3.0,
                  precision_days=0.02085,
                  maxClusterLen = 3
                  )   
-    #print("spo_idx")
-    #print(spo_idx)
-    #spogaps = np.zeros(len(spo_idx)) == 1
-    #spogaps[spo_idx] = True
-    #plt.figure()
-    #plt.plot(good_time[~spo_idx], good_flux[~spo_idx])
     
-    return good_time[~spo_idx], good_flux[~spo_idx]
+    return good_time[~spo_idx], med_det[~spo_idx]
 
-def loadGapInfoBySector(time, sector):
+def loadGapInfoBySector(time, sector, unknown_sector="error", gap_file=None):
     """Loads a list of bad cadence indices.
 
     TESS produces quality flags, but  does not populate the FFIs with them.
     Instead we have to look the up in the data release notes.
 
-    Based on the Data release notes, but modified by hand based on
+    The bad time ranges are read from the table in `corazon.gaps`, which
+    was based on the Data release notes, but modified by hand based on
     inspection of Wasp 126
 
     Inputs
@@ -62,113 +122,48 @@ def loadGapInfoBySector(time, sector):
         (1d np array) Array of TJDs for the data. See `extractlc.loadSingleSector`.
     sector
         (int)
+    unknown_sector
+        (str) "error", "none" or "infer". See `corazon.gaps.sector_gaps`
+    gap_file
+        (str) Optional user table of gaps, overriding the shipped one for
+        the sectors it lists.
 
     Returns
     -----------
     1d boolean np array of length time
     """
-    gaps = np.zeros_like(time, dtype=bool)
-
-    if sector == 1:
-        # See page 2 of
-        #https://archive.stsci.edu/missions/tess/doc/tess_drn/tess_sector_01_drn01_v01.pdf
-        gaps |= (time <= 1325.61)
-        gaps |= (1338.52153 <= time) & (time <= 1339.65310)  #Inter orbit gap
-        gaps |= (1346.95 <= time) & (time <= 1349.75)  #See DRN 1 p3
-        gaps |= (time >= 1352.92)  #End of sector usually bad.
-    elif sector == 2:
-        gaps |= (1367.15347 <= time) & (time <= 1368.59406)  #
-    elif sector == 3:
-        gaps |= (1381.1 <= time) & (time <= 1385.89663)  #Pre "science start"
-        gaps |= (1394.47997 <= time) & (time <= 1395.80497)  #apears to be bad??
-        gaps |= (1395.47997 <= time) & (time <= 1396.60497)  #Inter orbit gap
-        gaps |= (1406.2 <= time) & (time <= 1409.38829)  #Post science
-    elif sector == 4:
-        #The bad guide star data may still be usable. Need to check
-        gaps |= (1410.89974 <= time) & (time <= 1413.26468)  #Bad Guide star
-#        gaps |= (1418.53691 <= time) & (time <= 1421.86)  #Instr. Anom.
-#        gaps |= (1422.95 <= time) & (time <= 1424.54897)  #Inter orbit gap
-        gaps |= (1418.53691 <= time) & (time <= 1424.54897)
-        gaps |= (1436.0 <= time) & (time <= 1439.8)  #Not sure what this is
-    elif sector == 5:
-        gaps |= (1450.01 <= time) & (time <=  1451.81)  #Inter orbit gap
-        #I don't think this means the data is generally bad
-        gaps |= (1463.55 <= time) & (time <= 1464.40056)  #Camera 1 guiding
-    elif sector == 6:
-        gaps |= (1477.0 <= time) & (time <= 1478.41)  #inter orbit gap
-        gaps |= (1463.6 <= time) & (time <= 1468.26998)  #before beginning of 6
-    elif sector == 7:
-        #gaps |= (1517 <= time) & (time <= 1491.62) # orbit range
-        gaps |= (1502.5 <= time) & (time <= 1505.01) #inter sector gap
-    elif sector == 14:
-        gaps |= (1696.2 <= time) & (time <= 1697.2) #inter sector gap
-        #gaps |= gaps
-    elif sector == 15:
-        gaps |= (1723.25 <= time) & (time <= 1725.6)
-        gaps |= (1736.01 <= time)
-    elif sector == 16:
-        gaps |= (1738.65 >= time) 
-        gaps |= (time >= 1763.31) # orbit range
-        gaps |= (1750.25 <= time) & (time <= 1751.659) #inter sector gap
-    elif sector == 26 :
-        gaps |= (2010.26209 >= time)
-        gaps |= (time >= 2035.1343)
-        gaps |= (2021.482 <= time) & (time <= 2023.28936)        
-
-#        gaps |= (<= time) & (time <= )  #
-
-    else:
-        raise ValueError("No gap info available for sector %i" %(sector))
-
-    return gaps
+    return gaps.sector_gaps(time, sector, unknown_sector=unknown_sector,
+                            user_file=gap_file)
     
     
 
-def median_detrend(flux, window):
+def median_detrend(flux, window, dtype=np.float64):
     """
     Fergal's code to median detrend. 
+
+    The running median comes from `rolling.clamped_median`, which gives the
+    same offsets as the original per-point loop without calling np.median
+    once per cadence.
+
+    dtype is the type of the returned array.
     """
     size = len(flux)
-    nPoints = window
-    
-    filtered = np.zeros(size)
-    for i in range(size):
-        #This two step ensures that lwr and upr lie in the range [0,size)
-        lwr = max(i-nPoints, 0)
-        upr = min(lwr + 2*nPoints, size)
-        lwr = upr- 2*nPoints
-
-        sub = flux[lwr:upr]
+    offset = rolling.clamped_median(flux, window)
 
-        offset = np.median(sub)
-        try:
-            filtered[i] = flux[i]/offset - 1
-        except ZeroDivisionError:
-                filtered[i] = 0
+    filtered = np.zeros(size, dtype=dtype)
+    filtered[:] = flux/offset - 1
 
     return filtered
 
-def median_subtract(flux, window):
+def median_subtract(flux, window, dtype=np.float64):
     """
     Fergal's code to median detrend. 
     """
     size = len(flux)
-    nPoints = window
-    
-    filtered = np.zeros(size)
-    for i in range(size):
-        #This two step ensures that lwr and upr lie in the range [0,size)
-        lwr = max(i-nPoints, 0)
-        upr = min(lwr + 2*nPoints, size)
-        lwr = upr- 2*nPoints
+    offset = rolling.clamped_median(flux, window)
 
-        sub = flux[lwr:upr]
-
-        offset = np.median(sub)
-        try:
-            filtered[i] = flux[i] - offset
-        except ZeroDivisionError:
-                filtered[i] = 0
+    filtered = np.zeros(size, dtype=dtype)
+    filtered[:] = flux - offset
 
     return filtered
 
@@ -186,37 +181,40 @@ def conv_detrend(flux, window, gap):
     
     return median_det
 
-def idNoisyData(flux, window, Nsigma=4):
+def idNoisyData(flux, window, Nsigma=4, mdFlux=None):
     """
     Determine sections of the data that are very noisy compared to the rest.
     Look for N sigma away from the std of the data.
     Be careful, try not to cut out planets.
     I recommend using a window that is smaller than used for planet finding.
     
+    mdFlux is an optional, already computed,
+    ``median_detrend(flux, noiseWindow(window))``.
+
+    The median detrended flux is not changed by the cut, so one pass
+    gives the same answer as repeating it.
     """
+    if len(flux) == 0:
+        return np.zeros(0, dtype=bool)
+    if mdFlux is None:
+        mdFlux = median_detrend(flux, noiseWindow(window))
+
+    sd = np.std(mdFlux)
+    return np.abs(mdFlux) > Nsigma * sd
+
+def noiseWindow(window):
+    """The median detrend window used by `idNoisyData`"""
     win = int(window)
     if ~is_odd(win):
         win=win+1
-
-    is_bad = np.zeros(len(flux)) == 1
-        
-    mdFlux = median_detrend(flux[~is_bad], win)
-
-    for i in np.arange(1,4):
-
-        if np.all(is_bad):
-            continue
-
-        sd = np.std(mdFlux)
-        is_bad |= np.abs(mdFlux) > Nsigma * sd
-
-    return is_bad
+    return win
 
 def is_odd(num):
    return num % 2 != 0
 
 
-def running_std_gap(flux, window, N=3, nSigTimes=3.3):
+def running_std_gap(flux, window, N=3, nSigTimes=3.3, return_sections=False,
+                    dtype=np.float64):
     """
     for specified window, determine data chunks that are parts of sections
     of the data that have std nSigTimes larger than the overall std. only pulls
@@ -225,52 +223,163 @@ def running_std_gap(flux, window, N=3, nSigTimes=3.3):
     Returns isbad array of 1 and 0 where 1 means bad data and 0 means clean
     Be sure to set a wide enough window so you don't throw away planets.
     Probably N*duration(in points) of longest transit expected.
+
+    If return_sections is True, also return an (M,2) array of the
+    [start, end) indices of the M <= N sections that were marked bad,
+    noisiest first.
     """
-    gap = np.zeros(len(flux))
-    
-    std_array = np.zeros(len(flux))
+    gap = np.zeros(len(flux), dtype=bool)
     
+    std_array = np.zeros(len(flux), dtype=dtype)
     
-    for i in range(window, len(flux), 1):
-        
-        f = flux[i-window:i]
-        std_array[i] = np.nanstd(f)
-    
-    #plt.figure()
-    #plt.plot(std_array,'.')
+    #std_array[i] is the std of flux[i-window:i]
+    if len(flux) > window:
+        std_array[window:] = rolling.running_std(flux[:-1], window)
     
     med_std = np.median(std_array)
     #print("mean std: %f" % med_std)
     
-    argsort = np.argsort(std_array)
-    
-    for i in argsort[-1*N:]:
+    sections = []
+    for i in rolling.top_n(std_array, N):
         if std_array[i] > med_std * nSigTimes:
-            gap[i-window:i] = 1
+            gap[i-window:i] = True
+            sections.append([max(i-window, 0), i])
             
-    isbad = gap == 1
+    isbad = gap
     
+    if return_sections:
+        sections = np.array(sections[::-1], dtype=int).reshape(-1, 2)
+        return isbad, med_std, sections
     return isbad, med_std
         
 
-def calcBls(flux,time, bls_durs, minP=None, maxP=None, min_trans=3):
+def blsPeriodGrids(time, bls_durs, minP=None, maxP=None, min_trans=3,
+                   grid="uniform"):
+    """
+    Trial periods for the BLS search.
+
+    grid is one of
+
+    * "uniform": evenly spaced in frequency (`corazon.bls.autoperiod`,
+      the same grid as astropy's BoxLeastSquares.autoperiod)
+    * "duty_cycle": spaced by the duty cycle of the shortest duration
+      (`corazon.bls.duty_cycle_periods`), so fewer short periods are tried.
+    * "per_duration": a separate duty cycle grid for each duration, so
+      long durations are searched on coarser grids.
+
+    Returns a list of (periods, durations) pairs to search.
+    """
+    bls_durs = np.atleast_1d(bls_durs)
+    if grid == "uniform":
+        periods = corbls.autoperiod(time, bls_durs, minimum_period=minP,
+                                    maximum_period=maxP,
+                                    minimum_n_transit=min_trans,
+                                    frequency_factor=BLS_FREQUENCY_FACTOR)
+        return [(periods, bls_durs)]
+    elif grid == "duty_cycle":
+        periods = corbls.duty_cycle_periods(time, bls_durs, minP, maxP,
+                                            min_trans, BLS_GRID_OVERSAMPLE)
+        return [(periods, bls_durs)]
+    elif grid == "per_duration":
+        return [(corbls.duty_cycle_periods(time, d, minP, maxP, min_trans,
+                                           BLS_GRID_OVERSAMPLE), np.array([d]))
+                for d in bls_durs]
+    else:
+        raise ValueError("Unknown BLS period grid %s" % (grid))
+
+def calcBls(flux,time, bls_durs, minP=None, maxP=None, min_trans=3,
+            backend="astropy", grid="uniform", workers=1):
     """
     Take a bls and return the spectrum.
+
+    backend selects the BLS implementation, either "astropy"
+    (BoxLeastSquares.power) or "corazon" (`corazon.bls.bls_power`).
+    Both return an astropy BoxLeastSquaresResults.
+
+    grid selects the trial periods, see `blsPeriodGrids`. With
+    "per_duration" the spectra from each grid are merged and sorted by
+    period.
+
+    If workers > 1 the period grid is split across that many processes
+    (`corazon.bls.parallel_bls_power`). This needs the corazon backend.
     """
     
-    bls = BoxLeastSquares(time, flux)
-    period_grid = bls.autoperiod(bls_durs,minimum_period=minP, \
-                   maximum_period=maxP, minimum_n_transit=min_trans, \
-                   frequency_factor=0.8)
-    
-    bls_power = bls.power(period_grid, bls_durs, oversample=20)
+    if backend not in ("astropy", "corazon"):
+        raise ValueError("Unknown BLS backend %s" % (backend))
+    if workers > 1 and backend != "corazon":
+        raise ValueError("Parallel BLS needs the corazon BLS backend")
+
+    spectra = []
+    for period_grid, durs in blsPeriodGrids(time, bls_durs, minP, maxP,
+                                            min_trans, grid):
+        if backend == "astropy":
+            bls = BoxLeastSquares(time, flux)
+            spectra.append(bls.power(period_grid, durs,
+                                     oversample=BLS_OVERSAMPLE))
+        elif workers > 1:
+            spectra.append(corbls.parallel_bls_power(time, flux, period_grid,
+                                                     durs,
+                                                     oversample=BLS_OVERSAMPLE,
+                                                     workers=workers))
+        else:
+            spectra.append(corbls.bls_power(time, flux, period_grid, durs,
+                                            oversample=BLS_OVERSAMPLE))
     
+    bls_power = corbls.merge_results(spectra)
     return bls_power
 
-def findBlsSignal(time, flux, bls_durations, minP=None, maxP=None, min_trans=3):
+def findBlsSignal(time, flux, bls_durations, minP=None, maxP=None, min_trans=3,
+                  backend="astropy", grid="uniform", workers=1):
     
-    bls_power = calcBls(flux, time, bls_durations, minP=minP, maxP=maxP, min_trans=min_trans)
+    bls_power = calcBls(flux, time, bls_durations, minP=minP, maxP=maxP,
+                        min_trans=min_trans, backend=backend,
+                        grid=grid, workers=workers)
     
+    return blsPeak(bls_power)
+
+def findBlsSignalBatch(time, flux, bls_durations, valid=None, minP=None,
+                       maxP=None, min_trans=3, grid="uniform"):
+    """
+    Run findBlsSignal on many light curves that share a time axis.
+
+    time
+        (1d np array) Times shared by all targets, e.g. a sector's cadences
+    flux
+        (2d np array) One light curve per row, shape (n_targets, len(time))
+    valid
+        (2d boolean array) Optional, same shape as flux. False for points
+        to leave out of each target's search (gaps, outliers, etc.).
+        Non-finite fluxes are always left out.
+    grid
+        Period grid, see `blsPeriodGrids`.
+
+    The period grid and phase reference come from the shared time axis
+    (`corazon.bls.bls_peaks`), so a target whose first or last points are
+    left out can get a slightly different answer from findBlsSignal.
+
+    Returns an array of shape (n_targets, 5). Each row is period, t0,
+    depth, duration, snr, as for `findBlsSignal` with the corazon backend.
+    """
+    finite = time[np.isfinite(time)]
+    best = None
+    for period_grid, durs in blsPeriodGrids(finite, bls_durations, minP, maxP,
+                                            min_trans, grid):
+        power, peaks = corbls.bls_peaks(time, flux, period_grid, durs,
+                                        valid=valid,
+                                        oversample=BLS_OVERSAMPLE)
+        if best is None:
+            best, result = power, peaks
+        else:
+            better = power > best
+            best[better] = power[better]
+            result[better] = peaks[better]
+    return result
+
+def blsPeak(bls_power):
+    """
+    Return period, t0, depth, duration and snr at the highest point of
+    a BLS spectrum.
+    """
     index = np.argmax(bls_power.power)
     bls_period = bls_power.period[index]
     bls_t0 = bls_power.transit_time[index]
@@ -279,6 +388,49 @@ def findBlsSignal(time, flux, bls_durations, minP=None, maxP=None, min_trans=3):
     bls_snr = bls_power.depth_snr[index]
     
     return np.array([bls_period, bls_t0, bls_depth, bls_duration, bls_snr])
+
+def blsTopPeaks(bls_power, nPeaks, baseline=None, tol=HARMONIC_TOL,
+                maxOrder=HARMONIC_MAX_ORDER):
+    """
+    Return the nPeaks highest, non harmonically related, peaks of a BLS
+    spectrum.
+
+    The highest point is taken first, then every period within tol of an
+    integer multiple or fraction (up to maxOrder) of it is dropped, and
+    so on. If the baseline (time span of the data, in days) is given, tol
+    is at least HARMONIC_WIDTH times duration/baseline. The first row is
+    always the same as `blsPeak`.
+
+    Returns
+    -----------
+    (n, 5) numpy array of period, t0, depth, duration and snr, strongest
+    first. n can be less than nPeaks if the spectrum runs out of peaks.
+    """
+    period = np.asarray(bls_power.period)
+    power = np.array(bls_power.power, dtype=float)
+    power[~np.isfinite(power)] = -np.inf
+
+    peaks = []
+    while len(peaks) < nPeaks:
+        index = np.argmax(power)
+        if not np.isfinite(power[index]):
+            break
+
+        peaks.append([period[index], bls_power.transit_time[index],
+                      bls_power.depth[index], bls_power.duration[index],
+                      bls_power.depth_snr[index]])
+
+        width = tol
+        if baseline is not None:
+            duration = np.maximum(bls_power.duration, bls_power.duration[index])
+            width = np.maximum(tol, HARMONIC_WIDTH * duration / baseline)
+
+        ratio = np.maximum(period / period[index], period[index] / period)
+        order = np.round(ratio)
+        harmonic = (order <= maxOrder) & (np.abs(ratio / order - 1) < width)
+        power[harmonic] = -np.inf
+
+    return np.array(peaks).reshape(-1, 5)
  
 def simpleSnr(time,flux,results):
     """
@@ -296,8 +448,78 @@ def simpleSnr(time,flux,results):
     return snr
 
    
+class LazyBlsStats(dict):
+    """
+    The output of astropy's BoxLeastSquares.compute_stats, computed the
+    first time it is used.
+
+    Most runs never look at the stats (only `plot_lc_tce` reads
+    transit_times), so identifyTces keeps the data and the peak and
+    leaves the work until a key is read. Extra items, like grid_size,
+    can be set at any time and are never overwritten by the stats.
+
+    Until the stats are computed a reference to time and flux is held.
+    """
+    def __init__(self, time, flux, period, duration, transit_time, **kwargs):
+        dict.__init__(self, **kwargs)
+        self._args = (time, flux, period, duration, transit_time)
+
+    @property
+    def computed(self):
+        return self._args is None
+
+    def compute(self):
+        """Run compute_stats now, if it has not been run yet"""
+        if self._args is not None:
+            time, flux, period, duration, transit_time = self._args
+            bls_stats = BoxLeastSquares(time, flux).compute_stats(period,
+                                                 duration, transit_time)
+            for key, value in bls_stats.items():
+                self.setdefault(key, value)
+            self._args = None
+        return self
+
+    def __missing__(self, key):
+        if self._args is None:
+            raise KeyError(key)
+        return self.compute()[key]
+
+    def get(self, key, default=None):
+        return self.compute().get(key, default)
+
+    def __contains__(self, key):
+        return dict.__contains__(self.compute(), key)
+
+    def __iter__(self):
+        return dict.__iter__(self.compute())
+
+    def __len__(self):
+        return dict.__len__(self.compute())
+
+    def __eq__(self, other):
+        return dict.__eq__(self.compute(), other)
+
+    __hash__ = None
+
+    def __repr__(self):
+        return dict.__repr__(self.compute())
+
+    def keys(self):
+        return dict.keys(self.compute())
+
+    def values(self):
+        return dict.values(self.compute())
+
+    def items(self):
+        return dict.items(self.compute())
+
+    def copy(self):
+        return dict(self.compute())
+
+
 def identifyTces(time, flux, bls_durs_hrs=[1,2,4,8,12], minSnr=3, fracRemain=0.5, \
-                 maxTces=10, minP=None, maxP=None):
+                 maxTces=10, minP=None, maxP=None, bls_backend="astropy",
+                 bls_grid="uniform", bls_workers=1, extraction="iterative"):
     """
     Find highest point in the bls.
     remove that signal, median detrend again
@@ -305,9 +527,29 @@ def identifyTces(time, flux, bls_durs_hrs=[1,2,4,8,12], minSnr=3, fracRemain=0.5
     Stop when less than half the original data set remains.
     Or, when depth of signal is less than snr*running_std 
     
+    bls_backend is passed to `calcBls`.
+
+    bls_grid selects the trial periods, see `blsPeriodGrids`. The number
+    of trial periods searched is stored as stats[i]['grid_size'].
+
+    bls_workers is passed to `calcBls` as workers.
+
+    The stats are `LazyBlsStats`, so compute_stats only runs for signals
+    whose stats are read.
+
+    extraction="topk" searches once and takes the strongest non harmonic
+    peaks of that spectrum (`blsTopPeaks`) in place of searching again
+    after each mask. A candidate whose transits land on points already
+    masked for an earlier signal could have been changed by that mask, so
+    at the first such overlap it goes back to the usual search loop. The
+    stopping conditions and outputs are the same for both modes.
+
     returns period, t0, depth, duration, snr for each signal found.
     """
     
+    if extraction not in ("iterative", "topk"):
+        raise ValueError("Unknown TCE extraction mode %s" % (extraction))
+
     keepLooking = True
     counter = 0
     results = []
@@ -316,11 +558,35 @@ def identifyTces(time, flux, bls_durs_hrs=[1,2,4,8,12], minSnr=3, fracRemain=0.5
     
     t=time.copy()
     f=flux.copy()
+    removed = np.zeros(len(time), dtype=bool)
     
+    def search_once():
+        return calcBls(f, t, bls_durs_day, minP=minP, maxP=maxP,
+                       backend=bls_backend, grid=bls_grid,
+                       workers=bls_workers)
+
+    candidates = []
+    if extraction == "topk":
+        bls_power = search_once()
+        candidates = list(blsTopPeaks(bls_power, maxTces + 2,
+                                      baseline=np.ptp(time)))
+        full_bls = BoxLeastSquares(time, flux)
 
     while keepLooking:
         
-        bls_results = findBlsSignal(t, f, bls_durs_day, minP=minP, maxP=maxP)
+        bls_results = None
+        if len(candidates) > 0:
+            bls_results = candidates.pop(0)
+            in_transit = full_bls.transit_mask(time, bls_results[0],
+                                               bls_results[3]*1.1, bls_results[1])
+            if np.any(in_transit & removed):
+                #Overlaps an earlier signal, search the masked data again
+                candidates = []
+                bls_results = None
+
+        if bls_results is None:
+            bls_power = search_once()
+            bls_results = blsPeak(bls_power)
         #print(bls_results)
         #simple ssnr because the BLS depth snr is acting strangely
         bls_results[4] = simpleSnr(t, f, bls_results)
@@ -328,7 +594,9 @@ def identifyTces(time, flux, bls_durs_hrs=[1,2,4,8,12], minSnr=3, fracRemain=0.5
         
         results.append(bls_results)
         bls = BoxLeastSquares(t,f)
-        bls_stats = bls.compute_stats(bls_results[0], bls_results[3],bls_results[1])
+        bls_stats = LazyBlsStats(t, f, bls_results[0], bls_results[3],
+                                 bls_results[1])
+        bls_stats['grid_size'] = len(bls_power.period)
         stats.append(bls_stats)
         #signal_snr = bls_stats['depth'][0]/bls_stats['depth'
         transit_mask = bls.transit_mask(t, bls_results[0],\
@@ -336,6 +604,8 @@ def identifyTces(time, flux, bls_durs_hrs=[1,2,4,8,12], minSnr=3, fracRemain=0.5
         #plt.figure()
         #plt.plot(t,f,'ko',ms=3)
         
+        removed[np.flatnonzero(~removed)[transit_mask]] = True
+
         t=t[~transit_mask]
         f=f[~transit_mask]
         
@@ -473,21 +743,26 @@ def findPeriodicOutliers(time_days, singleOutlierIndex, precision_days):
     notOutliers = []
 
     outlierTimes = time_days[singleOutliers]
-    diffs = [outlierTimes[i+1] - outlierTimes[i] for i in range(0, len(outlierTimes)-1)]
-    diffs = [round(d, 5) for d in diffs]
+    diffs = np.round(np.diff(outlierTimes), 5)
 
     if len(singleOutliers) >= 4:
-        if len(set(diffs)) == len(diffs):
+        values, counts = np.unique(diffs, return_counts=True)
+        if len(values) == len(diffs):
             possibleTimes = np.array([])
         else:
-            period = max(set(diffs), key = diffs.count) # period = most common difference
-            epoch = outlierTimes[ diffs.index(period) ]
+            period = modalDiff(diffs, values, counts) # period = most common difference
+            epoch = outlierTimes[ np.flatnonzero(diffs == period)[0] ]
             possibleTimes = np.arange(epoch, outlierTimes[-1] + 0.5*period, period)
 
-        notOutliers = []
-        for i in range(len(outlierTimes)):
-            if np.any((abs(possibleTimes - outlierTimes[i]) < precision_days)):
-                notOutliers.append(singleOutliers[i])
+        #Only the comb tooth either side of each outlier can be the closest
+        comb = np.sort(possibleTimes)
+        isPeriodic = np.zeros(len(outlierTimes), dtype=bool)
+        if len(comb) > 0:
+            right = np.clip(np.searchsorted(comb, outlierTimes), 0, len(comb) - 1)
+            left = np.clip(right - 1, 0, len(comb) - 1)
+            isPeriodic = (np.abs(comb[left] - outlierTimes) < precision_days) | \
+                         (np.abs(comb[right] - outlierTimes) < precision_days)
+        notOutliers = list(singleOutliers[isPeriodic])
     
 
     elif len(singleOutliers) == 3:
@@ -500,6 +775,23 @@ def findPeriodicOutliers(time_days, singleOutlierIndex, precision_days):
     return notOutliers
 
 
+def modalDiff(diffs, values, counts):
+    """The most common element of diffs, given its np.unique values and counts
+
+    Ties are broken the way ``max(set(diffs), key=diffs.count)`` breaks
+    them (first in the set's iteration order), so the choice matches the
+    original list based code.
+    """
+    tied = values[counts == counts.max()]
+    if len(tied) == 1:
+        return tied[0]
+
+    tied = set(tied.tolist())
+    for d in set(diffs.tolist()):
+        if d in tied:
+            return d
+
+
 def robustStd(y):
     assert len(y) > 0
     mad = y - np.median(y)
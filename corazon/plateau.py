@@ -45,7 +45,7 @@ def plateau(array, threshold):
     """
 
 
-    arr  = array.astype(np.float32)
+    arr  = array.astype(np.float32, copy=False)
     arr = arr - threshold + 1e-12
     arrPlus = np.roll(arr, 1)
 
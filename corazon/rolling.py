@@ -0,0 +1,298 @@
+# -*- coding: utf-8 -*-
+"""
+Sliding window statistics shared by the detrending and noise rejection
+code in `corazon.planetSearch`.
+
+The functions here replace per-cadence Python loops that called
+`np.median` on a fresh slice for every point. They are written to give
+exactly the same numbers as those loops, including the way the window is
+clamped at the ends of the array.
+"""
+
+from bisect import bisect_left, insort
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+#Windows at least this long use the sorted-window engine. Shorter windows
+#are faster with the vectorised sliding_window_view path.
+SORTED_WINDOW_MIN = 512
+
+#Maximum number of elements materialised at once by the vectorised path
+CHUNK_ELEMENTS = 2**22
+
+
+def running_median(x, length):
+    """Median of every contiguous window of `length` points in `x`.
+
+    Inputs
+    ---------
+    x
+        (1d numpy array) Input data. NaNs propagate, as with `np.median`.
+    length
+        (int) Number of points in each window.
+
+    Returns
+    -----------
+    1d numpy array of length ``len(x) - length + 1``. Element ``j`` is
+    ``np.median(x[j:j+length])``.
+    """
+    x = np.asarray(x)
+    length = int(length)
+    if length < 1:
+        raise ValueError("Window length must be at least 1")
+    if length > len(x):
+        raise ValueError("Window length %i is longer than the data (%i)"
+                         % (length, len(x)))
+
+    if length < SORTED_WINDOW_MIN:
+        return _running_median_vectorised(x, length)
+    return _running_median_sorted(x, length)
+
+
+def _running_median_vectorised(x, length):
+    """Median of all windows using strided views, a block of rows at a time."""
+    windows = sliding_window_view(x, length)
+    nWin = len(windows)
+    step = max(CHUNK_ELEMENTS // length, 1)
+
+    out = np.empty(nWin, dtype=np.median(x[:length]).dtype)
+    for lwr in range(0, nWin, step):
+        upr = min(lwr + step, nWin)
+        out[lwr:upr] = np.median(windows[lwr:upr], axis=1)
+    return out
+
+
+def _running_median_sorted(x, length):
+    """Median of all windows by keeping a sorted copy of the current window.
+
+    Each step removes the point leaving the window and inserts the one
+    entering it with a binary search, so the cost is O(n log w) comparisons
+    plus a memmove of the list. NaNs are counted separately and any window
+    containing one gives a NaN, matching `np.median`.
+    """
+    nWin = len(x) - length + 1
+    isnan = np.isnan(x) if x.dtype.kind == 'f' else np.zeros(len(x), dtype=bool)
+    #Sort NaNs to the top so they never become one of the middle values
+    #of a NaN free window.
+    vals = np.where(isnan, np.inf, x).tolist()
+
+    dtype = np.median(x[:1]).dtype
+    lo = np.empty(nWin, dtype=dtype)
+    hi = np.empty(nWin, dtype=dtype)
+    iLo = (length - 1) // 2
+    iHi = length // 2
+
+    window = sorted(vals[:length])
+    lo[0] = window[iLo]
+    hi[0] = window[iHi]
+    for j in range(1, nWin):
+        del window[bisect_left(window, vals[j-1])]
+        insort(window, vals[j+length-1])
+        lo[j] = window[iLo]
+        hi[j] = window[iHi]
+
+    if iLo == iHi:
+        out = lo
+    else:
+        #Same arithmetic as np.median on an even number of points
+        out = (lo + hi) / 2
+
+    nNan = np.concatenate([[0], np.cumsum(isnan)])
+    hasNan = (nNan[length:] - nNan[:nWin]) > 0
+    if np.any(hasNan):
+        out = out.astype(np.result_type(out, np.float64), copy=False)
+        out[hasNan] = np.nan
+    return out
+
+
+def clamped_median(flux, nPoints):
+    """Median of a window of 2*nPoints centred on each point.
+
+    Near the ends of the array the window is shifted so that it stays
+    inside [0, size), exactly as in Fergal's original loop::
+
+        lwr = max(i-nPoints, 0)
+        upr = min(lwr + 2*nPoints, size)
+        lwr = upr- 2*nPoints
+        offset = np.median(flux[lwr:upr])
+
+    Inputs
+    ---------
+    flux
+        (1d numpy array)
+    nPoints
+        (int) Half width of the window
+
+    Returns
+    -----------
+    1d numpy array of length flux, the median used for each point.
+    """
+    flux = np.asarray(flux)
+    size = len(flux)
+    length = 2 * int(nPoints)
+
+    if size == 0:
+        return np.zeros(0)
+
+    if length > size or length == 0:
+        #Every point sees the same (negative index) slice in the original
+        #loop, so the offset is a constant.
+        lwr = size - length
+        offset = np.median(flux[lwr:size])
+        return np.full(size, offset)
+
+    medians = running_median(flux, length)
+    start = np.clip(np.arange(size) - nPoints, 0, size - length)
+    return medians[start]
+
+
+def running_std(x, length):
+    """NaN aware standard deviation of every window of `length` points.
+
+    Inputs
+    ---------
+    x
+        (1d numpy array) Input data. NaNs are ignored, as with `np.nanstd`.
+    length
+        (int) Number of points in each window.
+
+    Returns
+    -----------
+    1d numpy array of length ``len(x) - length + 1``. Element ``j`` is
+    ``np.nanstd(x[j:j+length])``.
+
+    Notes
+    ----------
+    The windows are strided views on `x`, and `np.nanstd` is applied to a
+    block of them at a time. This gives the same numbers as calling
+    `np.nanstd` on each slice, which a running sum of squares does not.
+    """
+    x = np.asarray(x)
+    length = int(length)
+    if length < 1:
+        raise ValueError("Window length must be at least 1")
+    if length > len(x):
+        raise ValueError("Window length %i is longer than the data (%i)"
+                         % (length, len(x)))
+
+    windows = sliding_window_view(x, length)
+    nWin = len(windows)
+    step = max(CHUNK_ELEMENTS // length, 1)
+
+    out = np.empty(nWin, dtype=np.result_type(x.dtype, np.float16))
+    for lwr in range(0, nWin, step):
+        upr = min(lwr + step, nWin)
+        out[lwr:upr] = np.nanstd(windows[lwr:upr], axis=1)
+    return out
+
+
+def top_n(x, N):
+    """Indices of the N largest elements of x, in increasing order of value.
+
+    Equivalent to ``np.argsort(x)[-N:]`` but uses a partial sort, so only
+    the N selected elements are sorted.
+    """
+    x = np.asarray(x)
+    N = min(int(N), len(x))
+    if N <= 0:
+        return np.zeros(0, dtype=int)
+
+    idx = np.argpartition(x, len(x) - N)[len(x) - N:]
+    return idx[np.argsort(x[idx])]
+
+
+def running_mean(x, length):
+    """Mean of every contiguous window of `length` points in `x`.
+
+    Uses a cumulative sum, so the cost is O(n) whatever the window. The
+    data are centred on their mean first, which keeps the rounding error
+    of the sum small for flux-like data near 1.
+
+    Returns
+    -----------
+    1d numpy array of length ``len(x) - length + 1``.
+    """
+    x = np.asarray(x, dtype=float)
+    length = int(length)
+    if length < 1:
+        raise ValueError("Window length must be at least 1")
+    if length > len(x):
+        raise ValueError("Window length %i is longer than the data (%i)"
+                         % (length, len(x)))
+
+    centre = np.mean(x)
+    csum = np.concatenate([[0], np.cumsum(x - centre)])
+    return (csum[length:] - csum[:-length]) / length + centre
+
+
+def running_biweight(x, length, c=5.0, n_iter=5):
+    """Tukey biweight location of every window of `length` points in `x`.
+
+    Each window starts at its median and is refined n_iter times with
+    weights ``(1 - u**2)**2``, where ``u = (x - location) / (c * MAD)``
+    and the MAD is that of the starting median. Points with ``|u| >= 1``
+    get no weight, so the estimate ignores transits and flares deeper
+    than about c MADs.
+
+    Returns
+    -----------
+    1d numpy array of length ``len(x) - length + 1``.
+    """
+    x = np.asarray(x, dtype=float)
+    length = int(length)
+    if length < 1:
+        raise ValueError("Window length must be at least 1")
+    if length > len(x):
+        raise ValueError("Window length %i is longer than the data (%i)"
+                         % (length, len(x)))
+
+    windows = sliding_window_view(x, length)
+    nWin = len(windows)
+    step = max(CHUNK_ELEMENTS // length, 1)
+
+    out = np.empty(nWin)
+    for lwr in range(0, nWin, step):
+        upr = min(lwr + step, nWin)
+        block = windows[lwr:upr]
+        loc = np.median(block, axis=1)
+        scale = c * np.median(np.abs(block - loc[:, None]), axis=1)
+        scale[scale == 0] = np.inf
+        for i in range(n_iter):
+            u = (block - loc[:, None]) / scale[:, None]
+            w = np.clip(1 - u**2, 0, None)**2
+            loc = np.sum(w * block, axis=1) / np.sum(w, axis=1)
+        out[lwr:upr] = loc
+    return out
+
+
+def clamped_running(running, flux, nPoints):
+    """Apply a running statistic with the window clamping of `clamped_median`.
+
+    Inputs
+    ---------
+    running
+        (callable) ``running(x, length)``, for example `running_mean`
+    flux
+        (1d numpy array)
+    nPoints
+        (int) Half width of the window
+
+    Returns
+    -----------
+    1d numpy array of length flux, the statistic used for each point.
+    """
+    flux = np.asarray(flux)
+    size = len(flux)
+    length = 2 * int(nPoints)
+
+    if size == 0:
+        return np.zeros(0)
+
+    if length > size or length == 0:
+        lwr = max(size - length, 0) if length > 0 else 0
+        return np.full(size, running(flux[lwr:size], size - lwr)[0])
+
+    values = running(flux, length)
+    start = np.clip(np.arange(size) - nPoints, 0, size - length)
+    return values[start]
@@ -29,6 +29,9 @@ for file in filelist[0:num]:
         
     run_pipeline.run_write_one(ticid, sector, outdir, lc_author=lc_author,
                                plot=True, run_tag = run_tag)
+
+#Write out any queued results, then the last batch of metrics
+run_pipeline.finish_run()
     
 
 #%%
@@ -1,14 +1,22 @@
 import corazon.pipeline as pipeline
+import atexit
 from datetime import datetime
-import os
+import io
+import json
 from exovetter import vetters
 import matplotlib.pyplot as plt
 import corazon.gen_lightcurve as genlc
+from corazon import manifest as corazon_manifest
+from corazon import output as out
+from corazon import store
+from corazon.vetter_pool import VetterPool
 #sys.path[2] = '/Users/smullally/Python_Code/lightkurve/lightkurve'
 
 
 def run_write_one(ticid, sector, out_dir, lc_author = 'qlp',local_dir = None,
-               run_tag = None, config_file = None, plot=False):
+               run_tag = None, config_file = None, plot=False,
+               metrics_store = None, output = None, background = None,
+               manifest = None):
     """
     Run the full bls search on a list of ticids stored in a file.
 
@@ -27,6 +35,22 @@ def run_write_one(ticid, sector, out_dir, lc_author = 'qlp',local_dir = None,
         directory name for the location of the data files.
     run_tag : string, optional
         directory name and string to attach to output file names. 
+    metrics_store : corazon.store.MetricsStore, optional
+        where to add the vetting metrics of every TCE. Default is the
+        store "<run_tag>-metrics.sqlite" in out_dir, shared by every
+        target of the run in this process.
+    output : string, optional
+        "files" for a directory of files per target, or "jsonl" for one
+        JSON lines file per process, see corazon.output. Default is the
+        "output" config value.
+    background : bool, optional
+        write the results on a separate thread, so the next target can
+        start. Default is the "background_output" config value.
+    manifest : corazon.manifest.RunManifest, optional
+        skip the target if the manifest has it finished with the same
+        light curve, config, vetters, thresholds and corazon version, and
+        record it once its results are written. If None and the "resume"
+        config value is True, "<run_tag>.manifest.jsonl" in out_dir is used.
 
     Returns
     -------
@@ -44,27 +68,41 @@ def run_write_one(ticid, sector, out_dir, lc_author = 'qlp',local_dir = None,
         print("Not implememted read in config file")
         #config = pipeline.load_config_file()
     
-    vetter_list = load_def_vetter()
+    #Vetters are built once per process and reset between TCEs
+    vetter_list = default_vetter_pool
     thresholds = load_def_thresholds()
     
+    if manifest is None and config.get("resume", False):
+        #Not "<run_tag>-*.jsonl", which out.merge reads as worker output
+        manifest = corazon_manifest.open_manifest(out_dir +
+                                                  "/%s.manifest.jsonl" % (run_tag))
+    key = None
+    if manifest is not None:
+        try:
+            key = corazon_manifest.target_key(
+                lc_key(ticid, sector, lc_author, local_dir,
+                       config.get("lc_key", "stat")),
+                config, vetter_list, thresholds)
+        except OSError:
+            #No light curve file to key on, run it and let it fail
+            key = None
+        if key is not None and manifest.is_done(ticid, sector, key):
+            manifest.skipped += 1
+            return
     
-    target_dir = "/tic%09is%02i/" % (int(ticid), sector)
-    log_name = out_dir + target_dir + "tic%09i-%s.log" % (ticid, run_tag)
-    output_file = out_dir + target_dir + "tic%09i-%s-tcesum.csv" % (ticid, run_tag)
+    if output is None:
+        output = config.get("output", "files")
+    if background is None:
+        background = config.get("background_output", False)
+    writer = out.open_writer(out_dir, run_tag, backend=output,
+                             batch_size=config.get("output_batch", 100),
+                             background=background,
+                             queue_size=config.get("output_queue", 16))
+    #A background write of an earlier target that failed is raised here,
+    #naming that target, rather than failing this one
+    writer.check()
+    record = out.new_record(ticid, sector, run_tag, lc_author)
     
-    if not os.path.exists(out_dir):
-        os.mkdir(out_dir)
-
-    try:
-        os.mkdir(out_dir+target_dir)   
-    except FileExistsError:
-        pass
-    except PermissionError as e:
-        log_obj = open(log_name,'w+')
-        log_obj.write("Permission Error on Target Directory ")
-        log_obj.write(e)
-        log_obj.close()
-        
     try:
         
         lcdata = genlc.hlsp(ticid, sector, author=lc_author,local_dir = local_dir)
@@ -76,48 +114,67 @@ def run_write_one(ticid, sector, out_dir, lc_author = 'qlp',local_dir = None,
                                 vetter_list, thresholds, plot=plot)
         
         if plot:
-            plotfilename = "tic%09i-%s-plot.png" % (ticid, 
-                                                    run_tag)
-            plt.savefig(out_dir + target_dir + plotfilename, bbox_inches='tight')
+            buf = io.BytesIO()
+            plt.savefig(buf, format='png', bbox_inches='tight')
             plt.close()
+            record['plot'] = buf.getvalue()
         
-        output_obj = open(output_file, 'w')
-        for r in result_strings:
-            output_obj.write(r)
-    
-        output_obj.close()
+        record['results'] = list(result_strings)
         
-        #Write TCEs
+        #TCEs, as their json files
         for tce in tce_list:
-            tcefilename = "tic%09i-%02i-%s.json" % (ticid, 
-                                                    int(tce['event']), 
-                                                    run_tag)
-    
-            full_filename = out_dir + target_dir + tcefilename
             tce['lc_author'] = lc_author
-            tce.to_json(full_filename)
+            record['tces'].append(json.loads(tce.to_json(None)))
             
-        #Write metrics    
-        #print(metrics_list)
-        #for i, metric in enumerate(metrics_list):
-        #    metricfilename = "tic%09i-%02i-%s-vetting.json" % (ticid, 
-        #                                            i+1, run_tag)
-        #    full_filename = out_dir + target_dir + metricfilename
-        #    thejson = json.dumps(metric)
-        #    mobj = open(full_filename,'w+')
-        #    mobj.write(thejson)
-        #    mobj.close()
+        #Write metrics, batched with the other targets of the run
+        if metrics_store is None:
+            metrics_store = store.open_store(out_dir + "/%s-metrics.sqlite"
+                                             % (run_tag))
+        writer.submit_for((ticid, sector), metrics_store.add, metrics_list,
+                          tce_list)
  
-
-        log_obj = open(log_name, 'w+')
-        log_obj.write("Success.")
-        log_obj.close()
+        record['status'] = "success"
+        record['log'] = "Success.\n" + vetter_list.report()
 
     except Exception as e:
-        log_obj = open(log_name,'w+')
-        log_obj.write("Failed to create TCEs for TIC %i for Sector %i \n" % (ticid, sector))
-        log_obj.write(str(e))
-        log_obj.close() 
+        record['log'] = "Failed to create TCEs for TIC %i for Sector %i \n" % (ticid, sector) + str(e)
+
+    #Only finished once the results and the metrics are on disk, and not
+    #at all if writing them fails
+    if key is not None and record['status'] == "success":
+        writer.write_then(record, _mark_done, manifest, metrics_store, ticid,
+                          sector, key)
+    else:
+        writer.write(record)
+
+
+def _mark_done(manifest, metrics_store, ticid, sector, key):
+    #The metrics are committed with the store's next batch
+    metrics_store.after_commit(manifest.mark_done, ticid, sector, key)
+
+
+def lc_key(ticid, sector, lc_author, local_dir=None, mode="stat"):
+    """Identify the light curve of a target for the run manifest.
+
+    Local files are keyed with `corazon.manifest.lc_file_key`. Light
+    curves downloaded from MAST are keyed by their product name.
+    """
+    if local_dir is None:
+        return "mast:%s:%i:%i" % (lc_author, int(ticid), int(sector))
+    filename = genlc.get_hlsp_filename(ticid, sector, lc_author)
+    return corazon_manifest.lc_file_key(local_dir + "/" + filename, mode)
+
+
+@atexit.register
+def finish_run():
+    """
+    Write everything run_write_one still holds: the queued and buffered
+    results first, then the metrics stores and run manifests they update.
+    Runs when the process exits, runners can call it sooner.
+    """
+    out.close_writers()
+    store.close_stores()
+    corazon_manifest.close_manifests()
 
 def load_def_config():
     """
@@ -135,12 +192,31 @@ def load_def_config():
         "det_window" : 95,  #window used for detrending
         "noise_window" : 19, #window used for running outlier rejection
         "n_sigma" : 4.5,  #noise/outlier reject sigma
+        "detrender" : "median",  #"median", "box" or "biweight", see corazon.detrend
+        "segment_gap_days" : None,  #Detrend each stretch between longer gaps on its own
+        "detrend_workers" : 1,  #Threads for segmented detrending
+        "float32" : False,  #Keep flux and BLS bins in single precision
+        "vet_workers" : 1,  #TCEs of one target vetted at the same time
+        "vet_executor" : "thread",  #"thread" or "process" pool for vetting
+        "vet_triage" : False,  #Stop vetting a TCE at its first failed threshold
         "max_period_days" : 11,
         "min_period_days" : 0.8,
         "bls_durs_hrs" : [1,2,4,8,12,14],
         "minSnr" : [1],
         "maxTces" : 20,
-        "fracRemain" : 0.7
+        "fracRemain" : 0.7,
+        "bls_backend" : "astropy",  #"astropy" or "corazon", see planetSearch.calcBls
+        "bls_grid" : "uniform",  #BLS trial periods, see planetSearch.blsPeriodGrids
+        "bls_workers" : 1,  #Processes for one BLS search (corazon backend only)
+        "tce_extraction" : "iterative",  #or "topk", see planetSearch.identifyTces
+        "unknown_sector" : "none",  #Gaps for sectors with no gap info: "none", "infer" or "error"
+        "gap_file" : None,  #Optional csv of sector gaps, see corazon.gaps
+        "output" : "files",  #"files" per target or "jsonl" per worker, see corazon.output
+        "output_batch" : 100,  #Targets buffered by the jsonl output
+        "background_output" : False,  #Write results on a separate thread
+        "output_queue" : 16,  #Targets the background writer can fall behind by
+        "resume" : False,  #Skip targets already finished, see corazon.manifest
+        "lc_key" : "stat"  #Detect changed light curves by "stat" or "sha256"
         }
     
     return config
@@ -157,6 +233,10 @@ def load_def_vetter():
     
     return vetter_list
 
+
+#The vetters used by run_write_one, shared by every target in the process
+default_vetter_pool = VetterPool(load_def_vetter)
+
 def load_def_thresholds():
     """
     Load a dictionary of the default threshold values for the vetters.
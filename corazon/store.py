@@ -0,0 +1,221 @@
+# -*- coding: utf-8 -*-
+"""
+A SQLite store of the vetting metrics of every TCE in a run.
+
+Each TCE is one row, keyed and indexed by TIC, sector and event, with the
+scalar metric columns of `disposition.METRIC_COLUMNS`, the flags of
+missing metrics and the disposition and reason given during the run. Rows are buffered and written in one
+transaction per batch, so a run over many targets does not commit once
+per TCE.
+
+The stored metrics can be queried later, or re-dispositioned with new
+thresholds, without reading any light curves::
+
+    python -m corazon.disposition run-metrics.sqlite --thresholds new.json
+"""
+
+import atexit
+import os
+import sqlite3
+import threading
+
+import numpy as np
+
+from corazon.disposition import (ID_COLUMNS, METRIC_COLUMNS, MISSING_COLUMN,
+                                 metrics_table)
+
+#Extra text columns, the disposition given during the run
+RESULT_COLUMNS = ('disposition', 'reason')
+
+#Rows buffered before they are written in one transaction
+DEFAULT_BATCH_SIZE = 500
+
+#Open stores, by absolute path, see `open_store`
+_stores = dict()
+_stores_lock = threading.Lock()
+
+
+class MetricsStore(object):
+    """Batched writer and reader of a SQLite metrics file.
+
+    Inputs
+    ---------
+    path
+        (str) SQLite file, created if it does not exist
+    batch_size
+        (int) Rows buffered before they are written. `flush` or `close`
+        write the rest.
+    """
+    columns = ID_COLUMNS + tuple(METRIC_COLUMNS) + (MISSING_COLUMN,) + \
+        RESULT_COLUMNS
+
+    def __init__(self, path, batch_size=DEFAULT_BATCH_SIZE):
+        self.path = path
+        self.batch_size = batch_size
+        self._rows = []
+        self._callbacks = []
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=60,
+                                     check_same_thread=False)
+        self._create()
+
+    def _create(self):
+        cols = ["ticid INTEGER NOT NULL", "sector INTEGER NOT NULL",
+                "event INTEGER NOT NULL"]
+        cols += ["%s REAL" % c for c in METRIC_COLUMNS]
+        cols += ["%s INTEGER NOT NULL DEFAULT 0" % MISSING_COLUMN]
+        cols += ["%s TEXT" % c for c in RESULT_COLUMNS]
+        with self._conn:
+            self._conn.execute("CREATE TABLE IF NOT EXISTS metrics (%s, "
+                               "PRIMARY KEY (ticid, sector, event))" %
+                               (", ".join(cols)))
+            self._conn.execute("CREATE INDEX IF NOT EXISTS metrics_sector "
+                               "ON metrics (sector)")
+
+    def add(self, metrics_list, tce_list):
+        """Buffer the metrics of the TCEs of one target.
+
+        The disposition and reason are read from each TCE, as set by
+        `pipeline.vet_all_tces`. The rows of a target (TIC and sector)
+        already in the store are replaced by the new ones, so a rerun that
+        finds fewer TCEs leaves no rows from the earlier run.
+        """
+        table = metrics_table(metrics_list, tce_list)
+        table['disposition'] = [t.get('disposition') for t in tce_list]
+        table['reason'] = [t.get('reason') for t in tce_list]
+        self.add_table(table)
+
+    def add_table(self, table):
+        """Buffer every row of a table of columns, replacing any rows of
+        the same targets"""
+        rows = []
+        for row in zip(*[table[c] for c in self.columns]):
+            rows.append(tuple(_to_sql(v) for v in row))
+        targets = set(row[:2] for row in rows)
+        with self._lock:
+            self._rows = [row for row in self._rows
+                          if row[:2] not in targets]
+            self._rows.extend(rows)
+            if len(self._rows) >= self.batch_size:
+                self._write()
+
+    def after_commit(self, func, *args):
+        """Run func(*args) once the rows added so far are committed"""
+        with self._lock:
+            if self._rows:
+                self._callbacks.append((func, args))
+                return
+        func(*args)
+
+    def flush(self):
+        """Write the buffered rows"""
+        with self._lock:
+            self._write()
+
+    def _write(self):
+        if self._rows:
+            self._commit()
+        callbacks, self._callbacks = self._callbacks, []
+        for func, args in callbacks:
+            func(*args)
+
+    def _commit(self):
+        #Rows start with ticid and sector
+        targets = sorted(set(row[:2] for row in self._rows))
+        with self._conn:
+            self._conn.executemany("DELETE FROM metrics WHERE ticid = ? AND "
+                                   "sector = ?", targets)
+            self._conn.executemany("INSERT OR REPLACE INTO metrics (%s) "
+                                   "VALUES (%s)" %
+                                   (", ".join(self.columns),
+                                    ", ".join("?" * len(self.columns))),
+                                   self._rows)
+        self._rows = []
+
+    def query(self, where=None, params=()):
+        """Read rows from the store as a table of columns.
+
+        Inputs
+        ---------
+        where
+            (str) Optional SQL condition, e.g. "sector = ? AND snr > ?"
+        params
+            Values for the ? in where
+
+        Returns
+        -----------
+        dict of column name -> 1d numpy array, ordered by TIC, sector and
+        event. Missing metrics are NaN.
+        """
+        self.flush()
+        sql = "SELECT %s FROM metrics" % (", ".join(self.columns))
+        if where:
+            sql += " WHERE " + where
+        sql += " ORDER BY ticid, sector, event"
+        rows = self._conn.execute(sql, params).fetchall()
+
+        values = list(zip(*rows)) if rows else [()] * len(self.columns)
+        table = dict()
+        for c, v in zip(self.columns, values):
+            if c in ID_COLUMNS or c == MISSING_COLUMN:
+                table[c] = np.array(v, dtype=np.int64)
+            elif c in METRIC_COLUMNS:
+                table[c] = np.array(v, dtype=float)
+            else:
+                table[c] = np.array(["" if x is None else x for x in v],
+                                    dtype=str)
+        return table
+
+    def __len__(self):
+        self.flush()
+        return self._conn.execute("SELECT COUNT(*) FROM metrics").fetchone()[0]
+
+    def close(self):
+        """Write the buffered rows and close the file"""
+        if self._conn is None:
+            return
+        self.flush()
+        self._conn.close()
+        self._conn = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def open_store(path, batch_size=DEFAULT_BATCH_SIZE):
+    """The `MetricsStore` for path, shared by everything in this process.
+
+    Stores opened here are closed, writing any buffered rows, when the
+    process exits or `close_stores` is called.
+    """
+    path = os.path.abspath(path)
+    with _stores_lock:
+        store = _stores.get(path)
+        if store is None:
+            store = MetricsStore(path, batch_size=batch_size)
+            _stores[path] = store
+        return store
+
+
+@atexit.register
+def close_stores():
+    """Close every store opened with `open_store`"""
+    with _stores_lock:
+        for store in _stores.values():
+            store.close()
+        _stores.clear()
+
+
+def _to_sql(value):
+    if isinstance(value, np.integer):
+        return int(value)
+    if isinstance(value, np.floating):
+        value = float(value)
+    if isinstance(value, float) and np.isnan(value):
+        return None
+    if isinstance(value, np.str_):
+        return str(value)
+    return value
@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+"""
+A process wide pool of ready to use vetter sets.
+
+Building the default vetters is slow, because `exovetter.vetters.Lpp`
+loads its reference map when it is constructed. A `VetterPool` builds
+one set with its factory, the first time a set is asked for. Any extra
+sets needed at the same time (e.g. by parallel vetting threads) are
+shallow copies of that first set, so they share the loaded map rather
+than reading it again. A set that is handed back is reset to its just
+constructed state and reused by the next caller.
+
+Vetters only ever replace their attributes when they run, they do not
+change them in place, so restoring the attribute dictionary saved after
+construction is enough to reset them.
+"""
+
+from contextlib import contextmanager
+import copy
+import threading
+
+
+class VetterPool(object):
+    """Hands out clean vetter sets, building as few as possible.
+
+    Inputs
+    ---------
+    factory
+        (callable) Returns a new list of vetters. Defaults to
+        `corazon.pipeline.load_def_vetter`.
+
+    Attributes
+    ----------
+    constructed
+        Number of sets built with factory
+    cloned
+        Number of sets copied from the first one
+    reused
+        Number of times an idle set was handed out again
+    """
+    def __init__(self, factory=None):
+        self.factory = factory
+        self.constructed = 0
+        self.cloned = 0
+        self.reused = 0
+        self._template = None
+        self._idle = []
+        #id(vetter list) -> (vetter list, attributes after construction)
+        self._sets = dict()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Return a list of vetters in their just constructed state"""
+        with self._lock:
+            if self._idle:
+                vetter_list = self._idle.pop()
+                self.reused += 1
+            elif self._template is None:
+                vetter_list = self._build()
+                self._template = vetter_list
+                self._sets[id(vetter_list)] = (vetter_list,
+                                               [dict(vars(v)) for v in vetter_list])
+                self.constructed += 1
+            else:
+                #Clones share the template's attributes, including the map
+                vetter_list = [copy.copy(v) for v in self._template]
+                self._sets[id(vetter_list)] = (vetter_list,
+                                               self._sets[id(self._template)][1])
+                self.cloned += 1
+            snapshot = self._sets[id(vetter_list)][1]
+
+        for v, state in zip(vetter_list, snapshot):
+            v.__dict__.clear()
+            v.__dict__.update(state)
+        return vetter_list
+
+    def release(self, vetter_list):
+        """Hand back a list returned by `acquire`"""
+        with self._lock:
+            entry = self._sets.get(id(vetter_list))
+            if entry is None or entry[0] is not vetter_list:
+                raise ValueError("Vetter list did not come from this pool")
+            self._idle.append(vetter_list)
+
+    @contextmanager
+    def borrow(self):
+        """Context manager around `acquire` and `release`"""
+        vetter_list = self.acquire()
+        try:
+            yield vetter_list
+        finally:
+            self.release(vetter_list)
+
+    def stats(self):
+        """Construction and reuse counts"""
+        return dict(constructed=self.constructed, cloned=self.cloned,
+                    reused=self.reused, idle=len(self._idle))
+
+    def describe(self):
+        """Class and settings of each vetter, from just after construction.
+
+        Only attributes that are numbers, strings or None are included.
+        Builds the first set if there is not one yet.
+        """
+        if self._template is None:
+            self.release(self.acquire())
+        with self._lock:
+            template = self._template
+            snapshot = self._sets[id(template)][1]
+        simple = (bool, int, float, str, type(None))
+        return [[type(v).__module__ + "." + type(v).__name__,
+                 {k: x for k, x in state.items() if isinstance(x, simple)}]
+                for v, state in zip(template, snapshot)]
+
+    def report(self):
+        return ("Vetter pool: %(constructed)i constructed, %(cloned)i cloned, "
+                "%(reused)i reused" % self.stats())
+
+    def clear(self):
+        """Drop every set, the next acquire builds a new one"""
+        with self._lock:
+            self._template = None
+            self._idle = []
+            self._sets = dict()
+
+    def _build(self):
+        factory = self.factory
+        if factory is None:
+            from corazon.pipeline import load_def_vetter
+            factory = load_def_vetter
+        return factory()
+
+    def __getstate__(self):
+        #Send only the factory and the clean template to other processes,
+        #which keep their own counts
+        state = dict(factory=self.factory, template=None, snapshot=None)
+        if self._template is not None:
+            snapshot = self._sets[id(self._template)][1]
+            template = [copy.copy(v) for v in self._template]
+            for v, snap in zip(template, snapshot):
+                v.__dict__ = dict(snap)
+            state['template'] = template
+            state['snapshot'] = snapshot
+        return state
+
+    def __setstate__(self, state):
+        self.__init__(state['factory'])
+        template = state['template']
+        if template is not None:
+            for v, snap in zip(template, state['snapshot']):
+                v.__dict__.clear()
+                v.__dict__.update(snap)
+            self._template = template
+            self._sets[id(template)] = (template, state['snapshot'])
+            self._idle.append(template)
@@ -14,6 +14,12 @@ def capture_options() -> argparse.Namespace:
     parser.add_argument('-i', '--data-input', required=True,
                         help="Where to find input data")
     parser.add_argument('-m', '--mode', type=Mode, required=True)
+    parser.add_argument('--output', choices=['files', 'jsonl'], default='files',
+                        help="A folder of files per TIC, or one JSON lines file per worker")
+    parser.add_argument('--background', action='store_true',
+                        help="Write results on a separate thread while the next TIC runs")
+    parser.add_argument('--resume', action='store_true',
+                        help="Continue a run in an existing output directory, skipping finished TICs")
 
     return parser.parse_args()
 
@@ -21,7 +27,8 @@ def capture_options() -> argparse.Namespace:
 def main() -> None:
     options = capture_options()
     if options.mode is Mode.RunCalculation:
-        test_against_tess_data(options.data_input, options.data_output)
+        test_against_tess_data(options.data_input, options.data_output, options.output,
+                               options.background, options.resume)
 
     elif options.mode is Mode.SyncData:
         sync_data(DATA_HOST, options.data_input)
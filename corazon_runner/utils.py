@@ -50,12 +50,17 @@ def locate_and_resolve_tess_datums(input_dir: str) -> types.GeneratorType:
             else:
                 raise NotImplementedError(line)
 
-def test_against_tess_data(input_dir: str, output_dir: str) -> None:
+def test_against_tess_data(input_dir: str, output_dir: str, output: str = 'files',
+                           background: bool = False, resume: bool = False) -> None:
     import os
     import shutil
     import tempfile
+    from datetime import datetime
 
+    from corazon import manifest as corazon_manifest
+    from corazon import output as corazon_output
     from corazon import run_pipeline
+    from corazon import store
 
     from tess_stars2px import tess_stars2px_function_entry
 
@@ -63,24 +68,54 @@ def test_against_tess_data(input_dir: str, output_dir: str) -> None:
     for entry in locate_and_resolve_tess_datums(input_dir):
         entries.append(entry)
 
-    if os.path.exists(output_dir):
-        raise IOError(f'Output DIR Exists: {output_dir}')
+    if os.path.exists(output_dir) and not resume:
+        raise IOError(f'Output DIR Exists: {output_dir} (use --resume to continue the run)')
 
-    os.makedirs(output_dir)
+    os.makedirs(output_dir, exist_ok=True)
+
+    # One metrics store for the whole run, written in batches
+    metrics_store = store.open_store(os.path.join(output_dir, 'metrics.sqlite'))
+
+    # Finished targets, so a resumed run skips them
+    manifest = corazon_manifest.open_manifest(os.path.join(output_dir, 'manifest.jsonl'))
+
+    # Same tag for every target, even if the run goes past midnight or is resumed
+    day = manifest.meta.get('day')
+    if day is None:
+        day = datetime.now().strftime('crz%m%d%Y')
+        manifest.set_meta(day=day)
+    runs = set()
 
     # import pdb; pdb.set_trace()
     print(f'Light curves found: {len(entries)}')
     print(f'Output Directory: {output_dir}')
-    for idx, entry in enumerate(entries):
-        if idx % 100 == 0:
-            print(f'Chunk: {idx}')
-
-        tic_folder = os.path.join(output_dir, entry.output_dir, str(entry.tic))
-        if not os.path.exists(tic_folder):
-            os.makedirs(tic_folder)
-
-        # tic_folder = os.path.join(output_dir, str(entry.tic))
-        run_pipeline.run_write_one(entry.tic, entry.sector, tic_folder, entry.option, entry.local_dir)
+    try:
+        for idx, entry in enumerate(entries):
+            if idx % 100 == 0:
+                print(f'Chunk: {idx}')
+
+            run_tag = f'{day}_{entry.option}'
+            if output == 'jsonl':
+                # One file per worker per run instead of a folder per TIC
+                tic_folder = os.path.join(output_dir, entry.output_dir)
+                runs.add((tic_folder, run_tag))
+            else:
+                tic_folder = os.path.join(output_dir, entry.output_dir, str(entry.tic))
+                if not os.path.exists(tic_folder):
+                    os.makedirs(tic_folder)
+
+            # tic_folder = os.path.join(output_dir, str(entry.tic))
+            run_pipeline.run_write_one(entry.tic, entry.sector, tic_folder, entry.option, entry.local_dir,
+                                       run_tag=run_tag, metrics_store=metrics_store, output=output,
+                                       background=background, manifest=manifest)
+    finally:
+        # Write out queued results, the last metrics and the manifest, even after an error
+        run_pipeline.finish_run()
+
+    print(f'Skipped, already finished: {manifest.skipped}')
+
+    for folder, run_tag in sorted(runs):
+        print(f'Merged: {corazon_output.merge(folder, run_tag)}')
 
 
 def run_command(cmd: str) -> None:
@@ -0,0 +1,232 @@
+import numpy as np
+import pytest
+from astropy.timeseries import BoxLeastSquares
+
+import corazon.planetSearch as ps
+from corazon import bls
+
+
+def make_transit_lc(period=2.3, t0=1326.1, duration=3/24., depth=3e-3,
+                    noise=1e-3, seed=0):
+    rng = np.random.default_rng(seed)
+    time = np.arange(1325, 1352, 1/48.)
+    flux = noise * rng.standard_normal(len(time))
+    intransit = np.abs((time - t0 + 0.5*period) % period - 0.5*period) < 0.5*duration
+    flux[intransit] -= depth
+    return time, flux
+
+
+def test_autoperiod_matches_astropy():
+    time, flux = make_transit_lc()
+    durs = np.array([1, 2, 4, 8, 12]) / 24.
+    expected = BoxLeastSquares(time, flux).autoperiod(durs, minimum_period=0.8,
+                                                      maximum_period=5,
+                                                      frequency_factor=0.8)
+    periods = bls.autoperiod(time, durs, minimum_period=0.8, maximum_period=5,
+                             frequency_factor=0.8)
+    np.testing.assert_array_equal(periods, expected)
+
+
+@pytest.mark.parametrize("period, t0, duration", [(2.3, 1326.1, 3/24.),
+                                                  (4.1, 1328.7, 7/24.)])
+def test_agrees_with_astropy(period, t0, duration):
+    time, flux = make_transit_lc(period, t0, duration)
+    durs = np.array([1, 2, 4, 8, 12]) / 24.
+
+    ours = ps.findBlsSignal(time, flux, durs, minP=0.8, maxP=5,
+                            backend="corazon")
+    theirs = ps.findBlsSignal(time, flux, durs, minP=0.8, maxP=5,
+                              backend="astropy")
+
+    assert ours[0] == pytest.approx(theirs[0], rel=1e-3)
+    assert ours[1] == pytest.approx(theirs[1], abs=0.02)
+    assert ours[2] == pytest.approx(theirs[2], rel=0.05)
+    assert ours[3] == pytest.approx(theirs[3])
+    assert ours[0] == pytest.approx(period, rel=1e-2)
+
+
+def test_power_spectrum_close_to_astropy():
+    time, flux = make_transit_lc()
+    durs = np.array([1, 2, 4]) / 24.
+    periods = bls.autoperiod(time, durs, minimum_period=1, maximum_period=3)
+
+    ours = bls.bls_power(time, flux, periods, durs, oversample=10)
+    theirs = BoxLeastSquares(time, flux).power(periods, durs, oversample=10)
+
+    #The engines only differ in how they wrap the phase, which changes
+    #the spectrum at a minority of periods.
+    same = np.isclose(ours.power, theirs.power, rtol=1e-9)
+    assert np.mean(same) > 0.8
+    assert np.argmax(ours.power) == np.argmax(theirs.power)
+
+
+def test_unknown_backend():
+    time, flux = make_transit_lc()
+    with pytest.raises(ValueError):
+        ps.calcBls(flux, time, [0.1], minP=1, maxP=2, backend="nope")
+
+
+@pytest.mark.skipif(bls.njit is None, reason="numba is not installed")
+@pytest.mark.parametrize("objective", ["likelihood", "snr"])
+def test_kernel_matches_numpy(monkeypatch, objective):
+    time, flux = make_transit_lc()
+    durs = np.array([1, 2, 4, 8]) / 24.
+    periods = bls.autoperiod(time, durs, minimum_period=0.8, maximum_period=5)
+
+    ours = bls.bls_power(time, flux, periods, durs, objective=objective)
+    monkeypatch.setattr(bls, "USE_KERNEL", False)
+    numpy = bls.bls_power(time, flux, periods, durs, objective=objective)
+
+    for name in ("power", "depth", "duration", "transit_time"):
+        np.testing.assert_allclose(ours[name], numpy[name], rtol=1e-9)
+
+
+@pytest.mark.parametrize("kernel", [True, False])
+def test_batch_matches_single_target(monkeypatch, kernel):
+    if kernel and bls.njit is None:
+        pytest.skip("numba is not installed")
+    monkeypatch.setattr(bls, "USE_KERNEL", kernel)
+    durs = np.array([1, 2, 4]) / 24.
+    lcs = [make_transit_lc(period=p, seed=i)
+           for i, p in enumerate([1.7, 2.3, 2.9])]
+    time = lcs[0][0]
+    flux = np.array([lc[1] for lc in lcs + [lcs[0]]])
+    valid = np.ones(flux.shape, dtype=bool)
+    valid[1, 300:400] = False
+    valid[3] = False
+    flux[2, 50] = np.nan
+
+    peaks = ps.findBlsSignalBatch(time, flux, durs, valid=valid, minP=1,
+                                  maxP=3)
+
+    assert peaks.shape == (4, 5)
+    for i in range(3):
+        use = valid[i] & np.isfinite(flux[i])
+        single = ps.findBlsSignal(time[use], flux[i, use], durs, minP=1,
+                                  maxP=3, backend="corazon")
+        np.testing.assert_allclose(peaks[i], single, rtol=1e-9)
+    assert np.all(np.isnan(peaks[3]))
+
+
+def test_duty_cycle_grid_is_smaller():
+    time, flux = make_transit_lc()
+    durs = np.array([1, 2, 4, 8, 12]) / 24.
+    uniform = ps.blsPeriodGrids(time, durs, 0.8, 10, grid="uniform")
+    duty = ps.blsPeriodGrids(time, durs, 0.8, 10, grid="duty_cycle")
+    per_dur = ps.blsPeriodGrids(time, durs, 0.8, 10, grid="per_duration")
+
+    n_uniform = len(uniform[0][0])
+    assert len(duty[0][0]) < n_uniform / 3
+    assert len(per_dur) == len(durs)
+    #Coarser grids for longer durations
+    sizes = [len(p) for p, d in per_dur]
+    assert sizes == sorted(sizes, reverse=True)
+    for periods, d in duty + per_dur:
+        assert periods[0] == pytest.approx(0.8)
+        assert periods[-1] == pytest.approx(10)
+
+
+@pytest.mark.parametrize("grid", ["uniform", "duty_cycle", "per_duration"])
+def test_default_minimum_period(grid):
+    time, flux = make_transit_lc()
+    durs = np.array([1, 2, 4, 8, 12]) / 24.
+    spectrum = ps.calcBls(flux, time, durs, minP=None, maxP=4, grid=grid)
+
+    #Twice the longest duration on the grid, and per_duration has a grid
+    #for each duration
+    longest = durs[0] if grid == "per_duration" else durs[-1]
+    assert np.min(spectrum.period) == pytest.approx(2 * longest)
+    assert ps.blsPeak(spectrum)[0] == pytest.approx(2.3, rel=1e-2)
+
+
+@pytest.mark.parametrize("period, t0, duration", [(1.13, 1325.4, 1.5/24.),
+                                                  (3.71, 1327.9, 4/24.),
+                                                  (8.2, 1330.3, 9/24.)])
+def test_duty_cycle_grid_recovery(period, t0, duration):
+    time, flux = make_transit_lc(period, t0, duration, depth=2e-3)
+    durs = np.array([1, 2, 4, 8, 12]) / 24.
+
+    sizes = dict()
+    for grid in ("uniform", "duty_cycle", "per_duration"):
+        spectrum = ps.calcBls(flux, time, durs, minP=0.8, maxP=10, grid=grid)
+        found = ps.blsPeak(spectrum)
+        sizes[grid] = len(spectrum.period)
+
+        assert found[0] == pytest.approx(period, rel=1e-2)
+        phase = (found[1] - t0 + 0.5*period) % period - 0.5*period
+        assert abs(phase) < 0.5 * duration
+
+    assert sizes["duty_cycle"] < sizes["uniform"] / 3
+    assert sizes["per_duration"] < sizes["uniform"]
+
+
+def test_parallel_matches_serial():
+    time, flux = make_transit_lc()
+    durations = np.array([1, 2, 4]) / 24.
+    periods = bls.autoperiod(time, durations, 0.5, 10, frequency_factor=0.8)
+
+    serial = bls.bls_power(time, flux, periods, durations)
+    parallel = bls.parallel_bls_power(time, flux, periods, durations,
+                                       workers=2)
+    for key in ["period", "power", "depth", "duration", "transit_time",
+                "depth_snr"]:
+        np.testing.assert_array_equal(parallel[key], serial[key])
+
+    with pytest.raises(ValueError):
+        ps.calcBls(flux, time, durations, minP=0.5, maxP=10, workers=2)
+
+
+def test_identify_tces_topk(monkeypatch):
+    time, flux = make_transit_lc(period=3.1, t0=1325.4)
+    _, planet2 = make_transit_lc(period=7.3, t0=1327.0, duration=4/24.,
+                                 depth=4e-3, noise=0)
+    flux = flux + planet2
+
+    calls = []
+    calcBls = ps.calcBls
+    monkeypatch.setattr(ps, "calcBls",
+                        lambda *a, **k: calls.append(1) or calcBls(*a, **k))
+
+    kwargs = dict(bls_durs_hrs=[2, 4], minP=0.8, maxP=8, maxTces=4,
+                  minSnr=1, bls_backend="corazon")
+    expected, expected_stats = ps.identifyTces(time, flux, **kwargs)
+    n_iterative = len(calls)
+    del calls[:]
+    results, stats = ps.identifyTces(time, flux, extraction="topk", **kwargs)
+
+    assert len(calls) < n_iterative
+    assert results.shape == expected.shape
+    assert len(stats) == len(expected_stats)
+    np.testing.assert_allclose(results[:2, 0], expected[:2, 0], rtol=1e-3)
+    assert "transit_times" in stats[0]
+
+    with pytest.raises(ValueError):
+        ps.identifyTces(time, flux, extraction="nope")
+
+
+@pytest.mark.parametrize("backend", ["astropy", "corazon"])
+def test_float32_tces_match_float64(backend):
+    time, flux = make_transit_lc(period=3.7, t0=1326.9, duration=4/24.,
+                                 depth=2e-3)
+    flux = flux + 1 + 2e-3 * np.sin(2*np.pi * time / 9.)
+    qflags = np.zeros(len(time), dtype=int)
+
+    tces = []
+    for float32 in [False, True]:
+        good_time, good_flux = ps.clean_timeseries(time, flux, qflags, 65, 27,
+                                                   4.5, 1, float32=float32)
+        assert good_flux.dtype == (np.float32 if float32 else np.float64)
+        assert good_time.dtype == np.float64
+        results, stats = ps.identifyTces(good_time, good_flux,
+                                         bls_durs_hrs=[2, 4, 8], minP=0.8,
+                                         maxP=8, maxTces=1,
+                                         bls_backend=backend)
+        tces.append(results[0])
+
+    tce64, tce32 = tces
+    assert tce32[0] == pytest.approx(tce64[0], rel=1e-4)  #period
+    assert tce32[1] == pytest.approx(tce64[1], abs=1e-3)  #t0
+    assert tce32[2] == pytest.approx(tce64[2], rel=1e-4)  #depth
+    assert tce32[3] == tce64[3]  #duration
+    assert tce32[4] == pytest.approx(tce64[4], rel=1e-4)  #snr
+    assert tce64[0] == pytest.approx(3.7, rel=1e-2)
@@ -0,0 +1,134 @@
+import numpy as np
+import pytest
+
+from corazon import detrend
+from corazon import rolling
+import corazon.planetSearch as ps
+
+
+def make_lc(seed=0):
+    rng = np.random.default_rng(seed)
+    time = np.arange(1325, 1352, 1/48.)
+    flux = 1 + 5e-3 * np.sin(2*np.pi * time / 10.)
+    flux += 1e-3 * rng.standard_normal(len(time))
+    return time, flux
+
+
+def loop_clamped(stat, flux, nPoints):
+    size = len(flux)
+    out = np.zeros(size)
+    for i in range(size):
+        lwr = min(max(i - nPoints, 0), size - 2*nPoints)
+        out[i] = stat(flux[lwr:lwr + 2*nPoints])
+    return out
+
+
+def biweight(x, c=5.0, n_iter=5):
+    loc = np.median(x)
+    scale = c * np.median(np.abs(x - loc))
+    for i in range(n_iter):
+        u = (x - loc) / scale
+        w = np.where(np.abs(u) < 1, (1 - u**2)**2, 0)
+        loc = np.sum(w * x) / np.sum(w)
+    return loc
+
+
+def test_median_is_median_detrend():
+    time, flux = make_lc()
+    np.testing.assert_array_equal(detrend.detrend(time, flux, 65),
+                                  ps.median_detrend(flux, 65))
+
+
+@pytest.mark.parametrize("method, stat", [("box", np.mean),
+                                          ("biweight", biweight)])
+def test_trends_match_loop(method, stat):
+    time, flux = make_lc()
+    expected = loop_clamped(stat, flux, 20)
+    trend = detrend.get_detrender(method)(time, flux, 20)
+    np.testing.assert_allclose(trend, expected, rtol=1e-12)
+
+
+def test_gap_is_not_used():
+    time, flux = make_lc()
+    gap = np.zeros(len(time), dtype=bool)
+    gap[300:320] = True
+    spiked = flux.copy()
+    spiked[gap] += 1
+
+    for method in sorted(detrend.DETRENDERS):
+        det = detrend.detrend(time, spiked, 65, gap=gap, method=method)
+        ref = detrend.detrend(time[~gap], flux[~gap], 65, method=method)
+        np.testing.assert_allclose(det[~gap], ref)
+        assert np.all(det[gap] > 0.5)
+
+
+def test_unknown_detrender():
+    time, flux = make_lc()
+    with pytest.raises(ValueError):
+        detrend.detrend(time, flux, 65, method="nope")
+
+
+def test_clean_timeseries_detrender():
+    time, flux = make_lc()
+    qflags = np.zeros(len(time), dtype=int)
+    for method in sorted(detrend.DETRENDERS):
+        good_time, good_flux = ps.clean_timeseries(time, flux, qflags, 65, 27,
+                                                   4.5, 99,
+                                                   unknown_sector="none",
+                                                   detrender=method)
+        assert len(good_time) == len(good_flux) > 0.9 * len(time)
+        assert np.std(good_flux) < 1.5e-3
+
+
+def test_running_mean_short_data():
+    x = np.arange(5.)
+    np.testing.assert_array_equal(rolling.clamped_running(rolling.running_mean,
+                                                          x, 10),
+                                  np.full(5, 2.))
+
+
+def make_gappy_lc():
+    time, flux = make_lc()
+    #An orbit gap with an offset across it, and a second sector
+    keep = (time < 1338) | (time > 1339.5)
+    flux[time > 1339] += 0.01
+    time2, flux2 = make_lc(seed=1)
+    return (np.concatenate([time[keep], time2 + 30]),
+            np.concatenate([flux[keep], flux2]))
+
+
+def test_segments():
+    time, flux = make_gappy_lc()
+    bounds = detrend.segment_bounds(time)
+    assert len(bounds) == 4
+    assert np.all(time[bounds[1:-1]] - time[bounds[1:-1] - 1] > 0.5)
+
+    expected = np.concatenate([detrend.detrend(time[a:b], flux[a:b], 65)
+                               for a, b in zip(bounds[:-1], bounds[1:])])
+    for workers in [1, 3]:
+        np.testing.assert_array_equal(
+            detrend.detrend_segments(time, flux, 65, workers=workers),
+            expected)
+
+    #Pieces cut at arbitrary points are regrouped into the same segments
+    cuts = [0, 17, 500, 1400, 1401, len(time)]
+    chunks = ((time[a:b], flux[a:b]) for a, b in zip(cuts[:-1], cuts[1:]))
+    streamed = list(detrend.stream_detrend(chunks, 65, workers=2))
+    assert len(streamed) == 3
+    np.testing.assert_array_equal(np.concatenate([t for t, f in streamed]),
+                                  time)
+    np.testing.assert_array_equal(np.concatenate([f for t, f in streamed]),
+                                  expected)
+
+    with pytest.raises(ValueError):
+        detrend.detrend_segments(time[::-1], flux, 65)
+
+
+def test_clean_timeseries_segments():
+    time, flux = make_gappy_lc()
+    qflags = np.zeros(len(time), dtype=int)
+    good_time, good_flux = ps.clean_timeseries(time, flux, qflags, 65, 27,
+                                               4.5, 99, unknown_sector="none",
+                                               segment_gap=0.5, workers=2)
+    #The offset across the orbit gap is removed
+    assert np.std(good_flux) < 1.5e-3
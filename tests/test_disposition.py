@@ -0,0 +1,101 @@
+import json
+import warnings
+
+import numpy as np
+
+from corazon import disposition
+from corazon.metrics import VetterMetrics
+
+with warnings.catch_warnings():
+    #lightkurve warns about optional dependencies on import
+    warnings.simplefilter("ignore")
+    import corazon.pipeline as pipe
+
+THRESHOLDS = {'snr': 1, 'norm_lpp': 2.0, 'tp_cover': 0.6, 'oe_sigma': 3,
+              'sweet': 3}
+
+
+def random_run(n, seed=0):
+    rng = np.random.default_rng(seed)
+    metrics_list = []
+    tce_list = []
+    for i in range(n):
+        amp = np.zeros((3, 3))
+        amp[:, -1] = rng.uniform(0, 3.5, size=3)
+        metrics_list.append(VetterMetrics(snr=rng.uniform(0.8, 20),
+                                          norm_lpp=rng.uniform(0, 2.5),
+                                          raw_lpp=rng.uniform(0, 1),
+                                          oe_sigma=rng.uniform(0, 4),
+                                          odd_depth=(1e-3, 1e-4),
+                                          even_depth=(2e-3, 1e-4),
+                                          tp_cover=rng.uniform(0.4, 1),
+                                          sweet={'amp': amp}))
+        tce_list.append({'target': "TIC %i" % (1000 + i // 3),
+                         'sector': 14, 'event': "%i" % (i % 3 + 1)})
+    return metrics_list, tce_list
+
+
+def test_dispose_matches_get_disposition():
+    metrics_list, tce_list = random_run(500)
+    table = disposition.metrics_table(metrics_list, tce_list)
+    disp, reason = disposition.dispose(table, THRESHOLDS)
+
+    expected = [pipe.get_disposition(m, THRESHOLDS) for m in metrics_list]
+    assert list(disp) == [e[0] for e in expected]
+    assert list(reason) == [e[1] for e in expected]
+    assert len(set(reason)) > 10
+    np.testing.assert_array_equal(table['ticid'][:4], [1000, 1000, 1000, 1001])
+    np.testing.assert_array_equal(table['event'][:4], [1, 2, 3, 1])
+
+
+def test_not_computed_never_fails():
+    m = VetterMetrics(snr=0.5, oe_sigma=10)
+    m.not_computed = ('norm_lpp', 'raw_lpp', 'tp_cover', 'sweet')
+    table = disposition.metrics_table([m], [{'target': "TIC 1",
+                                             'sector': 1, 'event': "1"}])
+    assert np.isnan(table['sweet_at'][0])
+    disp, reason = disposition.dispose(table, THRESHOLDS)
+    assert disp[0] == "FAIL"
+    assert reason[0] == "-LowSNR--OddEvenDetected-"
+
+
+def test_missing_metrics_fail():
+    m = VetterMetrics(snr=5, norm_lpp=0.1)
+    m.not_computed = ('oe_sigma',)
+    skipped = VetterMetrics(snr=5, oe_sigma=1, tp_cover=0.9,
+                            sweet={'amp': np.zeros((3, 3))})
+    skipped.not_computed = ('norm_lpp',)
+    metrics_list = [m, skipped]
+    table = disposition.metrics_table(metrics_list, [{'target': "TIC 1",
+                                                      'sector': 1,
+                                                      'event': "1"}] * 2)
+    disp, reason = disposition.dispose(table, THRESHOLDS)
+
+    assert list(disp) == ["FAIL", "PASS"]
+    assert reason[0] == "-Missing_tp_cover--Missing_sweet-"
+    expected = [pipe.get_disposition(m, THRESHOLDS) for m in metrics_list]
+    assert list(zip(disp, reason)) == expected
+
+
+def test_redisposition_cli(tmp_path, capsys):
+    metrics_list, tce_list = random_run(30, seed=2)
+    path = str(tmp_path / "metrics.npz")
+    disposition.save_table(path, disposition.metrics_table(metrics_list,
+                                                           tce_list))
+
+    #Thresholds so loose that everything passes
+    loose = tmp_path / "loose.json"
+    loose.write_text(json.dumps({'snr': 0, 'norm_lpp': 10, 'tp_cover': 0,
+                                 'oe_sigma': 10, 'sweet': 10}))
+    out = tmp_path / "out.csv"
+    disposition.main([path, "--thresholds", str(loose), "--out", str(out)])
+
+    lines = out.read_text().splitlines()
+    assert lines[0] == "ticid,sector,event,disposition,reason"
+    assert lines[1] == "1000,14,1,PASS,"
+    assert len(lines) == 31
+    assert "30 PASS, 0 FAIL" in capsys.readouterr().err
+
+    table = disposition.redisposition(path, THRESHOLDS)
+    expected = [pipe.get_disposition(m, THRESHOLDS)[0] for m in metrics_list]
+    assert list(table['disposition']) == expected
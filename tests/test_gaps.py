@@ -0,0 +1,134 @@
+import numpy as np
+import pytest
+
+from corazon import gaps
+import corazon.planetSearch as ps
+
+
+def reference_gaps(time, sector):
+    """The original hand written version, kept as a reference.
+
+    TESS produces quality flags, but  does not populate the FFIs with them.
+    Instead we have to look the up in the data release notes.
+
+    Based on the Data release notes, but modified by hand based on
+    inspection of Wasp 126
+
+    Inputs
+    ---------
+    time
+        (1d np array) Array of TJDs for the data. See `extractlc.loadSingleSector`.
+    sector
+        (int)
+
+    Returns
+    -----------
+    1d boolean np array of length time
+    """
+    gaps = np.zeros_like(time, dtype=bool)
+
+    if sector == 1:
+        # See page 2 of
+        #https://archive.stsci.edu/missions/tess/doc/tess_drn/tess_sector_01_drn01_v01.pdf
+        gaps |= (time <= 1325.61)
+        gaps |= (1338.52153 <= time) & (time <= 1339.65310)  #Inter orbit gap
+        gaps |= (1346.95 <= time) & (time <= 1349.75)  #See DRN 1 p3
+        gaps |= (time >= 1352.92)  #End of sector usually bad.
+    elif sector == 2:
+        gaps |= (1367.15347 <= time) & (time <= 1368.59406)  #
+    elif sector == 3:
+        gaps |= (1381.1 <= time) & (time <= 1385.89663)  #Pre "science start"
+        gaps |= (1394.47997 <= time) & (time <= 1395.80497)  #apears to be bad??
+        gaps |= (1395.47997 <= time) & (time <= 1396.60497)  #Inter orbit gap
+        gaps |= (1406.2 <= time) & (time <= 1409.38829)  #Post science
+    elif sector == 4:
+        #The bad guide star data may still be usable. Need to check
+        gaps |= (1410.89974 <= time) & (time <= 1413.26468)  #Bad Guide star
+#        gaps |= (1418.53691 <= time) & (time <= 1421.86)  #Instr. Anom.
+#        gaps |= (1422.95 <= time) & (time <= 1424.54897)  #Inter orbit gap
+        gaps |= (1418.53691 <= time) & (time <= 1424.54897)
+        gaps |= (1436.0 <= time) & (time <= 1439.8)  #Not sure what this is
+    elif sector == 5:
+        gaps |= (1450.01 <= time) & (time <=  1451.81)  #Inter orbit gap
+        #I don't think this means the data is generally bad
+        gaps |= (1463.55 <= time) & (time <= 1464.40056)  #Camera 1 guiding
+    elif sector == 6:
+        gaps |= (1477.0 <= time) & (time <= 1478.41)  #inter orbit gap
+        gaps |= (1463.6 <= time) & (time <= 1468.26998)  #before beginning of 6
+    elif sector == 7:
+        #gaps |= (1517 <= time) & (time <= 1491.62) # orbit range
+        gaps |= (1502.5 <= time) & (time <= 1505.01) #inter sector gap
+    elif sector == 14:
+        gaps |= (1696.2 <= time) & (time <= 1697.2) #inter sector gap
+        #gaps |= gaps
+    elif sector == 15:
+        gaps |= (1723.25 <= time) & (time <= 1725.6)
+        gaps |= (1736.01 <= time)
+    elif sector == 16:
+        gaps |= (1738.65 >= time) 
+        gaps |= (time >= 1763.31) # orbit range
+        gaps |= (1750.25 <= time) & (time <= 1751.659) #inter sector gap
+    elif sector == 26 :
+        gaps |= (2010.26209 >= time)
+        gaps |= (time >= 2035.1343)
+        gaps |= (2021.482 <= time) & (time <= 2023.28936)        
+
+#        gaps |= (<= time) & (time <= )  #
+
+    else:
+        raise ValueError("No gap info available for sector %i" %(sector))
+
+    return gaps
+    
+    
+
+
+@pytest.mark.parametrize("sector", [1, 2, 3, 4, 5, 6, 7, 14, 15, 16, 26])
+def test_table_matches_reference(sector):
+    rng = np.random.default_rng(sector)
+    time = np.sort(rng.uniform(1300, 2050, 200000))
+    #Include the range ends themselves, both ends are in the gap
+    table = gaps.load_gap_table()
+    time = np.concatenate([time, table.intervals[sector].ravel(), [np.nan]])
+
+    np.testing.assert_array_equal(ps.loadGapInfoBySector(time, sector),
+                                  reference_gaps(time, sector))
+
+
+def test_unknown_sector():
+    time = np.concatenate([np.arange(2500, 2512, 1/48.),
+                           np.arange(2513, 2525, 1/48.)])
+    with pytest.raises(ValueError):
+        ps.loadGapInfoBySector(time, 40)
+    assert not np.any(ps.loadGapInfoBySector(time, 40, unknown_sector="none"))
+
+    inferred = ps.loadGapInfoBySector(time, 40, unknown_sector="infer")
+    last = time[time < 2512].max()
+    expected = (time >= last - 0.5) & (time <= 2513 + 0.5)
+    np.testing.assert_array_equal(inferred, expected)
+
+    with pytest.raises(ValueError):
+        ps.loadGapInfoBySector(time, 40, unknown_sector="nope")
+
+
+def test_user_gap_file(tmpdir):
+    path = str(tmpdir.join("gaps.csv"))
+    with open(path, "w") as fp:
+        fp.write("# version: test\nsector,start,end,note\n")
+        fp.write("1,1330,1331,replaced\n40,2505,2506,\n")
+
+    table = gaps.gap_table(path)
+    assert table.version == "1+test"
+    np.testing.assert_array_equal(table.intervals[1], [[1330], [1331]])
+    assert 2 in table
+
+    time = np.arange(2500, 2510, 0.25)
+    np.testing.assert_array_equal(
+        ps.loadGapInfoBySector(time, 40, gap_file=path),
+        (time >= 2505) & (time <= 2506))
+
+
+def test_merge_intervals():
+    merged = gaps.merge_intervals([(5, 6), (1, 3), (2, 4), (4.5, 4.6),
+                                   (7, 6)])
+    np.testing.assert_array_equal(merged, [[1, 4.5, 5], [4, 4.6, 6]])
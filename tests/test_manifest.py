@@ -0,0 +1,232 @@
+import os
+import warnings
+
+import pytest
+
+from corazon import manifest, output, store
+from corazon.metrics import VetterMetrics
+from corazon.vetter_pool import VetterPool
+
+with warnings.catch_warnings():
+    #lightkurve warns about optional dependencies on import
+    warnings.simplefilter("ignore")
+    import corazon.run_pipeline as rp
+
+from exovetter import vetters
+
+
+def test_lc_file_key(tmp_path):
+    path = tmp_path / "lc.fits"
+    path.write_bytes(b"flux")
+    stat = manifest.lc_file_key(str(path))
+    sha = manifest.lc_file_key(str(path), mode="sha256")
+
+    os.utime(path, ns=(1, 1))
+    assert manifest.lc_file_key(str(path)) != stat
+    assert manifest.lc_file_key(str(path), mode="sha256") == sha
+    path.write_bytes(b"FLUX")
+    assert manifest.lc_file_key(str(path), mode="sha256") != sha
+    with pytest.raises(ValueError):
+        manifest.lc_file_key(str(path), mode="nope")
+
+
+def test_target_key():
+    pool = VetterPool(lambda: [vetters.OddEven(), vetters.Sweet()])
+    config = rp.load_def_config()
+    thresholds = rp.load_def_thresholds()
+    key = manifest.target_key("stat:1-2", config, pool, thresholds)
+
+    #Using the vetters does not change their settings
+    with pool.borrow() as vetter_list:
+        vetter_list[0].oe_sigma = 2.0
+        vetter_list[0].period = 3.0
+    assert manifest.target_key("stat:1-2", dict(config), pool,
+                               thresholds) == key
+    #Nor do settings that do not change the results
+    assert manifest.target_key("stat:1-2",
+                               dict(config, vet_workers=8, output="jsonl",
+                                    background_output=True, resume=True),
+                               pool, thresholds) == key
+
+    changed = [manifest.target_key("stat:1-3", config, pool, thresholds),
+               manifest.target_key("stat:1-2", dict(config, n_sigma=4),
+                                   pool, thresholds),
+               manifest.target_key("stat:1-2", config, pool,
+                                   dict(thresholds, snr=2)),
+               manifest.target_key("stat:1-2", config,
+                                   VetterPool(lambda: [vetters.OddEven(0.2),
+                                                       vetters.Sweet()]),
+                                   thresholds),
+               manifest.target_key("stat:1-2", config, pool, thresholds,
+                                   version="9.9")]
+    assert key not in changed
+    assert len(set(changed)) == len(changed)
+
+
+def test_manifest_persists(tmp_path):
+    path = str(tmp_path / "manifest.jsonl")
+    man = manifest.RunManifest(path, batch_size=2)
+    man.set_meta(day="crz01012024")
+    man.mark_done(1, 14, "a")
+    assert man.is_done(1, 14, "a")
+    assert not man.is_done(1, 14, "b")
+    man.mark_done(2, 14, "a")
+    man.mark_done(3, 14, "a")
+    #A crash before the last line was written, and one cut short
+    with open(path, "a") as fobj:
+        fobj.write('{"ticid": 4, "sec')
+
+    again = manifest.RunManifest(path)
+    assert len(again) == 2
+    assert again.is_done(2, 14, "a") and not again.is_done(3, 14, "a")
+    assert again.meta == {"day": "crz01012024"}
+
+
+@pytest.fixture
+def fake_targets(tmp_path, monkeypatch):
+    """Light curve files for TICs 1 and 2 in sector 14, and a search
+    that records the TICs it is run on"""
+    import astropy.units as u
+    from exovetter import const
+    from exovetter import tce as TCE
+
+    calls = []
+
+    def fake_search(ticid, sector, lcdata, config, vetter_list, thresholds,
+                    plot=False):
+        calls.append(ticid)
+        tce = TCE.Tce(period=2.3*u.day, epoch=1326.1*u.day,
+                      depth=2e-3*const.frac_amp, duration=4/48.*u.day,
+                      epoch_offset=const.string_to_offset['btjd'], snr=10,
+                      target="TIC %i" % ticid, sector=sector, event="1",
+                      disposition="PASS", reason="")
+        return [tce], ["line\n"], [VetterMetrics(snr=10)]
+
+    monkeypatch.setattr(rp.genlc, "hlsp", lambda *a, **k: None)
+    monkeypatch.setattr(rp.pipeline, "search_and_vet_one", fake_search)
+    pool = VetterPool(lambda: [vetters.OddEven()])
+    monkeypatch.setattr(rp, "default_vetter_pool", pool)
+
+    lc_dir = tmp_path / "lcs"
+    lc_dir.mkdir()
+    for ticid in (1, 2):
+        (lc_dir / rp.genlc.get_hlsp_filename(ticid, 14, "tess-spoc")
+         ).write_bytes(b"flux")
+    return lc_dir, calls
+
+
+def test_run_write_one_resumes(tmp_path, monkeypatch, fake_targets):
+    lc_dir, calls = fake_targets
+    out_dir = str(tmp_path / "out")
+    path = str(tmp_path / "manifest.jsonl")
+    man = manifest.RunManifest(path)
+
+    def run(ticid, output="jsonl"):
+        rp.run_write_one(ticid, 14, out_dir, lc_author="tess-spoc",
+                         local_dir=str(lc_dir), run_tag="t", output=output,
+                         manifest=man)
+
+    run(1)
+    run(2)
+    #Not finished until the buffered results are written
+    assert len(man) == 0
+    rp.finish_run()
+    assert len(man) == 2
+
+    run(1)
+    run(2, output="files")
+    assert calls == [1, 2]
+    assert man.skipped == 2
+
+    #A new light curve file, or a new config, is run again
+    os.utime(lc_dir / rp.genlc.get_hlsp_filename(2, 14, "tess-spoc"),
+             ns=(1, 1))
+    run(1)
+    run(2)
+    assert calls == [1, 2, 2]
+
+    config = rp.load_def_config()
+    monkeypatch.setattr(rp, "load_def_config",
+                        lambda: dict(config, n_sigma=3))
+    run(1, output="files")
+    assert calls == [1, 2, 2, 1]
+    rp.finish_run()
+
+
+def test_merge_with_manifest(tmp_path, monkeypatch, fake_targets):
+    lc_dir, calls = fake_targets
+    config = rp.load_def_config()
+    monkeypatch.setattr(rp, "load_def_config",
+                        lambda: dict(config, resume=True, output="jsonl"))
+    out_dir = str(tmp_path / "out")
+    for i in range(2):
+        for ticid in (1, 2):
+            rp.run_write_one(ticid, 14, out_dir, lc_author="tess-spoc",
+                             local_dir=str(lc_dir), run_tag="t")
+        rp.finish_run()
+    assert calls == [1, 2]
+    assert os.path.exists(os.path.join(out_dir, "t.manifest.jsonl"))
+
+    #A manifest under the worker file names is not read as results
+    with open(os.path.join(out_dir, "t-manifest.jsonl"), "w") as fobj:
+        fobj.write('{"ticid": 1, "sector": 14, "key": "a", "finished": 1e12}\n')
+    merged = output.merge(out_dir, "t")
+    assert [r['status'] for r in output.read_records(merged)] == \
+        ["success"] * 2
+    assert output.export_files(merged, str(tmp_path / "files")) == 2
+
+
+def test_failed_background_write_not_marked(tmp_path, monkeypatch,
+                                            fake_targets):
+    lc_dir, calls = fake_targets
+    write = output.FileWriter.write
+
+    def flaky(self, record):
+        if record['ticid'] == 1:
+            raise IOError("disk full")
+        write(self, record)
+    monkeypatch.setattr(output.FileWriter, "write", flaky)
+
+    man = manifest.RunManifest(str(tmp_path / "manifest.jsonl"))
+
+    def run(ticid):
+        rp.run_write_one(ticid, 14, str(tmp_path / "out"),
+                         lc_author="tess-spoc", local_dir=str(lc_dir),
+                         run_tag="t", output="files", background=True,
+                         manifest=man)
+    run(1)
+    with pytest.raises(output.WriteError) as info:
+        rp.finish_run()
+    assert info.value.ticid == 1
+    assert len(man) == 0
+
+    monkeypatch.setattr(output.FileWriter, "write", write)
+    run(1)
+    run(2)
+    rp.finish_run()
+    assert calls == [1, 1, 2]
+    assert len(man) == 2
+
+
+def test_marked_done_when_metrics_commit(tmp_path, fake_targets):
+    lc_dir, calls = fake_targets
+    man = manifest.RunManifest(str(tmp_path / "manifest.jsonl"))
+    st = store.MetricsStore(str(tmp_path / "metrics.sqlite"), batch_size=2)
+    commits = []
+    commit = st._commit
+
+    def counted():
+        commits.append(len(st._rows))
+        commit()
+    st._commit = counted
+
+    def run(ticid):
+        rp.run_write_one(ticid, 14, str(tmp_path / "out"),
+                         lc_author="tess-spoc", local_dir=str(lc_dir),
+                         run_tag="t", output="files", manifest=man,
+                         metrics_store=st)
+    run(1)
+    assert commits == [] and len(man) == 0
+    run(2)
+    assert commits == [2] and len(man) == 2
+    st.close()
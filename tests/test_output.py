@@ -0,0 +1,166 @@
+import filecmp
+import os
+import threading
+import time
+
+import pytest
+
+from corazon import output
+
+
+def record(ticid, sector, status="success", plot=None, run_tag="run1"):
+    rec = output.new_record(ticid, sector, run_tag, "qlp")
+    rec['status'] = status
+    rec['log'] = "Success.\n" if status == "success" else "Failed"
+    if status == "success":
+        rec['results'] = ["TIC %i, 1, %i, PASS\n" % (ticid, sector),
+                          "TIC %i, 2, %i, FAIL\n" % (ticid, sector)]
+        rec['tces'] = [{'period': 2.5, 'period_unit': 'd', 'event': "1",
+                        'target': "TIC %i" % ticid},
+                       {'period': 4.1, 'period_unit': 'd', 'event': "2",
+                        'target': "TIC %i" % ticid}]
+    rec['plot'] = plot
+    return rec
+
+
+def test_file_writer_layout(tmp_path):
+    writer = output.open_writer(str(tmp_path), "run1", backend="files")
+    writer.write(record(1234, 14, plot=b"png"))
+    writer.write(record(99, 15, status="failed"))
+
+    tdir = tmp_path / "tic000001234s14"
+    assert sorted(os.listdir(tdir)) == ["tic000001234-01-run1.json",
+                                        "tic000001234-02-run1.json",
+                                        "tic000001234-run1-plot.png",
+                                        "tic000001234-run1-tcesum.csv",
+                                        "tic000001234-run1.log"]
+    assert (tdir / "tic000001234-run1-tcesum.csv").read_text() == \
+        "TIC 1234, 1, 14, PASS\nTIC 1234, 2, 14, FAIL\n"
+    assert os.listdir(tmp_path / "tic000000099s15") == ["tic000000099-run1.log"]
+
+    with pytest.raises(ValueError):
+        output.open_writer(str(tmp_path), "run1", backend="nope")
+
+
+def test_jsonl_batches_merge_and_export(tmp_path):
+    out_dir = str(tmp_path / "run")
+    writer = output.open_writer(out_dir, "run1", backend="jsonl",
+                                batch_size=3)
+    assert output.open_writer(out_dir, "run1", backend="jsonl") is writer
+
+    writer.write(record(1, 14))
+    writer.write(record(2, 14, plot=b"png"))
+    assert not os.path.exists(writer.path)
+    writer.write(record(3, 14, status="failed"))
+    assert len(list(output.read_records(writer.path))) == 3
+    #A retry of a failed target, then records still in the buffer at exit
+    writer.write(record(3, 14))
+    writer.write(record(4, 15))
+    output.close_writers()
+
+    #A second worker, with a line cut short by a crash
+    other = os.path.join(out_dir, "run1-otherhost-1.jsonl")
+    with open(other, "w") as fobj:
+        fobj.write('{"ticid": 5, "sector": 14, "st')
+
+    merged = output.merge(out_dir, "run1")
+    records = list(output.read_records(merged))
+    assert [(r['ticid'], r['sector']) for r in records] == \
+        [(1, 14), (2, 14), (3, 14), (4, 15)]
+    assert records[2]['status'] == "success"
+
+    #Exporting gives the same files as writing them directly
+    legacy = tmp_path / "legacy"
+    exported = tmp_path / "exported"
+    direct = output.FileWriter(str(legacy))
+    for r in [record(1, 14), record(2, 14, plot=b"png"), record(3, 14),
+              record(4, 15)]:
+        direct.write(r)
+    assert output.export_files(merged, str(exported)) == 4
+    for tdir in os.listdir(legacy):
+        cmp = filecmp.dircmp(legacy / tdir, exported / tdir)
+        assert cmp.left_only == cmp.right_only == []
+        match = filecmp.cmpfiles(legacy / tdir, exported / tdir,
+                                 cmp.common_files, shallow=False)[0]
+        assert sorted(match) == sorted(cmp.common_files)
+
+    assert output.export_files(merged, str(tmp_path / "one"),
+                               targets=[(4, 15)]) == 1
+    assert os.listdir(tmp_path / "one") == ["tic000000004s15"]
+
+
+def test_background_writer(tmp_path):
+    out_dir = str(tmp_path)
+    writer = output.open_writer(out_dir, "bg", backend="jsonl",
+                                background=True, batch_size=1000)
+    assert isinstance(writer, output.BackgroundWriter)
+    done = []
+    for i in range(20):
+        writer.write(record(i, 14, run_tag="bg"))
+        writer.submit(done.append, i)
+    writer.flush()
+    assert done == list(range(20))
+    ticids = [r['ticid'] for r in output.read_records(writer.writer.path)]
+    assert ticids == list(range(20))
+
+    #The files backend shares the same thread
+    files = output.open_writer(str(tmp_path / "files"), "bg",
+                               background=True)
+    assert files.thread is writer.thread
+    files.write(record(7, 14, run_tag="bg"))
+    output.close_writers()
+    assert os.path.exists(tmp_path / "files" / "tic000000007s14" /
+                          "tic000000007-bg.log")
+
+
+def test_writer_thread_backpressure_and_errors():
+    thread = output.WriterThread(maxsize=2)
+    release = threading.Event()
+    thread.submit(release.wait)
+    thread.submit(time.sleep, 0)
+    thread.submit(time.sleep, 0)
+
+    #The queue is full, so the next submit waits for the thread
+    producer = threading.Thread(target=thread.submit, args=(time.sleep, 0))
+    producer.start()
+    producer.join(0.2)
+    assert producer.is_alive()
+    release.set()
+    producer.join(5)
+    assert not producer.is_alive()
+
+    def fail():
+        raise IOError("disk full")
+    done = []
+    thread.submit(fail)
+    thread.submit(done.append, 1)
+    with pytest.raises(IOError):
+        thread.join()
+    #Later tasks still ran
+    assert done == [1]
+    thread.close()
+    with pytest.raises(ValueError):
+        thread.submit(done.append, 2)
+
+
+def test_background_errors_name_the_target(tmp_path):
+    writer = output.open_writer(str(tmp_path), "err", background=True)
+
+    def fail(*args):
+        raise IOError("disk full")
+    ran = threading.Event()
+    writer.submit_for((5, 14), fail)
+    writer.submit(ran.set)
+    assert ran.wait(5)
+
+    #Work for the next target is still accepted, the error is raised by
+    #check, for the target that failed
+    writer.write(record(6, 14, run_tag="err"))
+    with pytest.raises(output.WriteError) as info:
+        writer.check()
+    assert (info.value.ticid, info.value.sector) == (5, 14)
+    assert isinstance(info.value.error, IOError)
+    assert "TIC 5 sector 14" in str(info.value)
+    writer.check()
+    output.close_writers()
+    assert os.path.exists(tmp_path / "tic000000006s14" / "tic000000006-err.log")
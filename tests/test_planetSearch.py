@@ -0,0 +1,253 @@
+import numpy as np
+import pytest
+
+import corazon.planetSearch as ps
+from corazon import rolling
+
+
+def loop_median_detrend(flux, window):
+    """The original per-point implementation, kept as a reference."""
+    size = len(flux)
+    nPoints = window
+    filtered = np.zeros(size)
+    for i in range(size):
+        lwr = max(i-nPoints, 0)
+        upr = min(lwr + 2*nPoints, size)
+        lwr = upr- 2*nPoints
+        offset = np.median(flux[lwr:upr])
+        filtered[i] = flux[i]/offset - 1
+    return filtered
+
+
+@pytest.mark.parametrize("size, window", [(500, 65), (500, 3), (100, 50),
+                                          (70, 50), (30, 50), (1500, 300)])
+def test_median_detrend_matches_loop(size, window):
+    rng = np.random.default_rng(42)
+    flux = 1 + 1e-3 * rng.standard_normal(size)
+
+    np.testing.assert_array_equal(ps.median_detrend(flux, window),
+                                  loop_median_detrend(flux, window))
+    np.testing.assert_array_equal(ps.median_subtract(flux, window) + 1,
+                                  flux - rolling.clamped_median(flux, window) + 1)
+
+
+@pytest.mark.parametrize("length", [4, 7, 600, 601])
+def test_running_median_engines_agree(length):
+    rng = np.random.default_rng(1)
+    x = rng.standard_normal(2000)
+    x[[100, 1500]] = np.nan
+
+    expected = np.array([np.median(x[j:j+length])
+                         for j in range(len(x) - length + 1)])
+    np.testing.assert_array_equal(rolling._running_median_sorted(x, length),
+                                  expected)
+    np.testing.assert_array_equal(rolling._running_median_vectorised(x, length),
+                                  expected)
+
+
+def loop_running_std_gap(flux, window, N=3, nSigTimes=3.3):
+    """The original per-point implementation, kept as a reference."""
+    gap = np.zeros(len(flux))
+    std_array = np.zeros(len(flux))
+    for i in range(window, len(flux), 1):
+        std_array[i] = np.nanstd(flux[i-window:i])
+    med_std = np.median(std_array)
+    for i in np.argsort(std_array)[-1*N:]:
+        if std_array[i] > med_std * nSigTimes:
+            gap[i-window:i] = 1
+    return gap == 1, med_std
+
+
+def test_running_std_gap_matches_loop():
+    rng = np.random.default_rng(7)
+    flux = 1e-3 * rng.standard_normal(3000)
+    flux[1000:1100] *= 20
+    flux[2500:2520] *= 50
+    flux[50] = np.nan
+
+    isbad, med_std, sections = ps.running_std_gap(flux, 70, N=2, nSigTimes=5,
+                                                  return_sections=True)
+    ref_isbad, ref_med_std = loop_running_std_gap(flux, 70, N=2, nSigTimes=5)
+
+    np.testing.assert_array_equal(isbad, ref_isbad)
+    assert med_std == ref_med_std
+    assert len(sections) == 2
+    for lwr, upr in sections:
+        assert np.all(isbad[lwr:upr])
+
+
+def test_lazy_bls_stats():
+    from astropy.timeseries import BoxLeastSquares
+
+    rng = np.random.default_rng(3)
+    time = np.arange(1325, 1352, 1/48.)
+    flux = 1e-3 * rng.standard_normal(len(time))
+    expected = BoxLeastSquares(time, flux).compute_stats(2.3, 0.1, 1326.1)
+
+    stats = ps.LazyBlsStats(time, flux, 2.3, 0.1, 1326.1, grid_size=10)
+    assert not stats.computed
+    np.testing.assert_array_equal(stats['transit_times'],
+                                  expected['transit_times'])
+    assert stats.computed
+    assert stats['grid_size'] == 10
+    assert set(stats) == set(expected) | {'grid_size'}
+    with pytest.raises(KeyError):
+        stats['nope']
+
+
+def loop_findPeriodicOutliers(time_days, singleOutlierIndex, precision_days):
+    """The original list based implementation, kept as a reference.
+
+    Inputs
+    ---------
+    time_days
+        (1d numpy array) Times of data points, in days
+
+    singleOutlierIndex
+        (array of ints) Array elements of time that have
+        been flagged as outliers. ``len(singleOutlierIndices == len(time)``
+
+    precision_days
+        (float) How close to perfectly evenly spaced do points need to
+        be to be marked as periodic?
+
+    Returns
+    ----------
+    notOutliers
+        An array of elements of `singleOutlierIndices` that are periodic.
+        set(notOutliers) is a wholly owned subset of set(singleOutlierIndices)
+    """
+
+    assert len(time_days) == len(singleOutlierIndex)
+
+    #Convert to list of indices
+    singleOutliers = np.where(singleOutlierIndex)[0]
+    notOutliers = []
+
+    outlierTimes = time_days[singleOutliers]
+    diffs = [outlierTimes[i+1] - outlierTimes[i] for i in range(0, len(outlierTimes)-1)]
+    diffs = [round(d, 5) for d in diffs]
+
+    if len(singleOutliers) >= 4:
+        if len(set(diffs)) == len(diffs):
+            possibleTimes = np.array([])
+        else:
+            period = max(set(diffs), key = diffs.count) # period = most common difference
+            epoch = outlierTimes[ diffs.index(period) ]
+            possibleTimes = np.arange(epoch, outlierTimes[-1] + 0.5*period, period)
+
+        notOutliers = []
+        for i in range(len(outlierTimes)):
+            if np.any((abs(possibleTimes - outlierTimes[i]) < precision_days)):
+                notOutliers.append(singleOutliers[i])
+    
+
+    elif len(singleOutliers) == 3:
+        #If we only have three outliers, and they are equally spaced
+        #then they are periodic
+        if abs(diffs[0] - diffs[1]) < precision_days:
+            notOutliers.extend(singleOutliers)
+    #debug()
+    assert set(notOutliers).issubset(singleOutliers)
+    return notOutliers
+
+
+@pytest.mark.parametrize("seed", range(6))
+def test_find_periodic_outliers_matches_loop(seed):
+    rng = np.random.default_rng(seed)
+    time = np.arange(1325, 1352, 1/48.)
+    isOutlier = rng.uniform(size=len(time)) < [0.002, 0.01, 0.05,
+                                               0.2, 0.5, 0.9][seed]
+    #A periodic train of outliers, on top of the random ones
+    isOutlier[::97] = True
+
+    expected = loop_findPeriodicOutliers(time, isOutlier, 0.0205)
+    result = ps.findPeriodicOutliers(time, isOutlier, 0.0205)
+    np.testing.assert_array_equal(result, expected)
+
+
+def test_find_periodic_outliers_ties():
+    #Two spacings each seen twice, the tie is broken as the original did
+    time = np.array([0, 1, 2, 5, 7, 9, 10.3, 13, 20.0])
+    for isOutlier in [np.ones(len(time), dtype=bool),
+                      np.array([1, 1, 1, 0, 1, 1, 1, 1, 0], dtype=bool),
+                      np.array([1, 0, 1, 0, 1, 0, 0, 0, 0], dtype=bool)]:
+        np.testing.assert_array_equal(
+            ps.findPeriodicOutliers(time, isOutlier, 0.1),
+            loop_findPeriodicOutliers(time, isOutlier, 0.1))
+
+
+def loop_clean_timeseries(time, flux, qflags, det_window, noise_window, n_sigma, sector,
+                     unknown_sector="error", gap_file=None):
+    
+    qbad = qflags != 0
+    tgaps = ps.loadGapInfoBySector(time, sector, unknown_sector=unknown_sector,
+                                gap_file=gap_file)
+    bad = loop_idNoisyData(flux, noise_window, Nsigma=n_sigma)
+ 
+    flagged = bad | qbad | tgaps  #Indicate bad data
+    med_det = ps.median_detrend(flux[~flagged], det_window)
+    det_time = time[~flagged]
+
+    #Look for extra noisy section on length of around 1.5 days (window = 90)
+    std_bad, med_std = ps.running_std_gap(med_det, 70, N=2, nSigTimes=5)
+    #print(len(std_bad[std_bad]))
+    
+    
+    good_time = det_time[~std_bad]
+    good_flux = med_det[~std_bad]
+    
+    #Final Pass for single point outliers that are not periodic
+    spo_idx = ps.findOutliers(good_time, good_flux, gap=None,
+                 threshold_sigma=3.0,
+                 precision_days=0.02085,
+                 maxClusterLen = 3
+                 )   
+    #print("spo_idx")
+    #print(spo_idx)
+    #spogaps = np.zeros(len(spo_idx)) == 1
+    #spogaps[spo_idx] = True
+    #plt.figure()
+    #plt.plot(good_time[~spo_idx], good_flux[~spo_idx])
+    
+    return good_time[~spo_idx], good_flux[~spo_idx]
+
+
+def loop_idNoisyData(flux, window, Nsigma=4):
+    """The original idNoisyData, kept as a reference."""
+    win = int(window)
+    if ~ps.is_odd(win):
+        win=win+1
+
+    is_bad = np.zeros(len(flux)) == 1
+    mdFlux = ps.median_detrend(flux[~is_bad], win)
+
+    for i in np.arange(1,4):
+        if np.all(is_bad):
+            continue
+        sd = np.std(mdFlux)
+        is_bad |= np.abs(mdFlux) > Nsigma * sd
+    return is_bad
+
+
+@pytest.mark.parametrize("noise_window, sector, noisy", [(27, 1, True),
+                                                         (64, 1, False),
+                                                         (64, 99, False),
+                                                         (64, 99, True)])
+def test_clean_timeseries_matches_loop(noise_window, sector, noisy):
+    rng = np.random.default_rng(11)
+    time = np.arange(1325, 1352, 1/48.)
+    flux = 1 + 1e-3 * rng.standard_normal(len(time))
+    if noisy:
+        flux[::211] += 5e-3
+        flux[400:480] += 1e-2 * rng.standard_normal(80)
+    qflags = np.zeros(len(time), dtype=int)
+    if sector == 1:
+        qflags[100:120] = 4
+
+    #Sector 99 has no gaps and no flags, so the first detrend is reused
+    args = (time, flux, qflags, 65, noise_window, 4.5, sector)
+    expected = loop_clean_timeseries(*args, unknown_sector="none")
+    result = ps.clean_timeseries(*args, unknown_sector="none")
+    for r, e in zip(result, expected):
+        np.testing.assert_array_equal(r, e)
@@ -0,0 +1,101 @@
+import sqlite3
+
+import numpy as np
+
+from corazon import disposition, store
+from corazon.metrics import VetterMetrics
+
+THRESHOLDS = {'snr': 1, 'norm_lpp': 2.0, 'tp_cover': 0.6, 'oe_sigma': 3,
+              'sweet': 3}
+
+
+def target(ticid, sector, n_tce, seed=0):
+    rng = np.random.default_rng(seed)
+    metrics_list = []
+    tce_list = []
+    for i in range(n_tce):
+        amp = np.zeros((3, 3))
+        amp[:, -1] = rng.uniform(0, 3.5, size=3)
+        m = VetterMetrics(snr=rng.uniform(0.8, 20),
+                          norm_lpp=rng.uniform(0, 2.5),
+                          oe_sigma=rng.uniform(0, 4),
+                          tp_cover=rng.uniform(0.4, 1), sweet={'amp': amp})
+        disp, reason = disposition.dispose(
+            disposition.metrics_table([m], [{'target': "TIC 1", 'sector': 1,
+                                             'event': "1"}]), THRESHOLDS)
+        metrics_list.append(m)
+        tce_list.append({'target': "TIC %i" % ticid, 'sector': sector,
+                         'event': "%i" % (i + 1), 'disposition': disp[0],
+                         'reason': reason[0]})
+    return metrics_list, tce_list
+
+
+def count_rows(path):
+    #A separate connection only sees committed rows
+    conn = sqlite3.connect(path)
+    try:
+        return conn.execute("SELECT COUNT(*) FROM metrics").fetchone()[0]
+    finally:
+        conn.close()
+
+
+def test_batched_writes(tmp_path):
+    path = str(tmp_path / "run-metrics.sqlite")
+    with store.MetricsStore(path, batch_size=5) as st:
+        st.add(*target(100, 14, 3))
+        assert count_rows(path) == 0
+        st.add(*target(101, 14, 3, seed=1))
+        assert count_rows(path) == 6
+        st.add(*target(102, 15, 2, seed=2))
+        assert count_rows(path) == 6
+    assert count_rows(path) == 8
+
+    with store.MetricsStore(path) as st:
+        #A target that is run again replaces its rows
+        st.add(*target(101, 14, 3, seed=1))
+        assert len(st) == 8
+
+        table = st.query("sector = ?", (14,))
+        np.testing.assert_array_equal(table['ticid'], [100] * 3 + [101] * 3)
+        np.testing.assert_array_equal(table['event'], [1, 2, 3] * 2)
+        assert np.all(np.isnan(table['raw_lpp']))
+
+        everything = st.query()
+    assert len(everything['ticid']) == 8
+
+    #The stored dispositions are what dispose gives with the same thresholds
+    disp, reason = disposition.dispose(everything, THRESHOLDS)
+    np.testing.assert_array_equal(disp, everything['disposition'])
+    np.testing.assert_array_equal(reason, everything['reason'])
+
+
+def test_rerun_replaces_target(tmp_path):
+    path = str(tmp_path / "run-metrics.sqlite")
+    with store.MetricsStore(path, batch_size=100) as st:
+        st.add(*target(100, 14, 4))
+        st.add(*target(101, 14, 2))
+        st.flush()
+        #Fewer TCEs on a rerun, written in a later batch and in this one
+        st.add(*target(100, 14, 2, seed=1))
+        st.add(*target(101, 14, 3))
+        st.add(*target(101, 14, 1, seed=3))
+        st.add(*target(100, 15, 1))
+
+        table = st.query()
+    np.testing.assert_array_equal(table['ticid'], [100, 100, 100, 101])
+    np.testing.assert_array_equal(table['sector'], [14, 14, 15, 14])
+    np.testing.assert_array_equal(table['event'], [1, 2, 1, 1])
+    expected = target(101, 14, 1, seed=3)[0][0]['snr']
+    assert table['snr'][-1] == expected
+
+
+def test_redisposition_from_store(tmp_path):
+    path = str(tmp_path / "run-metrics.sqlite")
+    st = store.open_store(path)
+    assert store.open_store(path) is st
+    st.add(*target(100, 14, 4))
+    store.close_stores()
+
+    table = disposition.redisposition(path, dict(THRESHOLDS, snr=100))
+    assert list(table['disposition']) == ["FAIL"] * 4
+    assert all(r.startswith("-LowSNR-") for r in table['reason'])
@@ -0,0 +1,306 @@
+import pickle
+import warnings
+
+import numpy as np
+import pytest
+from astropy.time import Time
+
+with warnings.catch_warnings():
+    #lightkurve warns about optional dependencies on import
+    warnings.simplefilter("ignore")
+    import lightkurve as lk
+    import corazon.pipeline as pipe
+
+from exovetter import vetters
+from corazon.metrics import METRIC_FIELDS, VetterMetrics
+from corazon.vetter_pool import VetterPool
+
+
+class ConstantLpp(object):
+    """Stands in for vetters.Lpp, whose map has to be downloaded"""
+    metric_names = ('norm_lpp', 'raw_lpp')
+
+    def __init__(self):
+        self.map_info = dict()
+        self.norm_lpp = None
+        self.runs = 0
+
+    def run(self, tce, lc):
+        self.runs += 1
+        self.norm_lpp = 0.1 * tce['period'].value
+        #Kept in the metrics, to check each TCE gets a clean vetter
+        self.raw_lpp = self.runs
+
+
+class DispositionKeys(object):
+    """Sets tp_cover and sweet, which get_disposition reads, whatever the
+    installed exovetter calls them"""
+    metric_names = ('tp_cover', 'sweet')
+
+    def __init__(self):
+        self.tp_cover = None
+        self.sweet = None
+
+    def run(self, tce, lc):
+        self.tp_cover = 1 / tce['period'].value
+        self.sweet = {'amp': np.zeros((3, 3))}
+
+
+class RunOnly(object):
+    """A vetter that does not say which metrics it makes"""
+    def run(self, tce, lc):
+        self.tp_cover = 1.0
+
+
+class Raises(object):
+    """A vetter whose run fails, as exovetter vetters can with ValueError"""
+    metric_names = ('tp_cover',)
+
+    def run(self, tce, lc):
+        raise ValueError("Cannot vet this TCE")
+
+
+THRESHOLDS = {'snr': 1, 'norm_lpp': 0.5, 'tp_cover': 0.3, 'oe_sigma': 3,
+              'sweet': 3}
+
+
+def make_lc_and_tces():
+    rng = np.random.default_rng(5)
+    t = np.arange(1325, 1352, 1/48.)
+    flux = 1 + 1e-3 * rng.standard_normal(len(t))
+    tces = []
+    for i, (period, t0) in enumerate([(2.3, 1326.1), (4.1, 1328.7),
+                                      (7.7, 1330.2), (3.3, 1325.9)]):
+        intransit = np.abs((t - t0 + 0.5*period) % period - 0.5*period) < 2/48.
+        flux[intransit] -= 2e-3 * (i + 1)
+        tces.append([period, t0, 2e-3 * (i + 1), 4/48., 10])
+    lc = lk.LightCurve(time=Time(t, format="btjd"), flux=flux,
+                       meta={'sector': 1})
+    return lc, np.array(tces)
+
+
+def vetter_list():
+    return [ConstantLpp(), vetters.OddEven(), vetters.TransitPhaseCoverage(),
+            vetters.Sweet(), DispositionKeys()]
+
+
+@pytest.mark.parametrize("executor", ["thread", "process"])
+def test_parallel_vetting_matches_serial(executor):
+    lc, tces = make_lc_and_tces()
+    expected = pipe.vet_all_tces(lc, tces, 1234, vetter_list(), THRESHOLDS)
+    result = pipe.vet_all_tces(lc, tces, 1234, vetter_list(), THRESHOLDS,
+                               workers=3, executor=executor)
+
+    #Result strings, dispositions and reasons
+    for i in range(3):
+        assert result[i] == expected[i]
+    assert len(set(result[1])) == 2
+
+    for m, e in zip(result[3], expected[3]):
+        assert set(m) == set(e)
+        for key in ['norm_lpp', 'oe_sigma', 'tp_cover', 'snr']:
+            assert m[key] == e[key]
+        np.testing.assert_array_equal(m['sweet']['amp'], e['sweet']['amp'])
+    assert [t['event'] for t in result[4]] == ['1', '2', '3', '4']
+
+
+def test_process_pool_kept_between_targets():
+    lc, tces = make_lc_and_tces()
+    pool = VetterPool(vetter_list)
+    expected = pipe.vet_all_tces(lc, tces, 1234, vetter_list(), THRESHOLDS)
+    first = pipe.vet_all_tces(lc, tces, 1234, pool, THRESHOLDS, workers=2,
+                              executor="process")
+    workers = pipe._vet_pool
+    second = pipe.vet_all_tces(lc, tces, 1234, pool, THRESHOLDS, workers=2,
+                               executor="process")
+    assert pipe._vet_pool is workers
+    assert first[1] == second[1] == expected[1]
+
+    #Other vetters get a new pool
+    pipe.vet_all_tces(lc, tces, 1234, vetter_list(), THRESHOLDS, workers=2,
+                      executor="process")
+    assert pipe._vet_pool is not workers
+    pipe.shutdown_vet_pool()
+    assert pipe._vet_pool is None
+
+
+def test_thread_vetters_kept_between_targets():
+    lc, tces = make_lc_and_tces()
+    vetters_ = vetter_list()
+    expected = pipe.vet_all_tces(lc, tces, 1234, vetter_list(), THRESHOLDS)
+    for i in range(3):
+        result = pipe.vet_all_tces(lc, tces, 1234, vetters_, THRESHOLDS,
+                                   workers=2, executor="thread")
+        assert result[1] == expected[1]
+
+    pool = pipe._thread_vetters
+    assert pool.stats()['constructed'] == 1
+    assert pool.stats()['cloned'] <= 1
+    #The extra sets share the caller's map rather than copying it
+    with pool.borrow() as first, pool.borrow() as second:
+        assert {id(first[0].map_info), id(second[0].map_info)} == \
+            {id(vetters_[0].map_info)}
+
+    pipe.vet_all_tces(lc, tces, 1234, vetter_list(), THRESHOLDS, workers=2,
+                      executor="thread")
+    assert pipe._thread_vetters is not pool
+
+
+def test_unknown_executor():
+    lc, tces = make_lc_and_tces()
+    with pytest.raises(ValueError):
+        pipe.vet_all_tces(lc, tces, 1234, vetter_list(), THRESHOLDS,
+                          workers=2, executor="nope")
+
+
+def test_vetter_pool_reuses_and_resets():
+    pool = VetterPool(vetter_list)
+    with pool.borrow() as first:
+        assert pool.stats()['constructed'] == 1
+        with pool.borrow() as second:
+            #Made by copying the first set, not by the factory
+            assert second[0] is not first[0]
+            assert pool.stats()['cloned'] == 1
+        lc, tces = make_lc_and_tces()
+        first[0].run({'period': 2.3 * pipe.u.day}, lc)
+        assert first[0].runs == 1
+    #The copy shares the map
+    assert second[0].map_info is first[0].map_info
+
+    with pool.borrow() as again:
+        assert again is first or again is second
+        assert again[0].runs == 0
+        assert again[0].norm_lpp is None
+    assert pool.stats() == dict(constructed=1, cloned=1, reused=1, idle=2)
+    assert "1 constructed" in pool.report()
+
+    with pytest.raises(ValueError):
+        pool.release(vetter_list())
+
+
+@pytest.mark.parametrize("workers, executor", [(1, "thread"), (3, "thread"),
+                                               (3, "process")])
+def test_vetter_pool_matches_list(workers, executor):
+    lc, tces = make_lc_and_tces()
+    expected = pipe.vet_all_tces(lc, tces, 1234, vetter_list(), THRESHOLDS)
+
+    pool = VetterPool(vetter_list)
+    for i in range(2):
+        result = pipe.vet_all_tces(lc, tces, 1234, pool, THRESHOLDS,
+                                   workers=workers, executor=executor)
+        for j in range(3):
+            assert result[j] == expected[j]
+        for m, e in zip(result[3], expected[3]):
+            assert m['norm_lpp'] == e['norm_lpp']
+            assert m['raw_lpp'] == 1
+
+    stats = pool.stats()
+    if executor == "process":
+        #Built once here, then each worker reuses its pickled copy
+        assert stats['constructed'] == 0
+    else:
+        assert stats['constructed'] == 1
+        assert stats['constructed'] + stats['cloned'] <= workers
+        assert stats['reused'] == 2 * len(tces) - stats['constructed'] \
+            - stats['cloned']
+
+
+def test_compact_metrics():
+    lc, tces = make_lc_and_tces()
+    result = pipe.vet_all_tces(lc, tces, 1234, vetter_list(), THRESHOLDS)
+    metrics = result[3][0]
+
+    #Only the schema is kept, not the light curve or vetter settings
+    assert isinstance(metrics, VetterMetrics)
+    assert set(metrics) == set(METRIC_FIELDS)
+    assert 'lc' not in metrics and 'runs' not in metrics
+    assert metrics['snr'] == 10
+    assert metrics['norm_lpp'] == pytest.approx(0.23)
+    with pytest.raises(KeyError):
+        metrics['lc_name']
+    with pytest.raises(KeyError):
+        metrics['lc'] = lc
+
+    restored = pickle.loads(pickle.dumps(metrics))
+    assert restored.keys() == metrics.keys()
+    assert restored['norm_lpp'] == metrics['norm_lpp']
+
+
+@pytest.mark.parametrize("workers", [1, 3])
+def test_triage_matches_full_dispositions(workers):
+    lc, tces = make_lc_and_tces()
+    expected = pipe.vet_all_tces(lc, tces, 1234, vetter_list(), THRESHOLDS)
+
+    vetters_ = vetter_list()
+    #Cheap and declared first, so it decides the long period TCEs
+    vetters_[-1].cost = 0
+    vetters_[0].cost = 100
+    result = pipe.vet_all_tces(lc, tces, 1234, vetters_, THRESHOLDS,
+                               workers=workers, triage=True)
+
+    assert result[1] == expected[1]
+    for m, disp in zip(result[3], result[1]):
+        if disp == 'PASS':
+            assert m.decided_by is None
+            assert m.not_computed == ()
+        else:
+            assert m.decided_by == 'DispositionKeys'
+            #Everything else was skipped, including the expensive LPP
+            assert m.computed('tp_cover') and not m.computed('norm_lpp')
+            assert m['norm_lpp'] is None
+    if workers == 1:
+        assert vetters_[0].runs == result[1].count('PASS')
+
+
+def test_triage_skips_metrics_made_in_run():
+    #TransitPhaseCoverage and Sweet only make their metrics in run()
+    lc, tces = make_lc_and_tces()
+    def make():
+        lpp = ConstantLpp()
+        lpp.cost = 0
+        return [vetters.TransitPhaseCoverage(), vetters.Sweet(),
+                vetters.OddEven(), lpp]
+    expected = pipe.vet_all_tces(lc, tces, 1234, make(), THRESHOLDS)
+    result = pipe.vet_all_tces(lc, tces, 1234, make(), THRESHOLDS,
+                               triage=True)
+
+    assert result[1] == expected[1]
+    for m in expected[3]:
+        assert m['tp_cover'] is not None and m['sweet'] is not None
+    decided = [m for m in result[3] if m.decided_by == 'ConstantLpp']
+    assert len(decided) > 0
+    for m in decided:
+        assert not m.computed('tp_cover') and not m.computed('sweet')
+        assert m['tp_cover'] is None and m['sweet'] is None
+
+    with pytest.raises(ValueError):
+        pipe.vet_tce(result[4][0], lc, [RunOnly()], thresholds=THRESHOLDS,
+                     triage=True)
+
+
+@pytest.mark.parametrize("triage", [False, True])
+def test_vetter_error_is_not_a_pass(triage):
+    lc, tces = make_lc_and_tces()
+    vetters_ = [ConstantLpp(), vetters.OddEven(), vetters.Sweet(), Raises()]
+    result = pipe.vet_all_tces(lc, tces, 1234, vetters_, THRESHOLDS,
+                               triage=triage)
+
+    assert result[1] == ['FAIL'] * len(tces)
+    for m, reason in zip(result[3], result[2]):
+        if m.decided_by in (None, 'Raises'):
+            assert reason.count("-Missing_tp_cover-") == 1
+            assert m.computed('tp_cover') and m['tp_cover'] is None
+
+
+def test_triage_low_snr():
+    lc, tces = make_lc_and_tces()
+    tces[:, 4] = 0.5
+    result = pipe.vet_all_tces(lc, tces, 1234, vetter_list(), THRESHOLDS,
+                               triage=True)
+    assert result[2] == ['-LowSNR-'] * len(tces)
+    for m in result[3]:
+        assert m.decided_by == 'snr'
+        assert not m.computed('oe_sigma')
+
+    with pytest.raises(ValueError):
+        pipe.vet_tce(result[4][0], lc, vetter_list(), triage=True)